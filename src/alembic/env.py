@@ -34,11 +34,22 @@ target_metadata = Base.metadata
 # ... etc.
 
 
+# Tables used by gobupload itself, not part of the GOB model
+GOBUPLOAD_TABLES = [
+    "apply_commit_decisions", "upload_fingerprints", "event_watermarks",
+    "event_partitions", "event_archives", "storage_fingerprints", "materialized_view_refreshes",
+    "deferred_foreign_keys", "materialized_view_watermarks"
+]
+
+
 def include_object(object, name, type_, reflected, compare_to):
-    if type_ == "index" or name in ["spatial_ref_sys", "events"]:
+    if type_ == "index" or name in ["spatial_ref_sys", "events", *GOBUPLOAD_TABLES]:
         # Indexes are created by gobupload upon startup
         # Events is a partitioned table and is maintained manually
         return False
+    if type_ == "table" and reflected and name.startswith("mv_"):
+        # Relation lookups are maintained as tables by gobupload in incremental mode (see materialized_views.py)
+        return False
     return True
 
 
@@ -0,0 +1,36 @@
+"""Event archives
+
+Revision ID: a9c6d7e8f0b1
+Revises: f8a5b6c7d9e0
+Create Date: 2026-10-18 17:02:31.518342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9c6d7e8f0b1'
+down_revision = 'f8a5b6c7d9e0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Checkpoints of the events that have been archived and deleted from the events table (see archive.py)
+    op.create_table('event_archives',
+    sa.Column('catalogue', sa.String(), nullable=False),
+    sa.Column('entity', sa.String(), nullable=False),
+    sa.Column('source', sa.String(), nullable=False),
+    sa.Column('archived_eventid', sa.BigInteger(), nullable=False),
+    sa.Column('snapshot_eventid', sa.BigInteger(), nullable=False),
+    sa.Column('events', sa.BigInteger(), nullable=False),
+    sa.Column('events_file', sa.String(), nullable=False),
+    sa.Column('snapshot_file', sa.String(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('catalogue', 'entity', 'source', 'archived_eventid')
+    )
+
+
+def downgrade():
+    op.drop_table('event_archives')
@@ -0,0 +1,32 @@
+"""Storage fingerprints
+
+Revision ID: b0d7e8f9a1c2
+Revises: a9c6d7e8f0b1
+Create Date: 2026-10-18 18:24:07.330915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'b0d7e8f9a1c2'
+down_revision = 'a9c6d7e8f0b1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Fingerprint of the index and materialized view definitions that have been reconciled at startup
+    op.create_table('storage_fingerprints',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('revision', sa.String(), nullable=False),
+    sa.Column('fingerprint', sa.String(), nullable=False),
+    sa.Column('definitions', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('storage_fingerprints')
@@ -0,0 +1,29 @@
+"""Apply commit decisions
+
+Revision ID: b3f1c2d4e5a6
+Revises: 7bb1fd6f214d
+Create Date: 2026-10-18 09:12:41.208113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3f1c2d4e5a6'
+down_revision = '7bb1fd6f214d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Commit decisions for pages of events that are applied in two-phase transactions by multiple workers
+    op.create_table('apply_commit_decisions',
+    sa.Column('xid', sa.String(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('xid')
+    )
+
+
+def downgrade():
+    op.drop_table('apply_commit_decisions')
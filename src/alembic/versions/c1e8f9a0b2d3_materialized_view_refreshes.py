@@ -0,0 +1,30 @@
+"""Materialized view refreshes
+
+Revision ID: c1e8f9a0b2d3
+Revises: b0d7e8f9a1c2
+Create Date: 2026-10-18 23:52:41.618204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c1e8f9a0b2d3'
+down_revision = 'b0d7e8f9a1c2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Last event of the relation table at the last refresh of its materialized view
+    op.create_table('materialized_view_refreshes',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('last_event', sa.BigInteger(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('materialized_view_refreshes')
@@ -0,0 +1,34 @@
+"""Upload fingerprints
+
+Revision ID: d6e3f4a5b7c8
+Revises: b3f1c2d4e5a6
+Create Date: 2026-10-18 13:21:09.614083
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd6e3f4a5b7c8'
+down_revision = 'b3f1c2d4e5a6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Fingerprint of the last successfully applied full upload, with the last eventid after the upload was applied
+    op.create_table('upload_fingerprints',
+    sa.Column('catalogue', sa.String(), nullable=False),
+    sa.Column('entity', sa.String(), nullable=False),
+    sa.Column('source', sa.String(), nullable=False),
+    sa.Column('application', sa.String(), nullable=False),
+    sa.Column('fingerprint', sa.String(), nullable=False),
+    sa.Column('last_eventid', sa.BigInteger(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('catalogue', 'entity', 'source', 'application')
+    )
+
+
+def downgrade():
+    op.drop_table('upload_fingerprints')
@@ -0,0 +1,30 @@
+"""Deferred foreign keys
+
+Revision ID: e3a0b1c2d4f5
+Revises: c1e8f9a0b2d3
+Create Date: 2026-10-19 09:48:36.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3a0b1c2d4f5'
+down_revision = 'c1e8f9a0b2d3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Foreign keys that have been dropped while applying, they are restored if the apply is interrupted
+    op.create_table('deferred_foreign_keys',
+    sa.Column('tablename', sa.String(), nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('definition', sa.String(), nullable=False),
+    sa.PrimaryKeyConstraint('tablename', 'name')
+    )
+
+
+def downgrade():
+    op.drop_table('deferred_foreign_keys')
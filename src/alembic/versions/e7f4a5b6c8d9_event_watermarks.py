@@ -0,0 +1,32 @@
+"""Event watermarks
+
+Revision ID: e7f4a5b6c8d9
+Revises: d6e3f4a5b7c8
+Create Date: 2026-10-18 15:02:44.187302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7f4a5b6c8d9'
+down_revision = 'd6e3f4a5b7c8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Highest applied eventid (entity _last_event) and highest stored eventid per collection and source
+    op.create_table('event_watermarks',
+    sa.Column('catalogue', sa.String(), nullable=False),
+    sa.Column('entity', sa.String(), nullable=False),
+    sa.Column('source', sa.String(), nullable=False),
+    sa.Column('applied_eventid', sa.BigInteger(), nullable=False),
+    sa.Column('last_eventid', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('catalogue', 'entity', 'source')
+    )
+
+
+def downgrade():
+    op.drop_table('event_watermarks')
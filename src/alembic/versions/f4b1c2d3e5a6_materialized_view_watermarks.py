@@ -0,0 +1,30 @@
+"""Materialized view watermarks
+
+Revision ID: f4b1c2d3e5a6
+Revises: e3a0b1c2d4f5
+Create Date: 2026-10-19 10:12:08.513672
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4b1c2d3e5a6'
+down_revision = 'e3a0b1c2d4f5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The last event per source of the relation table that has been applied to an incremental mv_ table
+    op.create_table('materialized_view_watermarks',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('source', sa.String(), nullable=False),
+    sa.Column('last_event', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name', 'source')
+    )
+
+
+def downgrade():
+    op.drop_table('materialized_view_watermarks')
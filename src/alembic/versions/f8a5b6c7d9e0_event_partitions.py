@@ -0,0 +1,34 @@
+"""Event partitions
+
+Revision ID: f8a5b6c7d9e0
+Revises: e7f4a5b6c8d9
+Create Date: 2026-10-18 16:11:52.904617
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from gobupload.storage.queries import get_backfill_event_partitions_query
+
+
+# revision identifiers, used by Alembic.
+revision = 'f8a5b6c7d9e0'
+down_revision = 'e7f4a5b6c8d9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Registry of the source partitions of the events table (schema events)
+    op.create_table('event_partitions',
+    sa.Column('catalogue', sa.String(), nullable=False),
+    sa.Column('entity', sa.String(), nullable=False),
+    sa.Column('source', sa.String(), nullable=False),
+    sa.Column('tablename', sa.String(), nullable=False),
+    sa.PrimaryKeyConstraint('catalogue', 'entity', 'source')
+    )
+    op.execute(get_backfill_event_partitions_query())
+
+
+def downgrade():
+    op.drop_table('event_partitions')
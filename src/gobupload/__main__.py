@@ -36,8 +36,11 @@ from gobupload import apply
 from gobupload import compare
 from gobupload import relate
 from gobupload import update
+from gobupload.apply.rebuild import TableRebuilder
+from gobupload.storage.archive import EventArchiver
 from gobupload.storage.handler import GOBStorageHandler
-from gobupload.config import DEBUG
+from gobupload.storage.materialized_views import MaterializedViews
+from gobupload.config import DEBUG, INDEX_BACKGROUND, REBUILD_WORKERS
 
 
 SERVICEDEFINITION: ServiceDefinition = {
@@ -196,6 +199,98 @@ def argument_parser():
         nargs="?",
         help="The materialized view to update. Use with --materialized-views."
     )
+
+    # Verify faux handler, which compares the event watermarks with the events and entities.
+    verify_parser = subparsers.add_parser(
+        name="verify_event_watermarks",
+    )
+    verify_parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        default=False,
+        help="Rebuild the event watermarks that differ."
+    )
+
+    # Verify faux handler, which compares the materialized views with a full recompute.
+    verify_views_parser = subparsers.add_parser(
+        name="verify_materialized_views",
+    )
+    verify_views_parser.add_argument(
+        "--mv-name",
+        nargs="?",
+        help="The materialized view to verify, all if omitted."
+    )
+    verify_views_parser.add_argument(
+        "--repair",
+        action="store_true",
+        default=False,
+        help="Recompute the materialized views that differ."
+    )
+
+    # Backfill faux handler, which registers the existing event partitions.
+    subparsers.add_parser(
+        name="backfill_event_partitions",
+    )
+
+    # Archive faux handler, which exports and deletes the applied events up to a cutoff.
+    archive_parser = subparsers.add_parser(
+        name="archive_events",
+        description="Archive the applied events up to an eventid to compressed files (see storage/archive.py)."
+    )
+    archive_parser.add_argument(
+        "--cutoff",
+        type=int,
+        required=True,
+        help="The last eventid to archive, limited to the last applied event of each collection."
+    )
+    archive_parser.add_argument(
+        "--directory",
+        required=True,
+        help="The directory to write the archive files to."
+    )
+    archive_parser.add_argument(
+        "--catalogue",
+        required=False,
+        help="The name of the data catalogue (example: \"meetbouten\")."
+    )
+    archive_parser.add_argument(
+        "--collection",
+        required=False,
+        help="The name of the data collection (example: \"metingen\")."
+    )
+    archive_parser.add_argument(
+        "--vacuum-full",
+        action="store_true",
+        default=False,
+        help="Rewrite the event partitions to return the space to the operating system (locks the partitions)."
+    )
+
+    # Rebuild faux handler, which replays the events of a collection into a new table.
+    rebuild_parser = subparsers.add_parser(
+        name="rebuild_table",
+        description="Rebuild the table of a collection from its events (see apply/rebuild.py)."
+    )
+    rebuild_parser.add_argument(
+        "--catalogue",
+        required=True,
+        help="The name of the data catalogue (example: \"meetbouten\")."
+    )
+    rebuild_parser.add_argument(
+        "--collection",
+        required=True,
+        help="The name of the data collection (example: \"metingen\")."
+    )
+    rebuild_parser.add_argument(
+        "--workers",
+        type=int,
+        default=REBUILD_WORKERS,
+        help="The number of workers that replay the events, sharded by tid."
+    )
+    rebuild_parser.add_argument(
+        "--snapshot-directory",
+        required=False,
+        help="The directory with the archived snapshots, required if events have been archived."
+    )
     return parser
 
 
@@ -205,7 +300,7 @@ if DEBUG:
 
 def run_as_message_driven() -> None:
     """Run in message driven mode, listening to a message queue."""
-    GOBStorageHandler().init_storage()
+    GOBStorageHandler().init_storage(background_indexes=INDEX_BACKGROUND)
 
     params = {
         "stream_contents": True,
@@ -217,14 +312,92 @@ def run_as_message_driven() -> None:
     messagedriven_service(SERVICEDEFINITION, "Upload", params)
 
 
+def _migrate(args: argparse.Namespace) -> int:
+    mviews = args.materialized_views
+    GOBStorageHandler().init_storage(
+        force_migrate=True,
+        recreate_materialized_views=[args.mv_name] if mviews and args.mv_name else mviews
+    )
+    return os.EX_OK
+
+
+def _backfill_event_partitions(args: argparse.Namespace) -> int:
+    partitions = GOBStorageHandler().backfill_event_partitions()
+    print(f"{partitions} event partitions registered")
+    return os.EX_OK
+
+
+def _archive_events(args: argparse.Namespace) -> int:
+    collections = list(
+        GOBStorageHandler().get_source_catalogue_entity_combinations(args.catalogue, args.collection)
+    )
+    results = [
+        EventArchiver(GOBStorageHandler(collection), args.directory).archive(args.cutoff, args.vacuum_full)
+        for collection in collections
+    ]
+    archived = [result for result in results if result]
+    print(
+        f"{sum(result.events for result in archived):,} events of {len(archived)} collections archived, "
+        f"reclaimed {sum(result.reclaimed for result in archived) / 2 ** 20:,.1f} MB"
+    )
+    return os.EX_OK
+
+
+def _rebuild_table(args: argparse.Namespace) -> int:
+    collections = list(
+        GOBStorageHandler().get_source_catalogue_entity_combinations(args.catalogue, args.collection)
+    )
+    if not collections:
+        print(f"No events for {args.catalogue} {args.collection}")
+        return os.EX_DATAERR
+
+    rebuilder = TableRebuilder(GOBStorageHandler(collections[0]), args.workers, args.snapshot_directory)
+    result = rebuilder.rebuild()
+    print(f"{result.events:,} events replayed in {result.duration:.0f}s, {result.events_per_second:,.0f} events/s")
+    return os.EX_OK
+
+
+def _verify_materialized_views(args: argparse.Namespace) -> int:
+    storage = GOBStorageHandler()
+    views = [view for view in MaterializedViews().get_all() if args.mv_name in (None, view.name)]
+    differ = 0
+
+    for view in views:
+        missing, surplus = view.verify(storage)
+        if missing or surplus:
+            differ += 1
+            print(f"{view.name}: {missing} rows missing, {surplus} rows surplus")
+
+            if args.repair:
+                view.repair(storage)
+
+    print(f"{differ} of {len(views)} materialized views differ")
+    return os.EX_OK if differ == 0 or args.repair else os.EX_DATAERR
+
+
+def _verify_event_watermarks(args: argparse.Namespace) -> int:
+    collections = GOBStorageHandler().get_event_watermark_collections()
+    consistent = [
+        GOBStorageHandler(collection).verify_event_watermarks(rebuild=args.rebuild) for collection in collections
+    ]
+    print(f"{consistent.count(False)} of {len(consistent)} event watermarks differ")
+    return os.EX_OK if all(consistent) or args.rebuild else os.EX_DATAERR
+
+
+# Faux handlers that are run directly, the other handlers are run by the standalone service
+FAUX_HANDLERS = {
+    "migrate": _migrate,
+    "backfill_event_partitions": _backfill_event_partitions,
+    "archive_events": _archive_events,
+    "rebuild_table": _rebuild_table,
+    "verify_materialized_views": _verify_materialized_views,
+    "verify_event_watermarks": _verify_event_watermarks,
+}
+
+
 def run_as_standalone(args: argparse.Namespace) -> int:
-    if args.handler == "migrate":
-        mviews = args.materialized_views
-        GOBStorageHandler().init_storage(
-            force_migrate=True,
-            recreate_materialized_views=[args.mv_name] if mviews and args.mv_name else mviews
-        )
-        return os.EX_OK
+    if handler := FAUX_HANDLERS.get(args.handler):
+        return handler(args)
 
     return standalone.run_as_standalone(args, SERVICEDEFINITION)
 
@@ -87,3 +87,13 @@ def _rename_relation(op, table_name: str, old_column: str, new_column: str,
         f"CREATE TABLE IF NOT EXISTS events.rel_{new_relation_name}_gob PARTITION OF events.rel_{new_relation_name} "
         f"FOR VALUES IN ('GOB')")
     op.execute(rename_events_query)
+
+    # Move the registration of the partition, if the partition registry exists at this revision
+    op.execute(
+        "DO $$ BEGIN IF to_regclass('event_partitions') IS NOT NULL THEN "
+        f"DELETE FROM event_partitions WHERE catalogue = 'rel' AND entity = '{old_relation_name}'; "
+        "INSERT INTO event_partitions (catalogue, entity, source, tablename) "
+        f"SELECT 'rel', '{new_relation_name}', 'GOB', 'rel_{new_relation_name}_gob' "
+        f"WHERE EXISTS (SELECT 1 FROM events.rel_{new_relation_name}_gob) ON CONFLICT DO NOTHING; "
+        "END IF; END $$"
+    )
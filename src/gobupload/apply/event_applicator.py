@@ -3,6 +3,9 @@ Event applicator
 
 Applies events to the respective entity in the current model
 
+The events are coalesced per entity: all events for an entity that are loaded before a flush are folded into
+one net change. A new entity is inserted once with its final values, an existing entity is updated once.
+
 """
 from __future__ import annotations
 
@@ -23,7 +26,8 @@ class EventApplicator:
         self.storage = storage
         self.stats = stats
 
-        self.inserts: list[GOB.ADD] = []
+        # events for new entities, each list starts with the initial ADD event
+        self.inserts: dict[str, list[Union[GOB.ADD, GOB.MODIFY, GOB.DELETE]]] = defaultdict(list)
         self.updates: dict[str, list[Union[GOB.ADD, GOB.MODIFY, GOB.DELETE]]] = defaultdict(list)
         self.updates_total = 0
 
@@ -37,9 +41,9 @@ class EventApplicator:
         if self.inserts or self.updates:
             raise GOBException("Have unapplied events. Call apply_all() before leaving context")
 
-    def _add_insert(self, gob_event: GOB.ADD):
-        """Adds ADD event to buffer."""
-        self.inserts.append(gob_event)
+    def _add_insert(self, gob_event: GOB.ADD | GOB.MODIFY | GOB.DELETE):
+        """Adds the initial ADD event or a later event for a new entity to buffer."""
+        self.inserts[gob_event.tid].append(gob_event)
 
     def _add_update(self, gob_event: GOB.ADD | GOB.MODIFY | GOB.DELETE):
         """Add a non-ADD event or an ADD event on a deleted entity."""
@@ -79,10 +83,8 @@ class EventApplicator:
             self.updates.clear()
             self.updates_total = 0
 
-    def _update_entity(self, entity: "GOBStorageHandler.DbEntity"):
-        tid = getattr(entity, FIELD.TID)
-        events = self.updates[tid]
-
+    def _apply_to_entity(self, entity: "GOBStorageHandler.DbEntity", events: list[ImportEvent]):
+        """Apply `events` to `entity` in order, the entity ends with the values of the last event."""
         for event in events:
             self._validate_update_event(event, getattr(entity, FIELD.DATE_DELETED))
 
@@ -92,12 +94,28 @@ class EventApplicator:
         if events:
             setattr(entity, FIELD.LAST_EVENT, events[-1].id)
 
+    def _update_entity(self, entity: "GOBStorageHandler.DbEntity"):
+        self._apply_to_entity(entity, self.updates[getattr(entity, FIELD.TID)])
+
+    def _coalesce_insert(self, events: list[ImportEvent]) -> dict:
+        """Fold the events of a new entity into the column values of a single insert."""
+        add_event, *other_events = events
+
+        # make sure _tid is filled from events.tid, not always present in event.contents
+        # the entity is not added to the session, it only holds the net values
+        entity = self.storage.DbEntity(
+            **add_event.get_attribute_dict() | {FIELD.LAST_EVENT: add_event.id, FIELD.TID: add_event.tid}
+        )
+        self.stats.add_applied(GOB.ADD.name, 1)
+        self._apply_to_entity(entity, other_events)
+
+        columns = self.storage.DbEntity.__table__.columns.keys()
+        return {key: value for key, value in vars(entity).items() if key in columns}
+
     def _flush_inserts(self):
-        """Generate database inserts from ADD events and clear buffer."""
+        """Generate a database insert per new entity and clear buffer."""
         if self.inserts:
-            self.storage.add_add_events(self.inserts)
-
-            self.stats.add_applied(GOB.ADD.name, len(self.inserts))
+            self.storage.add_entities([self._coalesce_insert(events) for events in self.inserts.values()])
             self.inserts.clear()
 
     def flush(self):
@@ -111,16 +129,17 @@ class EventApplicator:
         gob_event = database_to_gobevent(event)
         tid = gob_event.tid
 
-        if isinstance(gob_event, GOB.ADD) and tid not in self.last_events and tid not in self.add_event_tids:
+        if tid in self.inserts:
+            # The entity is added in this batch, fold the event into its insert
+            self._add_insert(gob_event)
+
+        elif isinstance(gob_event, GOB.ADD) and tid not in self.last_events and tid not in self.add_event_tids:
             # Initial add (an ADD event can also be applied on a deleted entity, this is handled by the else case)
             self._add_insert(gob_event)
 
-            # Store the tid to make sure a second ADD events get's handled as an ADD on deleted entity
+            # Store the tid to make sure an ADD event in a later batch gets handled as an ADD on deleted entity
             self.add_event_tids.add(tid)
 
         else:
-            # If ADD events are waiting to be applied to the database, flush those first to make sure they exist
-            self._flush_inserts()
-
             # Add other event (MODIFY, DELETE, ADD on deleted entity)
             self._add_update(gob_event)
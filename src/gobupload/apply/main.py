@@ -1,6 +1,9 @@
+import contextlib
+import functools
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Sequence
+from typing import Iterator, Sequence
 
 from sqlalchemy.engine import Row
 
@@ -11,16 +14,24 @@ from gobcore.message_broker.notifications import EventNotification, add_notifica
 from gobcore.message_broker.offline_contents import ContentsReader
 from gobcore.utils import ProgressTicker
 
-from gobupload.config import FULL_UPLOAD
+from gobupload import gob_model
+from gobupload.config import (
+    APPLY_SQL, APPLY_WORKERS, APPLY_TID_WORKERS, APPLY_DEFER_INDEXES_FRACTION,
+    APPLY_INDEX_WORKERS, APPLY_DEFER_FOREIGN_KEYS_FRACTION
+)
 from gobupload.storage.handler import GOBStorageHandler
+from gobupload.storage.event_reader import EventReader
+from gobupload.storage.instrumentation import instrumented, in_context, step
+from gobupload.storage.materialized_views import MaterializedViews
 from gobupload.apply.event_applicator import EventApplicator
+from gobupload.apply.maintenance import maintenance_scheduler
+from gobupload.apply.sharded_applicator import ShardedEventApplicator
+from gobupload.apply.sql_applicator import SQLEventApplicator
 from gobupload.update.update_statistics import UpdateStatistics
 from gobupload.utils import get_event_ids, is_corrupted
 
-# Trigger VACUUM ANALYZE on database if more than ANALYZE_THRESHOLD of entities are updated. When ANALYZE_THRESHOLD =
-# 0.3, this means that if more than 30% of the events update the data (MODIFY's, ADDs, DELETEs), a VACUUM ANALYZE is
-# triggered.
-ANALYZE_THRESHOLD = 0.3
+# Number of events that are applied in one transaction
+CHUNK_SIZE = 10_000
 
 
 def apply_events(storage: GOBStorageHandler, last_events: set[str], start_after: int, stats: UpdateStatistics):
@@ -32,39 +43,94 @@ def apply_events(storage: GOBStorageHandler, last_events: set[str], start_after:
     :param stats: update statitics for this action
     :return:
     """
-    CHUNK_SIZE = 10_000
+    if APPLY_SQL and SQLEventApplicator.supports(storage):
+        return apply_events_sql(storage, start_after, stats)
+
+    if APPLY_TID_WORKERS > 1 and ShardedEventApplicator.supports(storage, APPLY_TID_WORKERS):
+        return apply_events_sharded(storage, last_events, start_after, stats)
 
     with (
         ProgressTicker("Apply events", CHUNK_SIZE) as progress,
         EventApplicator(storage, last_events, stats) as event_applicator,
+        EventReader(storage, start_after, CHUNK_SIZE, prefetch=True) as event_reader
     ):
-        while chunk := storage.get_events_starting_after(start_after, CHUNK_SIZE):
+        # the next chunk is read while the current chunk is being applied
+        for chunk in event_reader:
             with storage.get_session():
                 for event in chunk:
                     progress.tick()
                     event_applicator.load(event)
 
                 event_applicator.flush()
-                start_after = event.eventid
+                storage.advance_applied_eventid(chunk[-1].eventid)
 
 
-def _apply_confirms(storage: GOBStorageHandler, confirms: Path, timestamp: str, stats: UpdateStatistics):
+def apply_events_sql(storage: GOBStorageHandler, start_after: int, stats: UpdateStatistics):
+    """Apply any unhandled events to the database with set-based SQL statements
+
+    :param storage: GOB (events + entities)
+    :param start_after: the id of the last event that has been applied to the storage
+    :param stats: update statistics for this action
+    :return:
+    """
+    sql_applicator = SQLEventApplicator(storage, stats)
+
+    with ProgressTicker("Apply events", CHUNK_SIZE) as progress:
+        while True:
+            with storage.get_session():
+                count, start_after = sql_applicator.apply_page(start_after, CHUNK_SIZE)
+
+                if count:
+                    storage.advance_applied_eventid(start_after)
+
+            if not count:
+                break
+
+            progress.ticks(count)
+
+
+def apply_events_sharded(storage: GOBStorageHandler, last_events: set[str], start_after: int, stats: UpdateStatistics):
+    """Apply any unhandled events to the database by APPLY_TID_WORKERS workers, sharded by tid
+
+    :param storage: GOB (events + entities)
+    :param last_events: all entities with events applied
+    :param start_after: the id of the last event that has been applied to the storage
+    :param stats: update statistics for this action
+    :return:
+    """
     with (
-        storage.get_session(),
-        ProgressTicker("Apply CONFIRM events", 50_000) as progress
+        ProgressTicker("Apply events", CHUNK_SIZE) as progress,
+        ShardedEventApplicator(storage, last_events, stats, APPLY_TID_WORKERS) as sharded_applicator,
+        EventReader(storage, start_after, CHUNK_SIZE, prefetch=True) as event_reader
     ):
-        for event in ContentsReader(confirms).items():
-            if event["event"] not in (CONFIRM.name, BULKCONFIRM.name):
-                raise GOBException(f"Expected 'CONFIRM' or 'BULKCONFIRM' got: {event['event']}")
+        for chunk in event_reader:
+            sharded_applicator.apply_page(chunk)
+            progress.ticks(len(chunk))
+
+
+def _read_confirms(confirms: Path, progress: ProgressTicker, stats: UpdateStatistics) -> Iterator[str]:
+    """Yields the tids of all (BULK)CONFIRM events in the confirms file."""
+    for event in ContentsReader(confirms).items():
+        if event["event"] not in (CONFIRM.name, BULKCONFIRM.name):
+            raise GOBException(f"Expected 'CONFIRM' or 'BULKCONFIRM' got: {event['event']}")
+
+        # get confirm data: BULKCONFIRM => data.confirms, CONFIRM => [data]
+        confirm_data = event["data"].get("confirms", [event["data"]])
+        confirm_len = len(confirm_data)
+
+        progress.ticks(confirm_len)
+        stats.add_applied(CONFIRM.name, confirm_len)
 
-            # get confirm data: BULKCONFIRM => data.confirms, CONFIRM => [data]
-            confirm_data = event["data"].get("confirms", [event["data"]])
-            confirm_len = len(confirm_data)
+        yield from (record["_tid"] for record in confirm_data)
 
-            progress.ticks(confirm_len)
 
-            storage.apply_confirms(confirm_data, timestamp=timestamp)
-            stats.add_applied(CONFIRM.name, confirm_len)
+def _apply_confirms(storage: GOBStorageHandler, confirms: Path, timestamp: str, stats: UpdateStatistics):
+    # all confirms are staged in one stream and applied in a single update
+    with (
+        storage.get_session(),
+        ProgressTicker("Apply CONFIRM events", 50_000) as progress
+    ):
+        storage.apply_confirms_staged(_read_confirms(confirms, progress, stats), timestamp=timestamp)
 
 
 def apply_confirm_events(storage: GOBStorageHandler, stats: UpdateStatistics, msg: dict):
@@ -74,11 +140,21 @@ def apply_confirm_events(storage: GOBStorageHandler, stats: UpdateStatistics, ms
     (BULK)CONFIRM events can be passed in a file.
     The name of the file is mag['confirms'].
 
+    An upload that is identical to the last applied upload confirms all entities.
+    The number of entities is msg['confirm_all'].
+
     :param storage:
     :param stats:
     :param msg:
     :return:
     """
+    if confirm_all := msg.pop("confirm_all", None):
+        with storage.get_session():
+            storage.apply_confirm_all(msg["header"]["timestamp"])
+
+        stats.add_applied(CONFIRM.name, confirm_all)
+        return
+
     if not msg.get("confirms"):
         return
 
@@ -92,10 +168,80 @@ def apply_confirm_events(storage: GOBStorageHandler, stats: UpdateStatistics, ms
         del msg["confirms"]
 
 
-def _should_analyze(stats):
-    applied_stats = stats.get_applied_stats()
-    return (1 - applied_stats.get('CONFIRM', {}).get('relative', 0)) > ANALYZE_THRESHOLD and \
-        sum([value['absolute'] for value in applied_stats.values()]) > 0
+def save_upload_fingerprint(storage: GOBStorageHandler, msg: dict):
+    """
+    Save the fingerprint of the applied upload (if present)
+
+    The comparison of the next upload is skipped if it has the same fingerprint.
+
+    :param storage:
+    :param msg:
+    :return:
+    """
+    if fingerprint := msg.pop("fingerprint", None):
+        storage.save_upload_fingerprint(msg["header"]["application"], fingerprint)
+
+
+def _is_bulk_apply(storage: GOBStorageHandler, start_after: int, fraction: float) -> bool:
+    """Tells if the number of events after `start_after` is larger than `fraction` of the number of entities."""
+    if fraction <= 0:
+        return False
+
+    events = storage.count_events_after(start_after)
+    entities = storage.get_table_size_estimate()
+
+    if events > fraction * entities:
+        logger.info(f"Apply {events:,} events on {entities:,} entities")
+        return True
+
+    return False
+
+
+def _index_maintenance(storage: GOBStorageHandler, start_after: int) -> contextlib.AbstractContextManager:
+    """
+    Returns the context to apply the events after `start_after` in
+
+    When the number of events is large compared to the number of entities the indexes are dropped
+    and rebuilt after the events have been applied, instead of being maintained for every row.
+
+    :param storage:
+    :param start_after:
+    :return:
+    """
+    if _is_bulk_apply(storage, start_after, APPLY_DEFER_INDEXES_FRACTION):
+        logger.info("Apply events with deferred indexes")
+        return storage.deferred_indexes(APPLY_INDEX_WORKERS)
+
+    return contextlib.nullcontext()
+
+
+def _foreign_key_maintenance(storage: GOBStorageHandler, start_after: int) -> contextlib.AbstractContextManager:
+    """
+    Returns the context to apply the relation events after `start_after` in
+
+    When the number of events is large compared to the number of relations the foreign keys are dropped
+    and validated once after the events have been applied, instead of being checked for every row.
+
+    :param storage:
+    :param start_after:
+    :return:
+    """
+    if storage.metadata.catalogue == "rel" and \
+            _is_bulk_apply(storage, start_after, APPLY_DEFER_FOREIGN_KEYS_FRACTION):
+        logger.info("Apply events with deferred foreign keys")
+        return storage.deferred_foreign_keys()
+
+    return contextlib.nullcontext()
+
+
+def _apply_materialized_view(storage: GOBStorageHandler, relation_name: str):
+    """Apply the changes of a relation to its mv_ table, if it is maintained incrementally."""
+    view = MaterializedViews().get_by_relation_name(relation_name)
+
+    # in lazy mode a missing table is created on the first refresh
+    if view.incremental and (not view.lazy or view.exists(storage)):
+        changes = view.apply_changes(storage)
+        logger.info(f"Applied {changes:,} changes to {view.name}")
 
 
 def _get_source_catalog_entity_combinations(msg) -> Sequence[Row]:
@@ -112,50 +258,104 @@ def _get_source_catalog_entity_combinations(msg) -> Sequence[Row]:
     return storage.get_source_catalogue_entity_combinations(catalogue, entity, source=header.get("source"))
 
 
-def apply(msg):
-    mode = msg['header'].get('mode', FULL_UPLOAD)
-
-    logger.info("Apply events")
+def _apply_combination(result: Row, msg: dict) -> tuple[UpdateStatistics, int, int]:
+    """Apply the unhandled events and confirms for a source / catalogue / entity combination
 
-    # Gather statistics of update process
-    stats = UpdateStatistics()
-    before = None
-    after = None
+    :param result: the source / catalogue / entity combination
+    :param msg: the apply message
+    :return: statistics, highest entity eventid before and after application
+    """
+    model = f"{result.source} {result.catalogue} {result.entity}"
 
-    for result in _get_source_catalog_entity_combinations(msg):
-        model = f"{result.source} {result.catalogue} {result.entity}"
+    logger.info(f"Apply events {model}")
 
-        logger.info(f"Apply events {model}")
+    with step(model):
         storage = GOBStorageHandler(result)
+        stats = UpdateStatistics()
+
+        # Finish any two-phase transactions of an interrupted sharded apply first
+        storage.recover_prepared_transactions()
 
         # Track eventId before event application
         entity_max_eventid, last_eventid = get_event_ids(storage)
-        before = min(entity_max_eventid or 0, before or sys.maxsize)
+        before = entity_max_eventid
 
         if is_corrupted(entity_max_eventid, last_eventid):
             logger.error(f"Model {model} is inconsistent! data is more recent than events")
         elif entity_max_eventid == last_eventid:
             logger.info(f"Model {model} is up to date")
             apply_confirm_events(storage, stats, msg)
+            save_upload_fingerprint(storage, msg)
         else:
             logger.info(f"Start application of unhandled {model} events")
             last_events = set(storage.get_current_ids(exclude_deleted=False))
 
-            apply_events(storage, last_events, entity_max_eventid, stats)
+            with (
+                _foreign_key_maintenance(storage, entity_max_eventid),
+                _index_maintenance(storage, entity_max_eventid)
+            ):
+                apply_events(storage, last_events, entity_max_eventid, stats)
+
             apply_confirm_events(storage, stats, msg)
+            save_upload_fingerprint(storage, msg)
+
+        if result.catalogue == "rel":
+            _apply_materialized_view(storage, result.entity)
 
         # Track eventId after event application
         entity_max_eventid, last_eventid = get_event_ids(storage)
-        after = max(entity_max_eventid or 0, after or 0)
+        after = entity_max_eventid
+
+    # Build result message
+    results = stats.results()
+    maintenance_scheduler.schedule(storage)
+
+    stats.log()
+    logger.info(f"Apply events {model} completed", {'data': results})
+
+    return stats, before, after
+
+
+def _apply_combinations(msg: dict) -> Iterator[tuple[UpdateStatistics, int, int]]:
+    """Apply all source / catalogue / entity combinations for the message, in order of the combinations
+
+    Independent combinations are applied concurrently by APPLY_WORKERS workers, each with its own storage handler.
+    Confirms and fingerprints belong to a single combination, messages with these are always applied serially.
+    """
+    combinations = _get_source_catalog_entity_combinations(msg)
+    apply_combination = functools.partial(_apply_combination, msg=msg)
+
+    if APPLY_WORKERS <= 1 or msg.get("confirms") or msg.get("confirm_all") or msg.get("fingerprint"):
+        yield from map(apply_combination, combinations)
+        return
+
+    combinations = list(combinations)
+    if len(combinations) <= 1:
+        yield from map(apply_combination, combinations)
+        return
+
+    # Reflect all entity tables at once, the workers should not reflect the (shared) metadata
+    tables = [gob_model.get_table_name(result.catalogue, result.entity) for result in combinations]
+    GOBStorageHandler(only=[GOBStorageHandler.EVENTS_TABLE, *tables])
+
+    with ThreadPoolExecutor(max_workers=APPLY_WORKERS, thread_name_prefix="apply") as executor:
+        yield from executor.map(in_context(apply_combination), combinations)
+
+
+@instrumented("apply")
+def apply(msg):
+    logger.info("Apply events")
+
+    # Gather statistics of update process
+    stats = UpdateStatistics()
+    before = None
+    after = None
 
-        # Build result message
-        results = stats.results()
-        if mode == FULL_UPLOAD and _should_analyze(stats):
-            logger.info("Running VACUUM ANALYZE on table")
-            storage.analyze_table()
+    for combination_stats, combination_before, combination_after in _apply_combinations(msg):
+        stats.merge(combination_stats)
 
-        stats.log()
-        logger.info(f"Apply events {model} completed", {'data': results})
+        before = min(combination_before or 0, before or sys.maxsize)
+        after = max(combination_after or 0, after or 0)
 
     msg['summary'] = logger.get_summary()
 
@@ -0,0 +1,95 @@
+"""
+Table maintenance
+
+After events have been applied the table statistics (pg_stat_user_tables) tell what maintenance the table needs:
+
+- VACUUM ANALYZE when the number of dead rows is larger than MAINTENANCE_VACUUM_FRACTION of the live rows
+  (eg after many MODIFY events or after the confirms of a full upload)
+- ANALYZE when the number of rows modified since the last analyze is larger than MAINTENANCE_ANALYZE_FRACTION
+  of the live rows
+- nothing otherwise
+
+The maintenance is not part of the apply job, it runs in the background by at most MAINTENANCE_WORKERS tables
+at the same time. A table is scheduled at most once until its maintenance has started.
+With MAINTENANCE_WORKERS = 0 the maintenance runs in the apply job.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from gobcore.logging.logger import logger
+
+from gobupload.config import MAINTENANCE_WORKERS, MAINTENANCE_VACUUM_FRACTION, MAINTENANCE_ANALYZE_FRACTION
+from gobupload.storage.handler import GOBStorageHandler
+
+VACUUM = "VACUUM ANALYZE"
+ANALYZE = "ANALYZE"
+
+# Tables with less changed rows are left to autovacuum
+MIN_ROWS = 1_000
+
+
+def get_maintenance(storage: GOBStorageHandler) -> str | None:
+    """Returns the maintenance that the table of `storage` needs, VACUUM, ANALYZE or None."""
+    statistics = storage.get_table_statistics()
+
+    if statistics is None:
+        return None
+
+    live = statistics.n_live_tup
+
+    if statistics.n_dead_tup > max(MIN_ROWS, MAINTENANCE_VACUUM_FRACTION * live):
+        return VACUUM
+
+    if statistics.n_mod_since_analyze > max(MIN_ROWS, MAINTENANCE_ANALYZE_FRACTION * live):
+        return ANALYZE
+
+    return None
+
+
+class MaintenanceScheduler:
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="maintenance") if workers else None
+
+        self._lock = threading.Lock()
+        self._scheduled: set[str] = set()
+
+    def _run(self, storage: GOBStorageHandler, maintenance: str):
+        with self._lock:
+            self._scheduled.discard(storage.tablename)
+
+        try:
+            storage.analyze_table(vacuum=maintenance == VACUUM)
+        except Exception as e:
+            # the apply job has finished, report on the process log
+            logging.getLogger(__name__).error(f"{maintenance} {storage.tablename} failed: {e}")
+
+    def schedule(self, storage: GOBStorageHandler) -> Future | None:
+        """Schedules the maintenance that the table of `storage` needs, if any.
+
+        :param storage: the storage handler of the table, it is not used by the caller afterwards
+        :return: the future of the scheduled maintenance, None if not scheduled
+        """
+        if (maintenance := get_maintenance(storage)) is None:
+            return None
+
+        if self.executor is None:
+            logger.info(f"Running {maintenance} on table")
+            storage.analyze_table(vacuum=maintenance == VACUUM)
+            return None
+
+        with self._lock:
+            if storage.tablename in self._scheduled:
+                return None
+            self._scheduled.add(storage.tablename)
+
+        logger.info(f"Scheduled {maintenance} on table")
+        return self.executor.submit(self._run, storage, maintenance)
+
+
+# Shared by all apply jobs in this process
+maintenance_scheduler = MaintenanceScheduler(MAINTENANCE_WORKERS)
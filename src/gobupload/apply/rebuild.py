@@ -0,0 +1,285 @@
+"""
+Table rebuild
+
+Rebuilds the table of a collection from the event log, eg when the table is corrupted (see utils.is_corrupted).
+
+The events are replayed into a shadow table, the collection table remains available while rebuilding:
+
+- the shadow table is created UNLOGGED with the columns of the table, the unique constraints and the tid indexes
+- for every source the last archived snapshot is loaded, if events have been archived (see storage/archive.py)
+- the events (after the snapshot) are applied with set-based SQL (SQLEventApplicator), by `workers` workers that
+  each apply the events of a shard of the tids
+- the _gobids of the existing entities are kept, the table is made LOGGED and the other indexes are built
+- the shadow table is swapped in, in a single transaction
+
+The swap drops the collection table with its dependent objects. Foreign keys that reference the table are added
+again as NOT VALID and validated afterwards, dropped materialized views are created again. Indexes that are not
+managed by GOB (see GOBStorageHandler.get_managed_indexes) are created again by the next init_storage.
+The event watermarks are reset to the rebuilt table, events that have been applied to the collection table while
+rebuilding are applied again by the next apply.
+
+Only collections that are supported by SQLEventApplicator can be rebuilt.
+"""
+from __future__ import annotations
+
+import gzip
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+from sqlalchemy import text, exc as sa_exc
+from sqlalchemy.engine import Row
+
+from gobcore.exceptions import GOBException
+from gobcore.logging.logger import logger
+from gobcore.model import FIELD
+
+from gobupload.apply.sql_applicator import SQLEventApplicator
+from gobupload.storage.handler import GOBStorageHandler
+from gobupload.storage.materialized_views import MaterializedViews
+from gobupload.update.update_statistics import UpdateStatistics
+
+# Number of events per shard that are applied in one transaction
+CHUNK_SIZE = 10_000
+
+
+@dataclass
+class RebuildResult:
+    events: int
+    entities: int
+    duration: float
+
+    @property
+    def events_per_second(self) -> float:
+        return self.events / self.duration if self.duration else 0.0
+
+
+class TableRebuilder:
+
+    def __init__(self, storage: GOBStorageHandler, workers: int = 1, snapshot_directory: Path | str | None = None):
+        """
+        :param storage: the storage handler of the collection (any source)
+        :param workers: the number of tid shards that are applied concurrently
+        :param snapshot_directory: the directory with the archived snapshots (see storage/archive.py)
+        """
+        self.storage = storage
+        self.workers = max(workers, 1)
+        self.snapshot_directory = Path(snapshot_directory) if snapshot_directory else None
+
+        self.tablename = storage.tablename
+        self.shadow = f"rebuild_{zlib.crc32(self.tablename.encode()):08x}"
+
+        self.sources = list(storage.get_source_catalogue_entity_combinations(
+            storage.metadata.catalogue, storage.metadata.entity
+        ))
+
+    def _execute(self, *statements: str):
+        with self.storage.engine.begin() as connection:
+            for statement in statements:
+                connection.execute(text(statement))
+
+    def _get_constraints(self) -> dict[str, str]:
+        """Returns the definitions of the primary key and unique constraints of the table by name."""
+        query = f"""
+SELECT conname, pg_get_constraintdef(oid)
+FROM pg_catalog.pg_constraint
+WHERE contype IN ('p', 'u') AND conrelid = '"{self.tablename}"'::regclass
+ORDER BY conname
+"""
+        with self.storage.engine.connect() as connection:
+            return dict(connection.execute(text(query)).all())
+
+    def _get_referencing_foreign_keys(self) -> list[Row]:
+        """Returns the foreign keys of other tables that reference the table."""
+        query = f"""
+SELECT conrelid::regclass::text AS tablename, conname AS name, pg_get_constraintdef(oid) AS definition
+FROM pg_catalog.pg_constraint
+WHERE contype = 'f' AND confrelid = '"{self.tablename}"'::regclass AND conrelid <> confrelid
+"""
+        with self.storage.engine.connect() as connection:
+            return connection.execute(text(query)).all()
+
+    def _temporary_name(self, name: str) -> str:
+        return f"{self.shadow}_{zlib.crc32(name.encode()):08x}"
+
+    def _create_shadow(self, constraints: dict[str, str], tid_indexes: dict[str, dict]):
+        self._execute(
+            f"DROP TABLE IF EXISTS {self.shadow}",
+            f'CREATE UNLOGGED TABLE {self.shadow} (LIKE "{self.tablename}" INCLUDING DEFAULTS)',
+            *(
+                f'ALTER TABLE {self.shadow} ADD CONSTRAINT "{self._temporary_name(name)}" {definition}'
+                for name, definition in constraints.items()
+            ),
+            *(
+                self.storage._create_index_statement(
+                    self._temporary_name(name), definition | {"table_name": self.shadow}
+                )
+                for name, definition in tid_indexes.items()
+            )
+        )
+
+    def _load_snapshot(self, storage: GOBStorageHandler) -> int:
+        """Loads the last archived snapshot of the source into the shadow table, if any.
+
+        :return: the eventid of the snapshot, 0 if the events have not been archived
+        """
+        if (archive := storage.get_last_event_archive()) is None:
+            return 0
+
+        if self.snapshot_directory is None:
+            raise GOBException(
+                f"Events of {self.tablename} {storage.metadata.source} have been archived up to "
+                f"{archive.archived_eventid}, the snapshot directory is required"
+            )
+
+        path = self.snapshot_directory / archive.snapshot_file
+
+        with gzip.open(path, "rt") as file:
+            columns = file.readline().strip()
+
+        with self.storage.engine.begin() as connection, gzip.open(path, "rb") as file:
+            with connection.connection.cursor() as cur:
+                cur.copy_expert(f"COPY {self.shadow} ({columns}) FROM STDIN WITH (FORMAT csv, HEADER)", file)
+
+        logger.info(f"Loaded snapshot {archive.snapshot_file} of {storage.metadata.source}")
+        return archive.snapshot_eventid
+
+    def _replay_shard(self, storage: GOBStorageHandler, shard: int, start_after: int) -> UpdateStatistics:
+        stats = UpdateStatistics()
+        sql_applicator = SQLEventApplicator(storage, stats, self.shadow, shard, self.workers)
+
+        while True:
+            with storage.get_session():
+                count, start_after = sql_applicator.apply_page(start_after, CHUNK_SIZE)
+
+            if not count:
+                return stats
+
+    def _replay(self, source: Row) -> UpdateStatistics:
+        """Replays the events of a source into the shadow table, sharded by tid."""
+        # Handlers are created in the main thread, the workers should not reflect the (shared) metadata
+        handlers = [GOBStorageHandler(source) for _ in range(self.workers)]
+        start_after = self._load_snapshot(handlers[0])
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="rebuild") as executor:
+            futures = [
+                executor.submit(self._replay_shard, handler, shard, start_after)
+                for shard, handler in enumerate(handlers)
+            ]
+
+        stats = UpdateStatistics()
+        for future in futures:
+            # raises the first exception, if any
+            stats.merge(future.result())
+        return stats
+
+    def _keep_gobids(self):
+        """Give the rebuilt entities the _gobid they have in the table."""
+        self._execute(f"""
+UPDATE {self.shadow} AS shadow
+SET {FIELD.GOBID} = entity.{FIELD.GOBID}
+FROM "{self.tablename}" AS entity
+WHERE shadow.{FIELD.TID} = entity.{FIELD.TID} AND shadow.{FIELD.GOBID} <> entity.{FIELD.GOBID}
+""")
+
+    def _swap(self, constraints: dict[str, str], indexes: dict[str, dict], referencing: list[Row]):
+        sequence = f"pg_get_serial_sequence('\"{self.tablename}\"', '{FIELD.GOBID}')"
+
+        self._execute(
+            f'LOCK TABLE "{self.tablename}" IN ACCESS EXCLUSIVE MODE',
+            # the _gobid sequence is owned by the table, keep it
+            f"DO $$ BEGIN IF {sequence} IS NOT NULL THEN "
+            f"EXECUTE format('ALTER SEQUENCE %s OWNED BY {self.shadow}.{FIELD.GOBID}', {sequence}); "
+            f"END IF; END $$",
+            f'DROP TABLE "{self.tablename}" CASCADE',
+            f'ALTER TABLE {self.shadow} RENAME TO "{self.tablename}"',
+            *(
+                f'ALTER TABLE "{self.tablename}" RENAME CONSTRAINT "{self._temporary_name(name)}" TO "{name}"'
+                for name in constraints
+            ),
+            *(
+                f'ALTER INDEX "{self._temporary_name(name)}" RENAME TO "{name}"'
+                for name in indexes
+            ),
+            *(
+                f'ALTER TABLE {fk.tablename} ADD CONSTRAINT "{fk.name}" {fk.definition.removesuffix(" NOT VALID")} '
+                f'NOT VALID'
+                for fk in referencing
+            )
+        )
+
+    def _validate_referencing(self, referencing: list[Row]):
+        for fk in referencing:
+            try:
+                self._execute(f'ALTER TABLE {fk.tablename} VALIDATE CONSTRAINT "{fk.name}"')
+            except sa_exc.IntegrityError as e:
+                logger.warning(f"Foreign key {fk.name} on {fk.tablename} is violated, it remains NOT VALID: {e.orig}")
+
+    def rebuild(self) -> RebuildResult:
+        """Rebuild the table from the event log and swap it in.
+
+        :return: the number of replayed events, rebuilt entities and the duration in seconds
+        """
+        if not SQLEventApplicator.supports(self.storage):
+            raise GOBException(f"{self.tablename} can not be rebuilt with SQL, it has fields that are not supported")
+
+        start = time.perf_counter()
+
+        indexes = self.storage.get_managed_indexes()
+        tid_indexes = {
+            name: definition for name, definition in indexes.items() if definition["columns"][0] == FIELD.TID
+        }
+        other_indexes = {name: definition for name, definition in indexes.items() if name not in tid_indexes}
+        constraints = self._get_constraints()
+        foreign_keys = self.storage.get_foreign_keys()
+        referencing = self._get_referencing_foreign_keys()
+
+        logger.info(f"Rebuild {self.tablename} from the events of {len(self.sources)} sources in {self.shadow}")
+        self._create_shadow(constraints, tid_indexes)
+
+        stats = UpdateStatistics()
+        for source in self.sources:
+            stats.merge(self._replay(source))
+
+        events = sum(stats.applied.values())
+        replayed = time.perf_counter() - start
+        logger.info(f"Replayed {events:,} events in {replayed:.0f}s, {events / max(replayed, 1e-3):,.0f} events/s")
+
+        self._keep_gobids()
+        self._execute(
+            f"ALTER TABLE {self.shadow} SET LOGGED",
+            # foreign key names are unique per table, the names are kept
+            *(
+                f'ALTER TABLE {self.shadow} ADD CONSTRAINT "{name}" {definition} NOT VALID'
+                for name, definition in foreign_keys.items()
+            )
+        )
+        self.storage.create_indexes({
+            self._temporary_name(name): definition | {"table_name": self.shadow}
+            for name, definition in other_indexes.items()
+        }, self.workers)
+        self._execute(f"ANALYZE {self.shadow}")
+
+        # the dependent materialized views are dropped, they are recreated on the next start if interrupted
+        self.storage.invalidate_storage_fingerprint()
+        self._swap(constraints, indexes, referencing)
+        logger.info(f"Swapped in the rebuilt table {self.tablename}")
+
+        self.storage.validate_foreign_keys(foreign_keys)
+        self._validate_referencing(referencing)
+        MaterializedViews().initialise(self.storage)
+
+        # events that have been applied to the old table while rebuilding are applied again
+        for source in self.sources:
+            GOBStorageHandler(source).rebuild_event_watermarks(reset=True)
+
+        entities = self.storage.get_query_value(f'SELECT COUNT(*) FROM "{self.tablename}"')
+        result = RebuildResult(events, entities, time.perf_counter() - start)
+
+        logger.info(
+            f"Rebuilt {self.tablename}, {result.entities:,} entities from {result.events:,} events "
+            f"in {result.duration:.0f}s, {result.events_per_second:,.0f} events/s"
+        )
+        return result
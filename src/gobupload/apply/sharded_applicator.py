@@ -0,0 +1,141 @@
+"""
+Sharded event applicator
+
+Applies the events of one collection concurrently. Each page of events is split into shards on the hash of the
+tid, all events of an entity are in the same shard and are applied in order by the same worker.
+
+The high-water mark of the collection (the highest entity _last_event) must only advance when all events in a
+page have been applied. The shards of a page are therefore applied in two-phase transactions:
+
+- every worker applies its shard and prepares its transaction
+- when all shards are prepared a commit decision for the page is stored
+- all prepared transactions are committed and the commit decision is removed
+
+If any shard fails all prepared transactions are rolled back. Prepared transactions that are left by an
+interrupted apply are finished by GOBStorageHandler.recover_prepared_transactions before the next apply.
+The transactions are identified by the collection, source, page and shard. The applicator holds the apply lock
+of the collection and source, the recovery waits for it and never finishes the transactions of a running apply.
+
+This requires the Postgres setting max_prepared_transactions to be at least the number of workers.
+"""
+from __future__ import annotations
+
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import ExitStack
+from typing import Sequence
+
+from sqlalchemy.engine import Row
+
+from gobcore.logging.logger import logger
+
+from gobupload.apply.event_applicator import EventApplicator
+from gobupload.storage.handler import GOBStorageHandler, PreparedTransaction
+from gobupload.update.update_statistics import UpdateStatistics
+
+
+class ShardWorker:
+    """Applies the events of a single shard, with its own storage handler, applicator and statistics."""
+
+    def __init__(self, storage: GOBStorageHandler, last_events: set[str], shard: int):
+        self.shard = shard
+        self.storage = GOBStorageHandler(storage.metadata)
+        self.stats = UpdateStatistics()
+        self.event_applicator = EventApplicator(self.storage, last_events, self.stats)
+
+    def apply(self, page: str, events: Sequence[Row]) -> PreparedTransaction:
+        """Applies `events` in a prepared transaction, the transaction is rolled back if an error occurs.
+
+        :param page: the id of the page the events belong to
+        :param events: the events of this shard in the page, ordered by eventid
+        :return: the prepared transaction
+        """
+        transaction = PreparedTransaction(self.storage.engine, self.storage.get_apply_xid(page, self.shard))
+
+        with self.storage.get_prepared_session(transaction):
+            for event in events:
+                self.event_applicator.load(event)
+
+            self.event_applicator.flush()
+
+        return transaction
+
+
+class ShardedEventApplicator:
+
+    def __init__(self, storage: GOBStorageHandler, last_events: set[str], stats: UpdateStatistics, workers: int):
+        self.storage = storage
+        self.stats = stats
+
+        # Handlers are created in the main thread, the workers should not reflect the (shared) metadata
+        self.workers = [ShardWorker(storage, last_events, shard) for shard in range(workers)]
+        self.executor: ThreadPoolExecutor | None = None
+        self._exit_stack = ExitStack()
+
+    @classmethod
+    def supports(cls, storage: GOBStorageHandler, workers: int) -> bool:
+        """Tells if the database allows `workers` concurrent prepared transactions."""
+        max_prepared = int(storage.get_query_value("SHOW max_prepared_transactions"))
+
+        if max_prepared < workers:
+            logger.warning(
+                f"Events are applied serially, max_prepared_transactions ({max_prepared}) "
+                f"should be at least the number of workers ({workers})"
+            )
+            return False
+
+        return True
+
+    def __enter__(self):
+        # the prepared transactions of this apply are not recovered while it runs
+        self._exit_stack.enter_context(self.storage.apply_lock())
+
+        self.executor = ThreadPoolExecutor(max_workers=len(self.workers), thread_name_prefix="apply_shard")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.executor.shutdown()
+        self.executor = None
+
+        self._exit_stack.close()
+
+        for worker in self.workers:
+            self.stats.merge(worker.stats)
+
+    def _shard(self, events: Sequence[Row]) -> dict[int, list[Row]]:
+        """Returns the events per shard, the order of the events is kept."""
+        shards = defaultdict(list)
+
+        for event in events:
+            shards[zlib.crc32(event.tid.encode()) % len(self.workers)].append(event)
+
+        return shards
+
+    def apply_page(self, events: Sequence[Row]):
+        """Applies a page of events, all shards are committed or none.
+
+        :param events: the events in the page, ordered by eventid
+        """
+        page = str(events[0].eventid)
+        futures = [
+            self.executor.submit(self.workers[shard].apply, page, shard_events)
+            for shard, shard_events in self._shard(events).items()
+        ]
+        wait(futures)
+
+        if errors := [future.exception() for future in futures if future.exception()]:
+            # Failed shards have been rolled back already, rollback the shards that have been prepared
+            for future in futures:
+                if future.exception() is None:
+                    future.result().rollback()
+
+            raise errors[0]
+
+        transactions = [future.result() for future in futures]
+
+        # From this point on the page is committed, also if the process is interrupted
+        self.storage.add_commit_decision(page, events[-1].eventid)
+        for transaction in transactions:
+            transaction.commit()
+        self.storage.delete_commit_decision(page)
@@ -0,0 +1,258 @@
+"""
+SQL event applicator
+
+Applies a page of events to the entities in the current model with set-based SQL statements.
+
+The events are not converted into GOB events and ORM entities. Instead the page is staged in a temporary
+table and applied per round, where round n contains the n-th event of every entity in the page:
+
+- ADD events for new entities are inserted
+- all other events (MODIFY, DELETE, CONFIRM and ADD on a deleted entity) update the entity with a JSON patch
+
+The validation rules are the same as in EventApplicator._validate_update_event.
+Collections with fields that can not be cast by the database (eg geometries) are applied by the EventApplicator.
+
+The events can also be applied to another table with the same columns (eg the shadow table of a rebuild) and be
+restricted to a shard of the tids, all events of an entity are in the same shard.
+"""
+from gobcore.events.import_events import ADD, MODIFY, DELETE, CONFIRM, modifications_key
+from gobcore.exceptions import GOBException
+from gobcore.model import FIELD
+
+from gobupload.storage.handler import GOBStorageHandler
+from gobupload.update.update_statistics import UpdateStatistics
+from gobupload.utils import random_string
+
+
+class SQLEventApplicator:
+
+    # GOB types of which the event values are cast correctly by jsonb_populate_record
+    SUPPORTED_TYPES = {
+        "GOB.String",
+        "GOB.Character",
+        "GOB.Integer",
+        "GOB.BigInteger",
+        "GOB.Decimal",
+        "GOB.Boolean",
+        "GOB.Date",
+        "GOB.DateTime",
+        "GOB.JSON",
+        "GOB.Reference",
+        "GOB.ManyReference",
+        "GOB.VeryManyReference",
+    }
+
+    # Entity state before an event is applied
+    ABSENT = "absent"
+    DELETED = "deleted"
+    CURRENT = "current"
+
+    def __init__(
+        self,
+        storage: GOBStorageHandler,
+        stats: UpdateStatistics,
+        tablename: str | None = None,
+        shard: int = 0,
+        shards: int = 1
+    ):
+        """
+        :param storage: the storage handler of the collection
+        :param stats: update statistics
+        :param tablename: the table to apply the events to, default the collection table
+        :param shard: the shard of the tids to apply the events of, 0 <= shard < shards
+        :param shards: the number of shards
+        """
+        self.storage = storage
+        self.stats = stats
+        self.tablename = tablename or storage.tablename
+        self.shard = shard
+        self.shards = shards
+
+        self.staged = f"tmp_apply_{random_string(8)}"
+
+        # _gobid is generated by the database
+        self.columns = [name for name in storage.DbEntity.__table__.columns.keys() if name != FIELD.GOBID]
+
+    @classmethod
+    def supports(cls, storage: GOBStorageHandler) -> bool:
+        """Tells if the events for the collection of `storage` can be applied with SQL statements."""
+        return all(field["type"] in cls.SUPPORTED_TYPES for field in storage._fields.values())
+
+    def _stage_query(self) -> str:
+        shard = "AND abs(hashtext(tid)::bigint) % :shards = :shard" if self.shards > 1 else ""
+
+        # The state of an entity before an event is derived from the applied events before it in the page:
+        # ADD makes the entity current and DELETE makes a current entity deleted, other events and events that
+        # are skipped because the entity is absent leave the state unchanged
+        return f"""
+CREATE TEMPORARY TABLE {self.staged} ON COMMIT DROP AS
+SELECT
+    page.eventid,
+    page.action,
+    page.tid,
+    page."timestamp",
+    page.source,
+    page.application,
+    page.contents,
+    page.round,
+    CASE
+        WHEN page.last_add IS NOT NULL AND page.last_delete > page.last_add THEN '{self.DELETED}'
+        WHEN page.last_add IS NOT NULL THEN '{self.CURRENT}'
+        WHEN entity.{FIELD.TID} IS NULL THEN '{self.ABSENT}'
+        WHEN entity.{FIELD.DATE_DELETED} IS NOT NULL OR page.last_delete IS NOT NULL THEN '{self.DELETED}'
+        ELSE '{self.CURRENT}'
+    END AS state
+FROM (
+    SELECT
+        events.*,
+        ROW_NUMBER() OVER (PARTITION BY tid ORDER BY eventid) AS round,
+        MAX(eventid) FILTER (WHERE action = '{ADD.name}') OVER earlier AS last_add,
+        MAX(eventid) FILTER (WHERE action = '{DELETE.name}') OVER earlier AS last_delete
+    FROM (
+        SELECT eventid, action, tid, "timestamp", source, application, contents
+        FROM {self.storage.EVENTS_TABLE}
+        WHERE
+            catalogue = :catalogue
+            AND entity = :entity
+            AND source = :source
+            AND eventid > :start_after
+            {shard}
+        ORDER BY eventid
+        LIMIT :limit
+    ) AS events
+    WINDOW earlier AS (PARTITION BY tid ORDER BY eventid ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING)
+) AS page
+LEFT JOIN {self.tablename} AS entity ON entity.{FIELD.TID} = page.tid
+"""
+
+    def _invalid_event_query(self) -> str:
+        # Only apply ADD on a new or deleted entity, only apply other events on a current entity
+        return f"""
+SELECT eventid, action, tid, contents->>'{FIELD.LAST_EVENT}' AS last_event
+FROM {self.staged}
+WHERE
+    (action = '{ADD.name}' AND state = '{self.CURRENT}')
+    OR (action <> '{ADD.name}' AND state = '{self.DELETED}')
+ORDER BY eventid
+LIMIT 1
+"""
+
+    @staticmethod
+    def _patch_expression() -> str:
+        """Returns the JSON expression with the entity values to set for each staged event."""
+        modifications = \
+            f"(SELECT jsonb_object_agg(mod->>'key', mod->'new_value') " \
+            f"FROM jsonb_array_elements(contents->'{modifications_key}') AS mod)"
+
+        return f"""(
+    CASE action
+        WHEN '{ADD.name}' THEN
+            jsonb_build_object('{FIELD.SOURCE}', source, '{FIELD.APPLICATION}', application)
+            || (contents->'entity')
+            || jsonb_build_object(
+                '{FIELD.TID}', tid, '{ADD.timestamp_field}', "timestamp", '{FIELD.DATE_DELETED}', NULL
+            )
+        WHEN '{MODIFY.name}' THEN
+            COALESCE({modifications}, '{{}}'::jsonb)
+            || jsonb_strip_nulls(jsonb_build_object('{FIELD.HASH}', contents->'{FIELD.HASH}'))
+            || jsonb_build_object('{MODIFY.timestamp_field}', "timestamp")
+        WHEN '{DELETE.name}' THEN
+            jsonb_build_object('{DELETE.timestamp_field}', "timestamp")
+        WHEN '{CONFIRM.name}' THEN
+            jsonb_build_object('{CONFIRM.timestamp_field}', "timestamp")
+    END
+    || jsonb_build_object('{FIELD.LAST_EVENT}', eventid)
+)"""
+
+    def _insert_query(self) -> str:
+        columns = ", ".join(f'"{name}"' for name in self.columns)
+        values = ", ".join(f'record."{name}"' for name in self.columns)
+
+        return f"""
+INSERT INTO {self.tablename} ({columns})
+SELECT {values}
+FROM {self.staged} AS staged
+CROSS JOIN LATERAL jsonb_populate_record(NULL::{self.tablename}, {self._patch_expression()}) AS record
+WHERE staged.round = :round AND staged.action = '{ADD.name}' AND staged.state = '{self.ABSENT}'
+ORDER BY staged.eventid
+"""
+
+    def _update_query(self) -> str:
+        columns = ", ".join(f'"{name}"' for name in self.columns)
+        values = ", ".join(f'record."{name}"' for name in self.columns)
+
+        # jsonb_populate_record keeps the current entity values for any column that is not in the patch
+        return f"""
+UPDATE {self.tablename} AS entity
+SET ({columns}) = (SELECT {values} FROM jsonb_populate_record(entity, patch.patch) AS record)
+FROM (
+    SELECT tid, {self._patch_expression()} AS patch
+    FROM {self.staged}
+    WHERE round = :round AND state <> '{self.ABSENT}'
+) AS patch
+WHERE entity.{FIELD.TID} = patch.tid
+"""
+
+    def _applied_query(self) -> str:
+        # Non-ADD events on non-existing entities are not applied
+        return f"""
+SELECT action, COUNT(*) AS count
+FROM {self.staged}
+WHERE action = '{ADD.name}' OR state <> '{self.ABSENT}'
+GROUP BY action
+"""
+
+    def _validate(self):
+        session = self.storage.session
+
+        if invalid := session.execute(self._invalid_event_query()).first():
+            if invalid.action == ADD.name:
+                raise GOBException(
+                    f"Trying to 'ADD' an existing (non-deleted) entity. "
+                    f"(id: {invalid.eventid}, last_event: {invalid.last_event}, tid: {invalid.tid})"
+                )
+
+            raise GOBException(
+                f"Trying to '{invalid.action}' a deleted entity "
+                f"(id: {invalid.eventid}, last_event: {invalid.last_event}) tid: {invalid.tid})"
+            )
+
+    def apply_page(self, start_after: int, limit: int) -> tuple[int, int]:
+        """Applies the next page of at most `limit` events after eventid `start_after` (not committed yet).
+
+        :param start_after: the id of the last event that has been applied
+        :param limit: maximum number of events in the page
+        :return: number of events in the page, id of the last event in the page
+        """
+        session = self.storage.session
+        metadata = self.storage.metadata
+
+        params = {
+            "catalogue": metadata.catalogue,
+            "entity": metadata.entity,
+            "source": metadata.source,
+            "start_after": start_after,
+            "limit": limit
+        }
+        if self.shards > 1:
+            params |= {"shard": self.shard, "shards": self.shards}
+
+        session.execute(self._stage_query(), params)
+        count, last_eventid, rounds = session.execute(
+            f"SELECT COUNT(*), MAX(eventid), MAX(round) FROM {self.staged}"
+        ).one()
+
+        if not count:
+            return 0, start_after
+
+        session.execute(f"ANALYZE {self.staged}")
+        self._validate()
+
+        for round_ in range(1, rounds + 1):
+            session.execute(self._insert_query(), {"round": round_})
+            session.execute(self._update_query(), {"round": round_})
+
+        for row in session.execute(self._applied_query()):
+            self.stats.add_applied(row.action, row.count)
+
+        return count, last_eventid
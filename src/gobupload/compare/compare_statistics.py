@@ -20,14 +20,15 @@ class CompareStatistics():
         """
         self.collected += 1
 
-    def compare(self, row):
+    def compare(self, row, count=1):
         """
-        Adds 1 to the counter for the specific row type (e.g. ADD, DELETE, ...)
+        Adds count (default 1) to the counter for the specific row type (e.g. ADD, DELETE, ...)
         :param row:
+        :param count:
         :return:
         """
         row_type = row['type']
-        self.compared[row_type] = self.compared.get(row_type, 0) + 1
+        self.compared[row_type] = self.compared.get(row_type, 0) + count
 
     def results(self):
         """Get statistics in a dictionary
@@ -0,0 +1,32 @@
+"""
+Upload fingerprint
+
+Order-independent digest of an upload, identical uploads have the same fingerprint.
+
+The digest of each entity is derived from its _tid and _hash (the hash covers all entity values).
+The digests are added modulo 2^256, so the fingerprint does not depend on the order of the entities.
+"""
+import hashlib
+
+from gobcore.model import FIELD
+
+
+class UploadFingerprint:
+
+    _MODULUS = 2 ** 256
+
+    def __init__(self):
+        self.count = 0
+        self._sum = 0
+
+    def add(self, entity: dict):
+        """Adds a populated entity to the fingerprint."""
+        digest = hashlib.sha256(f"{entity[FIELD.TID]}\x00{entity[FIELD.HASH]}".encode("utf-8")).digest()
+
+        self._sum = (self._sum + int.from_bytes(digest, "big")) % self._MODULUS
+        self.count += 1
+
+    @property
+    def value(self) -> str:
+        """The fingerprint, including the number of entities."""
+        return f"{self.count}:{self._sum:064x}"
@@ -20,11 +20,13 @@ from gobcore.utils import ProgressTicker
 from gobupload import gob_model
 from gobupload.config import FULL_UPLOAD
 from gobupload.storage.handler import GOBStorageHandler
+from gobupload.storage.instrumentation import instrumented
 from gobupload.compare.enrich import Enricher
 from gobupload.compare.populate import Populator
 from gobupload.compare.entity_collector import EntityCollector
 from gobupload.compare.event_collector import EventCollector
 from gobupload.compare.compare_statistics import CompareStatistics
+from gobupload.compare.fingerprint import UploadFingerprint
 
 
 def _collect_entities(
@@ -32,7 +34,8 @@ def _collect_entities(
         collect: Callable[[dict], None],
         enricher: Enricher,
         populator: Populator,
-        stats: CompareStatistics
+        stats: CompareStatistics,
+        fingerprint: UploadFingerprint
 ):
     with ProgressTicker("Collect compare events", 10_000) as progress:
         for entity in entities:
@@ -40,9 +43,11 @@ def _collect_entities(
             stats.collect(entity)
             enricher.enrich(entity)
             populator.populate(entity)
+            fingerprint.add(entity)
             collect(entity)
 
 
+@instrumented("compare")
 def compare(msg):
     """Compare new data in msg (contents) with the current data.
 
@@ -68,7 +73,8 @@ def compare(msg):
     logger.info(f"Compare {model}")
 
     stats = CompareStatistics()
-    filename, confirms = None, None  # initialise here, storage.get_session doesn't re-raise exception
+    fingerprint = UploadFingerprint()
+    filename, confirms, confirm_all = None, None, None  # initialise here, storage.get_session doesn't re-raise
 
     # Check any dependencies
     if not meets_dependencies(storage, msg):
@@ -85,10 +91,14 @@ def compare(msg):
         # Collect entities in a temporary table
         with storage.get_session(invalidate=True):
             with EntityCollector(storage) as collector:
-                _collect_entities(msg["contents"], collector.collect, enricher, populator, stats)
+                _collect_entities(msg["contents"], collector.collect, enricher, populator, stats, fingerprint)
 
-            diff = storage.compare_temporary_data(mode)
-            filename, confirms = _process_compare_results(storage, entity_model, diff, stats)
+            if mode == ImportMode.FULL and fingerprint.value == storage.get_upload_fingerprint(metadata.application):
+                logger.info(f"Upload is identical to the last applied upload, confirm all {model} entities")
+                filename, confirm_all = _confirm_all(fingerprint, stats)
+            else:
+                diff = storage.compare_temporary_data(mode)
+                filename, confirms = _process_compare_results(storage, entity_model, diff, stats)
 
     else:
         # If there are no records in the database all data are ADD events
@@ -98,7 +108,9 @@ def compare(msg):
             ContentsWriter() as writer,
             EventCollector(contents_writer=writer, confirms_writer=None, version=version) as collector
         ):
-            _collect_entities(msg["contents"], collector.collect_initial_add, enricher, populator, stats)
+            _collect_entities(
+                msg["contents"], collector.collect_initial_add, enricher, populator, stats, fingerprint
+            )
 
         filename = writer.filename
 
@@ -113,9 +125,14 @@ def compare(msg):
         "header": msg["header"],
         "summary": results,
         "contents_ref": filename,
-        "confirms": confirms
+        "confirms": confirms,
+        "confirm_all": confirm_all
     }
 
+    if mode == ImportMode.FULL:
+        # saved when the upload has been applied
+        message["fingerprint"] = fingerprint.value
+
     return message
 
 
@@ -139,6 +156,20 @@ def meets_dependencies(storage, msg):
     return True
 
 
+def _confirm_all(fingerprint: UploadFingerprint, stats: CompareStatistics) -> tuple[str, int]:
+    """Skip the comparison for an upload that is identical to the last applied upload.
+
+    No events are created, all current entities are confirmed at once by apply.
+
+    :return: (empty) contents file, number of confirmed entities
+    """
+    with ContentsWriter() as writer:
+        pass
+
+    stats.compare({"type": "CONFIRM"}, fingerprint.count)
+    return writer.filename, fingerprint.count
+
+
 def _get_modify_current_entities(storage: GOBStorageHandler, chunk: list[Row]) -> dict[str, Row]:
     """Return current entities for MODIFY events in `chunk`."""
     if tids_modify := [getattr(row, "_tid") for row in chunk if getattr(row, "type") == "MODIFY"]:
@@ -12,3 +12,68 @@ GOB_DB = {
     "host": os.getenv("DATABASE_HOST_OVERRIDE", "localhost"),
     "port": os.getenv("DATABASE_PORT_OVERRIDE", 5406),
 }
+
+# Apply events with set-based SQL statements when the collection supports it
+APPLY_SQL = True if os.getenv("APPLY_SQL") else False
+
+# Number of source / catalogue / entity combinations that are applied concurrently
+APPLY_WORKERS = int(os.getenv("APPLY_WORKERS", 1))
+
+# Number of workers that apply the events of a single collection concurrently, sharded by tid
+APPLY_TID_WORKERS = int(os.getenv("APPLY_TID_WORKERS", 1))
+
+# Drop and rebuild the indexes of a collection when the number of events to apply is larger than this fraction
+# of the number of entities (0 = never)
+APPLY_DEFER_INDEXES_FRACTION = float(os.getenv("APPLY_DEFER_INDEXES_FRACTION", 0))
+
+# Number of indexes that are rebuilt in parallel
+APPLY_INDEX_WORKERS = int(os.getenv("APPLY_INDEX_WORKERS", 4))
+
+# Drop the foreign keys of a relation table while applying when the number of events to apply is larger than this
+# fraction of the number of relations, the foreign keys are validated afterwards (0 = never)
+APPLY_DEFER_FOREIGN_KEYS_FRACTION = float(os.getenv("APPLY_DEFER_FOREIGN_KEYS_FRACTION", 0))
+
+# Number of tables that are vacuumed or analyzed at the same time after apply (0 = in the apply job)
+MAINTENANCE_WORKERS = int(os.getenv("MAINTENANCE_WORKERS", 2))
+
+# Vacuum a table after apply when the number of dead rows is larger than this fraction of the live rows
+MAINTENANCE_VACUUM_FRACTION = float(os.getenv("MAINTENANCE_VACUUM_FRACTION", 0.2))
+
+# Analyze a table after apply when the number of rows modified since the last analyze is larger than this fraction
+# of the live rows
+MAINTENANCE_ANALYZE_FRACTION = float(os.getenv("MAINTENANCE_ANALYZE_FRACTION", 0.1))
+
+# Number of workers that replay the events of a collection concurrently when its table is rebuilt, sharded by tid
+REBUILD_WORKERS = int(os.getenv("REBUILD_WORKERS", 4))
+
+# Local file to cache the reflected database metadata in, to speed up the startup (empty = no cache)
+REFLECTION_CACHE_FILE = os.getenv("REFLECTION_CACHE_FILE", "")
+
+# Number of indexes that are created concurrently at startup
+INDEX_WORKERS = int(os.getenv("INDEX_WORKERS", 2))
+
+# Create the missing indexes in the background at startup, the service does not wait for them
+INDEX_BACKGROUND = True if os.getenv("INDEX_BACKGROUND") else False
+
+# Maintain the mv_ relation lookups as regular tables when relation events are applied, instead of refreshing
+# materialized views
+MV_INCREMENTAL = True if os.getenv("MV_INCREMENTAL") else False
+
+# Number of seconds a materialized view refresh waits for other refresh requests of the same view, which are then
+# covered by the same refresh (0 = refresh at once)
+MV_REFRESH_WINDOW = float(os.getenv("MV_REFRESH_WINDOW", 0))
+
+# Number of materialized views that are created in parallel at startup
+MV_WORKERS = int(os.getenv("MV_WORKERS", 4))
+
+# Don't create missing materialized views at startup, they are created on their first refresh
+MV_LAZY = True if os.getenv("MV_LAZY") else False
+
+# Record the duration and rows of the SQL statements of the jobs, the slowest statements are added to the summary
+SQL_INSTRUMENTATION = True if os.getenv("SQL_INSTRUMENTATION") else False
+
+# Number of slowest SQL statements in the summary of a job
+SQL_TOP_STATEMENTS = int(os.getenv("SQL_TOP_STATEMENTS", 10))
+
+# Local file to write the traces of the SQL statements to, one JSON object per line (empty = no trace file)
+SQL_TRACE_FILE = os.getenv("SQL_TRACE_FILE", "")
@@ -0,0 +1,95 @@
+import json
+import sys
+import time
+
+from psycopg2.extras import execute_values
+
+from gobupload.storage.handler import GOBStorageHandler
+
+
+class MetaData:
+    catalogue = "benchmark"
+    entity = "event_insert"
+    source = "benchmark"
+    application = "benchmark"
+    timestamp = "2023-01-01T00:00:00"
+
+
+COLUMNS = '"timestamp", catalogue, entity, "version", "action", source, source_id, contents, application, tid'
+TEMPLATE = "(%s::timestamp, %s, %s, %s, %s, %s, %s, %s::jsonb, %s, %s)"
+
+
+def _events(count: int) -> list[dict]:
+    return [
+        {"event": "ADD", "version": "0.1", "data": {"_source_id": str(i), "_tid": str(i), "filler": "x" * 200}}
+        for i in range(count)
+    ]
+
+
+def _teardown(storage: GOBStorageHandler):
+    storage.execute(f"DROP TABLE IF EXISTS {GOBStorageHandler.EVENTS_TABLE}.{MetaData.catalogue} CASCADE")
+    storage.execute(f"DELETE FROM {storage.EVENT_PARTITIONS_TABLE} WHERE catalogue = '{MetaData.catalogue}'")
+
+
+def _routed_insert(storage: GOBStorageHandler, events: list[dict]):
+    """Insert the events into the events table, routed to the partition by insertIntoEvents (as before)."""
+    argslist = [
+        (
+            MetaData.timestamp, MetaData.catalogue, MetaData.entity, event["version"], event["event"],
+            MetaData.source, event["data"]["_source_id"], json.dumps(event["data"]), MetaData.application,
+            event["data"]["_tid"]
+        )
+        for event in events
+    ]
+    sql = f"INSERT INTO {storage.EVENTS_TABLE} ({COLUMNS}) VALUES %s"
+
+    with storage.engine.begin() as connection:
+        with connection.connection.cursor() as cur:
+            execute_values(cur, sql, argslist, TEMPLATE, page_size=2_000)
+
+
+def _direct_insert(storage: GOBStorageHandler, events: list[dict]):
+    """Insert the events into the source partition directly (add_events)."""
+    with storage.get_session() as session, session.bind.begin():
+        storage.add_events(events)
+
+
+def _measure(storage: GOBStorageHandler, name: str, events: list[dict], chunksize: int):
+    insert = _direct_insert if name == "direct" else _routed_insert
+
+    start = time.perf_counter()
+    for i in range(0, len(events), chunksize):
+        insert(storage, events[i:i + chunksize])
+    duration = time.perf_counter() - start
+
+    print(f"{name:<8} {len(events):>10,} events {duration:>8.2f}s {len(events) / duration:>12,.0f} events/s")
+
+
+def run():
+    count = int(sys.argv[1]) if len(sys.argv) >= 2 else 200_000
+    chunksize = 10_000
+
+    storage = GOBStorageHandler()
+    storage.metadata = MetaData
+    events = _events(count)
+
+    _teardown(storage)
+
+    try:
+        # creates the partitions
+        storage.get_event_partition()
+
+        _measure(storage, "routed", events, chunksize)
+        _measure(storage, "direct", events, chunksize)
+    finally:
+        _teardown(storage)
+
+
+if __name__ == "__main__":
+    """
+    python -m gobupload.dev_utils.event_insert_benchmark [ events ]
+
+    Prints the time to insert events into the events table, routed to the partition by insertIntoEvents
+    and inserted into the source partition directly.
+    """
+    run()
@@ -0,0 +1,85 @@
+import sys
+import time
+
+from sqlalchemy import select
+
+from gobcore.events import database_to_gobevent
+
+from gobupload.storage.event_reader import EventReader
+from gobupload.storage.handler import GOBStorageHandler, StreamSession
+
+
+def _get_events_starting_after(storage: GOBStorageHandler, eventid: int, limit: int):
+    """Returns the next `limit` events after `eventid` as ORM objects, the way events were read before EventReader."""
+    Event = storage.DbEvent
+    stmt = (
+        select(Event)
+        .where(
+            Event.source == storage.metadata.source,
+            Event.catalogue == storage.metadata.catalogue,
+            Event.entity == storage.metadata.entity,
+            Event.eventid > eventid
+        )
+        .order_by(Event.eventid.asc())
+        .limit(limit)
+    )
+
+    with StreamSession(storage.engine) as session:
+        session.expire_on_commit = False  # allows getting object attributes after closing session
+        return session.scalars(stmt).all()
+
+
+def _orm_pages(storage: GOBStorageHandler, page_size: int):
+    start_after = 0
+    while page := _get_events_starting_after(storage, start_after, page_size):
+        yield page
+        start_after = page[-1].eventid
+
+
+def _measure(name: str, pages, max_events: int):
+    count = 0
+    start = time.perf_counter()
+
+    for page in pages:
+        for event in page:
+            database_to_gobevent(event)
+        count += len(page)
+
+        if count >= max_events:
+            break
+
+    duration = time.perf_counter() - start
+    print(f"{name:<20} {count:>10,} events {duration:>8.2f}s {1_000_000 * duration / max(count, 1):>8.1f} us/event")
+
+
+def run():
+    assert len(sys.argv) >= 4, "Missing arguments: event_reader_benchmark.py " \
+                               "meetbouten meetbouten AMSBI [ max_events ]"
+
+    class MetaData:
+        catalogue = sys.argv[1]
+        entity = sys.argv[2]
+        source = sys.argv[3]
+
+    max_events = int(sys.argv[4]) if len(sys.argv) >= 5 else 100_000
+    page_size = 10_000
+
+    storage = GOBStorageHandler(gob_metadata=MetaData)
+
+    _measure("ORM", _orm_pages(storage, page_size), max_events)
+
+    with EventReader(storage, 0, page_size) as reader:
+        _measure("Core", reader, max_events)
+
+    with EventReader(storage, 0, page_size, prefetch=True) as reader:
+        _measure("Core + prefetch", reader, max_events)
+
+
+if __name__ == "__main__":
+    """
+    python -m gobupload.dev_utils.event_reader_benchmark meetbouten meetbouten AMSBI [ max_events ]
+
+    Prints the time per event to read and convert the events of a collection to GOB events,
+    for the ORM reader (paginated ORM queries) and the Core reader (EventReader).
+    """
+    run()
@@ -0,0 +1,93 @@
+import sys
+import time
+
+from gobupload.storage.handler import GOBStorageHandler
+
+
+class BenchmarkStorage(GOBStorageHandler):
+    """Storage handler on a scratch relation table, the foreign key methods only use the table name."""
+    tablename = "rel_foreign_key_benchmark"
+
+
+SRC_TABLE = "foreign_key_benchmark_src"
+DST_TABLE = "foreign_key_benchmark_dst"
+
+# Number of relations that are inserted in one transaction, as in apply
+CHUNK_SIZE = 10_000
+
+
+def _setup(storage: BenchmarkStorage, rows: int):
+    for table in (SRC_TABLE, DST_TABLE):
+        storage.execute(f"""
+CREATE TABLE {table} (
+    _id varchar,
+    volgnummer integer,
+    PRIMARY KEY (_id, volgnummer)
+)""")
+        storage.execute(f"INSERT INTO {table} SELECT i::varchar, 1 FROM generate_series(1, {rows}) AS i")
+        storage.execute(f"ANALYZE {table}")
+
+    storage.execute(f"""
+CREATE TABLE {storage.tablename} (
+    _gobid serial PRIMARY KEY,
+    src_id varchar,
+    src_volgnummer integer,
+    dst_id varchar,
+    dst_volgnummer integer,
+    CONSTRAINT {storage.tablename}_sfk FOREIGN KEY (src_id, src_volgnummer) REFERENCES {SRC_TABLE} (_id, volgnummer),
+    CONSTRAINT {storage.tablename}_dfk FOREIGN KEY (dst_id, dst_volgnummer) REFERENCES {DST_TABLE} (_id, volgnummer)
+)""")
+
+
+def _teardown(storage: BenchmarkStorage):
+    for table in (storage.tablename, SRC_TABLE, DST_TABLE):
+        storage.execute(f"DROP TABLE IF EXISTS {table}")
+
+
+def _insert_relations(storage: BenchmarkStorage, rows: int):
+    """Insert a relation for every source, referring to a random destination, in chunks."""
+    for start in range(0, rows, CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, rows)
+        storage.execute(f"""
+INSERT INTO {storage.tablename} (src_id, src_volgnummer, dst_id, dst_volgnummer)
+SELECT i::varchar, 1, (1 + floor(random() * {rows}))::varchar, 1 FROM generate_series({start + 1}, {end}) AS i
+""")
+
+
+def _measure(storage: BenchmarkStorage, name: str, rows: int):
+    storage.execute(f"TRUNCATE {storage.tablename}")
+
+    start = time.perf_counter()
+    if name == "deferred":
+        with storage.deferred_foreign_keys():
+            _insert_relations(storage, rows)
+    else:
+        _insert_relations(storage, rows)
+    duration = time.perf_counter() - start
+
+    print(f"{name:<12} {rows:>12,} relations {duration:>8.1f} s {rows / duration:>12,.0f} relations/s")
+
+
+def run():
+    rows = int(sys.argv[1]) if len(sys.argv) >= 2 else 1_000_000
+
+    storage = BenchmarkStorage()
+
+    _teardown(storage)
+    _setup(storage, rows)
+
+    try:
+        _measure(storage, "per row", rows)
+        _measure(storage, "deferred", rows)
+    finally:
+        _teardown(storage)
+
+
+if __name__ == "__main__":
+    """
+    python -m gobupload.dev_utils.foreign_key_benchmark [ rows ]
+
+    Prints the time to insert the relations of a full relate with the foreign keys checked for every row
+    and with the foreign keys dropped and validated afterwards (deferred_foreign_keys).
+    """
+    run()
@@ -0,0 +1,37 @@
+import time
+
+from gobupload.storage.handler import GOBStorageHandler
+
+
+def _measure(name: str):
+    start = time.perf_counter()
+    GOBStorageHandler._set_base(update=True)
+    duration = time.perf_counter() - start
+
+    tables = len(GOBStorageHandler.base.metadata.tables)
+    print(f"{name:<12} {tables:>6} tables {duration:>8.2f}s")
+
+
+def run():
+    cache = GOBStorageHandler.reflection_cache
+
+    if not cache.enabled:
+        print("Set REFLECTION_CACHE_FILE to measure the reflection cache")
+        return
+
+    cache.invalidate()
+
+    # reflects the database and saves the cache
+    _measure("reflect")
+
+    # loads the cache
+    _measure("cached")
+
+
+if __name__ == "__main__":
+    """
+    REFLECTION_CACHE_FILE=/tmp/reflection.pickle python -m gobupload.dev_utils.reflection_benchmark
+
+    Prints the time to reflect the database (cold start) and to load the reflection from the cache (warm start).
+    """
+    run()
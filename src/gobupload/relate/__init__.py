@@ -18,19 +18,25 @@ from gobcore.typesystem import fully_qualified_type_name
 from gobcore.typesystem.gob_types import VeryManyReference
 
 from gobupload import gob_model
+from gobupload.config import MV_REFRESH_WINDOW
 from gobupload.storage.handler import GOBStorageHandler
+from gobupload.storage.instrumentation import instrumented
 from gobupload.storage.materialized_views import MaterializedViews
 from gobupload.storage.relate import check_relations, check_very_many_relations, \
     check_relation_conflicts
 
 from gobupload.relate.update import Relater
 from gobupload.relate.publish import publish_result
+from gobupload.relate.refresh import RefreshCoordinator
 
 CATALOG_KEY = 'original_catalogue'
 COLLECTION_KEY = 'original_collection'
 ATTRIBUTE_KEY = 'original_attribute'
 RELATE_VERSION = '0.1'
 
+# Coalesces the refreshes of the materialized views of all relate_update_view jobs
+refresh_coordinator = RefreshCoordinator(MV_REFRESH_WINDOW)
+
 
 def get_catalog_from_msg(msg: dict, catalog_key: str):  # noqa: C901
     """Return valid GOBModel catalog (name, dict) tuple.
@@ -295,6 +301,7 @@ def verify_process_message(msg: dict):
             f" {header[ATTRIBUTE_KEY]}")
 
 
+@instrumented("relate")
 def process_relate(msg: dict):
     """This function starts the actual relate process.
 
@@ -377,8 +384,14 @@ def update_materialized_view(msg):
     storage_handler = GOBStorageHandler()
 
     view = _get_materialized_view(catalog_name, collection_name, attribute_name)
-    view.refresh(storage_handler)
-    logger.info(f"Update materialized view {view.name}")
+    status = refresh_coordinator.refresh(view, storage_handler)
+
+    if status == RefreshCoordinator.REFRESHED:
+        logger.info(f"Update materialized view {view.name}")
+    elif status == RefreshCoordinator.COVERED:
+        logger.info(f"Materialized view {view.name} has been updated by another job")
+    else:
+        logger.info(f"Materialized view {view.name} is up-to-date")
 
     timestamp = datetime.datetime.utcnow().isoformat()
     msg["header"].update({"timestamp": timestamp})
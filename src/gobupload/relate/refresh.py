@@ -0,0 +1,64 @@
+"""
+Materialized view refresh coordinator
+
+A catalogue-wide relate results in many relate_update_view jobs, often for the same materialized view and within
+minutes of each other. The coordinator coalesces the refresh requests per view:
+
+- a request waits `window` seconds before it refreshes the view, other requests for the view can arrive meanwhile
+- only one refresh per view runs at a time, the requests take an advisory lock per view (in all processes)
+- a request is covered by a refresh that started after the request has been made (see
+  materialized_view_refreshes.timestamp), it is finished when it obtains the lock after that refresh
+
+Every request returns when the refresh that covers it has finished.
+"""
+import time
+
+from sqlalchemy import text
+
+from gobupload.storage.handler import GOBStorageHandler
+from gobupload.storage.materialized_views import MaterializedView
+
+# Advisory lock class of the refresh locks, the view is identified by the hash of its name
+REFRESH_LOCK = 19935912
+
+
+class RefreshCoordinator:
+
+    REFRESHED = "refreshed"
+    COVERED = "covered"
+    UNCHANGED = "unchanged"
+
+    def __init__(self, window: float = 0):
+        """
+        :param window: the number of seconds a request waits for other requests of the same view
+        """
+        self.window = window
+
+    def refresh(self, view: MaterializedView, storage_handler: GOBStorageHandler) -> str:
+        """Refresh the view, or wait for a refresh of another request that covers this request
+
+        :return: REFRESHED, COVERED if refreshed by another request or UNCHANGED if the view is up-to-date
+        """
+        lock_params = {"lock": REFRESH_LOCK, "name": view.name}
+        # now() is a timestamp with time zone, the timestamp of the refresh is not, compare them in the database
+        covered = f"""
+SELECT timestamp >= :requested
+FROM {storage_handler.MATERIALIZED_VIEW_REFRESHES_TABLE}
+WHERE name = :name
+"""
+
+        with storage_handler.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            requested = connection.execute(text("SELECT now()")).scalar()
+
+            if self.window:
+                time.sleep(self.window)
+
+            connection.execute(text("SELECT pg_advisory_lock(:lock, hashtext(:name))"), lock_params)
+
+            try:
+                if connection.execute(text(covered), {"name": view.name, "requested": requested}).scalar():
+                    return self.COVERED
+
+                return self.REFRESHED if view.refresh(storage_handler) else self.UNCHANGED
+            finally:
+                connection.execute(text("SELECT pg_advisory_unlock(:lock, hashtext(:name))"), lock_params)
@@ -20,6 +20,7 @@ from gobcore.utils import ProgressTicker
 from gobupload import gob_model
 from gobupload.compare.event_collector import EventCollector
 from gobupload.storage.handler import StreamSession
+from gobupload.storage.instrumentation import step
 from gobupload.relate.exceptions import RelateException
 
 EQUALS = 'equals'
@@ -1118,11 +1119,13 @@ LEFT JOIN {self.dst_table_name} dst ON {self.and_join.join(self._dst_table_outer
         :return:
         """
 
-        for src_entities_query, dst_entities_query in self._get_chunks(start_src_event, max_src_event, start_dst_event,
-                                                                       max_dst_event, only_src_side=only_src_side):
+        chunks = self._get_chunks(start_src_event, max_src_event, start_dst_event, max_dst_event,
+                                  only_src_side=only_src_side)
+        for chunk, (src_entities_query, dst_entities_query) in enumerate(chunks, start=1):
             query = self.get_query(src_entities_query, dst_entities_query, max_src_event, max_dst_event,
                                    is_conflicts_query=is_conflicts_query)
-            self._query_into_results_table(query, is_conflicts_query)
+            with step(f"{'conflicts ' if is_conflicts_query else ''}chunk {chunk}"):
+                self._query_into_results_table(query, is_conflicts_query)
 
         self._remove_duplicate_rows()
 
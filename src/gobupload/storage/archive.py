@@ -0,0 +1,195 @@
+"""
+Event archive
+
+The events of a collection are kept forever in its source partition, although only the events after the last
+applied event are ever read again. EventArchiver exports the applied events up to a cutoff to compressed files,
+records a checkpoint in the event_archives table and deletes the exported events from the source partition.
+
+Every archive run writes two files to the archive directory:
+
+    <catalogue>_<entity>_<source>_events_<from>_<to>.csv.gz     the events with from < eventid <= to
+    <catalogue>_<entity>_<source>_snapshot_<eventid>.csv.gz     the entities of the source, applied up to eventid
+
+Both are gzip compressed CSV files (PostgreSQL COPY format csv) with a header line with the column names.
+The events file has the columns of the events table, ordered by eventid. The snapshot file has the columns of
+the entity table, ordered by _gobid.
+
+The cutoff is limited to the last applied event, events that have not been applied are never archived.
+The snapshot is taken in the same transaction as the export, it holds the state of the entities after the last
+applied event. The collection can be restored by loading the last snapshot and applying the live events after
+its eventid, or replayed from scratch by applying the events files in order followed by the live events.
+"""
+from __future__ import annotations
+
+import gzip
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from gobcore.logging.logger import logger
+
+from gobupload.storage.handler import GOBStorageHandler
+
+
+@dataclass
+class ArchiveResult:
+    archived_eventid: int
+    snapshot_eventid: int
+    events: int
+    events_file: Path
+    snapshot_file: Path
+    size_before: int
+    size_after: int
+    scan_before: float
+    scan_after: float
+
+    @property
+    def reclaimed(self) -> int:
+        return self.size_before - self.size_after
+
+
+class EventArchiver:
+
+    def __init__(self, storage: GOBStorageHandler, directory: Path | str):
+        self.storage = storage
+        self.directory = Path(directory)
+
+        metadata = storage.metadata
+        self.partition = storage.event_partitions.get(metadata.catalogue, metadata.entity, metadata.source)
+        self.prefix = f"{metadata.catalogue}_{metadata.entity}_{metadata.source.lower()}"
+
+    def _get_size(self) -> int:
+        query = text("SELECT pg_total_relation_size(to_regclass(:partition))")
+        with self.storage.engine.connect() as connection:
+            return connection.execute(query, {"partition": self.partition}).scalar() or 0
+
+    def _scan(self) -> float:
+        """Returns the time in seconds of a full scan of the source partition."""
+        with self.storage.engine.connect() as connection:
+            start = time.perf_counter()
+            connection.execute(text(f"SELECT COUNT(*) FROM {self.partition}")).scalar()
+            return time.perf_counter() - start
+
+    def _export(self, connection: Connection, query: str, params: dict, path: Path) -> int:
+        """Writes the result of `query` to the compressed CSV file `path`.
+
+        The file is written under a temporary name and renamed when complete.
+
+        :return: the number of exported rows
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        partial = path.with_name(f"{path.name}.partial")
+
+        with connection.connection.cursor() as cur:
+            sql = cur.mogrify(query, params).decode()
+
+            with gzip.open(partial, "wb") as file:
+                cur.copy_expert(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER)", file)
+                rows = cur.rowcount
+
+        with open(partial, "rb") as file:
+            os.fsync(file.fileno())
+
+        partial.rename(path)
+        return rows
+
+    def _delete(self, start_after: int, result: ArchiveResult):
+        """Deletes the archived events from the source partition and records the checkpoint."""
+        metadata = self.storage.metadata
+        checkpoint = f"""
+INSERT INTO {self.storage.EVENT_ARCHIVES_TABLE}
+    (catalogue, entity, source, archived_eventid, snapshot_eventid, events, events_file, snapshot_file)
+VALUES
+    (:catalogue, :entity, :source, :archived_eventid, :snapshot_eventid, :events, :events_file, :snapshot_file)
+"""
+        params = {
+            "catalogue": metadata.catalogue,
+            "entity": metadata.entity,
+            "source": metadata.source,
+            "archived_eventid": result.archived_eventid,
+            "snapshot_eventid": result.snapshot_eventid,
+            "events": result.events,
+            "events_file": result.events_file.name,
+            "snapshot_file": result.snapshot_file.name,
+        }
+
+        with self.storage.engine.begin() as connection:
+            connection.execute(
+                text(f"DELETE FROM {self.partition} WHERE eventid > :start_after AND eventid <= :end"),
+                {"start_after": start_after, "end": result.archived_eventid}
+            )
+            connection.execute(text(checkpoint), params)
+
+    def _vacuum(self, full: bool):
+        with self.storage.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            connection.execute(text(f"VACUUM {'FULL ' if full else ''}ANALYZE {self.partition}"))
+
+    def archive(self, cutoff: int, vacuum_full: bool = False) -> ArchiveResult | None:
+        """Archive the events of the collection up to and including eventid `cutoff`.
+
+        :param cutoff: the last eventid to archive, limited to the last applied event
+        :param vacuum_full: rewrite the source partition to return the space of the archived events to the
+            operating system, this locks the partition. By default the space is only reused by new events.
+        :return: the result, None if there is nothing to archive
+        """
+        start_after = self.storage.get_archived_eventid()
+        size_before = self._get_size()
+        scan_before = self._scan()
+
+        # the snapshot and the exported events are read from the same database snapshot
+        with self.storage.engine.connect().execution_options(isolation_level="REPEATABLE READ") as connection:
+            snapshot_eventid = connection.execute(
+                text(f'SELECT max(_last_event) FROM "{self.storage.tablename}" WHERE _source = :source'),
+                {"source": self.storage.metadata.source}
+            ).scalar() or 0
+            archived_eventid = min(cutoff, snapshot_eventid)
+
+            if archived_eventid <= start_after:
+                logger.info(f"No events to archive for {self.prefix}, archived up to {start_after}")
+                return None
+
+            events_file = self.directory / f"{self.prefix}_events_{start_after}_{archived_eventid}.csv.gz"
+            snapshot_file = self.directory / f"{self.prefix}_snapshot_{snapshot_eventid}.csv.gz"
+
+            events = self._export(
+                connection,
+                f"SELECT * FROM {self.partition} WHERE eventid > %(start_after)s AND eventid <= %(end)s "
+                "ORDER BY eventid",
+                {"start_after": start_after, "end": archived_eventid},
+                events_file
+            )
+            self._export(
+                connection,
+                f'SELECT * FROM "{self.storage.tablename}" WHERE _source = %(source)s ORDER BY _gobid',
+                {"source": self.storage.metadata.source},
+                snapshot_file
+            )
+
+        result = ArchiveResult(
+            archived_eventid=archived_eventid,
+            snapshot_eventid=snapshot_eventid,
+            events=events,
+            events_file=events_file,
+            snapshot_file=snapshot_file,
+            size_before=size_before,
+            size_after=size_before,
+            scan_before=scan_before,
+            scan_after=scan_before
+        )
+
+        self._delete(start_after, result)
+        self._vacuum(vacuum_full)
+
+        result.size_after = self._get_size()
+        result.scan_after = self._scan()
+
+        logger.info(
+            f"Archived {result.events:,} events of {self.prefix} up to {archived_eventid} to {events_file.name}, "
+            f"reclaimed {result.reclaimed / 2 ** 20:,.1f} MB, "
+            f"full scan {result.scan_before:.2f}s -> {result.scan_after:.2f}s"
+        )
+        return result
@@ -0,0 +1,127 @@
+"""
+Event reader
+
+Reads the events of a collection in pages of plain rows, ordered by eventid.
+
+Pages are read with keyset pagination (eventid > last eventid of the previous page) on one connection.
+Each page is read in its own (autocommit) transaction to prevent locking the events table for a long time.
+
+Optionally the next page is prefetched in a separate thread while the current page is being processed:
+
+    with EventReader(storage, start_after=0, page_size=10_000, prefetch=True) as reader:
+        for page in reader:
+            ...
+"""
+from __future__ import annotations
+
+import queue
+import threading
+from typing import Iterator, Sequence
+
+from sqlalchemy import select
+from sqlalchemy.engine import Connection, Row
+
+from gobupload.storage.handler import GOBStorageHandler
+
+
+class EventReader:
+
+    # Columns required to reconstruct a GOB event out of a database event
+    COLUMNS = [
+        "eventid", "timestamp", "catalogue", "entity", "version", "action", "source", "application", "tid", "contents"
+    ]
+
+    # Seconds to wait for the consumer before checking if reading has been stopped
+    _PUT_TIMEOUT = 1
+
+    def __init__(self, storage: GOBStorageHandler, start_after: int, page_size: int = 10_000, prefetch=False):
+        """
+        :param storage: storage handler for the collection to read the events for
+        :param start_after: read events with an eventid greater than this eventid
+        :param page_size: maximum number of events in a page
+        :param prefetch: read the next page in a separate thread
+        """
+        self.storage = storage
+        self.start_after = start_after
+        self.page_size = page_size
+        self.prefetch = prefetch
+
+        self._connection: Connection | None = None
+        self._pages: queue.Queue | None = None
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def __enter__(self):
+        self._connection = self.storage.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+
+        if self.prefetch:
+            self._pages = queue.Queue(maxsize=1)
+            self._thread = threading.Thread(target=self._prefetch, name="EventReader", daemon=True)
+            self._thread.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stopped.set()
+
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+        self._connection.close()
+        self._connection = None
+
+    def _query(self, start_after: int):
+        events = self.storage.DbEvent.__table__
+        metadata = self.storage.metadata
+
+        return (
+            select(*[events.c[name] for name in self.COLUMNS])
+            .where(
+                events.c.source == metadata.source,
+                events.c.catalogue == metadata.catalogue,
+                events.c.entity == metadata.entity,
+                events.c.eventid > start_after
+            )
+            .order_by(events.c.eventid.asc())
+            .limit(self.page_size)
+        )
+
+    def _read_pages(self) -> Iterator[Sequence[Row]]:
+        start_after = self.start_after
+
+        while not self._stopped.is_set():
+            page = self._connection.execute(self._query(start_after)).all()
+            if not page:
+                return
+
+            yield page
+            start_after = page[-1].eventid
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._pages.put(item, timeout=self._PUT_TIMEOUT)
+                return
+            except queue.Full:
+                continue
+
+    def _prefetch(self):
+        """Reads the pages into the queue, ends with None or the exception that occurred."""
+        try:
+            for page in self._read_pages():
+                self._put(page)
+        except Exception as err:
+            self._put(err)
+        else:
+            self._put(None)
+
+    def __iter__(self) -> Iterator[Sequence[Row]]:
+        if not self.prefetch:
+            yield from self._read_pages()
+            return
+
+        while (page := self._pages.get()) is not None:
+            if isinstance(page, Exception):
+                raise page
+            yield page
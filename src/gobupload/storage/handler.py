@@ -11,18 +11,21 @@ from __future__ import annotations
 
 import datetime
 import functools
+import hashlib
 import json
+import threading
 import warnings
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from typing import Union, Iterator, Iterable, Any, Sequence
 
 from psycopg2.extras import execute_values
 from sqlalchemy import (
-    create_engine, Table, update, exc as sa_exc, select, column, String, values, Column, text,
+    create_engine, Table, exc as sa_exc, select, column, String, values, Column, text, func,
     Executable, Result, ScalarResult
 )
-from sqlalchemy.engine import Row
+from sqlalchemy.engine import Row, Connection, Engine, TwoPhaseTransaction
 from sqlalchemy.engine.url import URL
 from sqlalchemy.exc import MultipleResultsFound
 from sqlalchemy.ext.automap import automap_base
@@ -44,9 +47,13 @@ import alembic.script
 from gobcore.typesystem.gob_types import JSON
 from gobcore.typesystem.json import GobTypeJSONEncoder
 from gobupload import gob_model
-from gobupload.config import GOB_DB
+from gobupload.config import GOB_DB, INDEX_WORKERS, MV_LAZY, MV_WORKERS, REFLECTION_CACHE_FILE, SQL_INSTRUMENTATION
 from gobupload.storage import queries
+from gobupload.storage.indexes import IndexBuilder
+from gobupload.storage.instrumentation import sql_instrumentation
 from gobupload.storage.materialized_views import MaterializedViews
+from gobupload.storage.partitions import EventPartitions
+from gobupload.storage.reflection_cache import ReflectionCache
 from gobupload.utils import random_string
 
 # not used but must be imported
@@ -115,6 +122,62 @@ class StreamSession(SessionORM):
         return super().execute(stmt, *args, **kwargs)
 
 
+class CopyStream:
+    """
+    Read-only file-like object over an iterable of values, to COPY the values in CSV format.
+
+    The values are consumed while the database reads the stream, they are never held in memory at once.
+    """
+
+    def __init__(self, values: Iterable[str]):
+        self._lines = ('"' + value.replace('"', '""') + '"\n' for value in values)
+        self._buffer = ""
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._buffer) < size:
+            if (line := next(self._lines, None)) is None:
+                break
+            self._buffer += line
+
+        if size < 0:
+            size = len(self._buffer)
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class PreparedTransaction:
+    """
+    Two-phase transaction on its own connection.
+
+    The connection is kept open until the prepared transaction is committed or rolled back;
+    closing the connection of a prepared transaction rolls it back.
+    """
+
+    def __init__(self, engine: Engine, xid: str):
+        self.xid = xid
+        self.connection: Connection = engine.connect()
+        self.transaction: TwoPhaseTransaction = self.connection.begin_twophase(xid)
+
+    def prepare(self):
+        """PREPARE TRANSACTION, the transaction survives a crash of this process from now on."""
+        self.transaction.prepare()
+
+    def commit(self):
+        """COMMIT (PREPARED) the transaction and release the connection."""
+        try:
+            self.transaction.commit()
+        finally:
+            self.connection.close()
+
+    def rollback(self):
+        """ROLLBACK (PREPARED) the transaction and release the connection."""
+        try:
+            self.transaction.rollback()
+        finally:
+            self.connection.close()
+
+
 class GOBStorageHandler:
     """Metadata aware Storage handler."""
 
@@ -131,32 +194,124 @@ class GOBStorageHandler:
     )
 
     Session = sessionmaker(engine, class_=StreamSession, autoflush=False)
+    if SQL_INSTRUMENTATION:
+        # the sessions use the engine, their statements are recorded as well
+        sql_instrumentation.install(engine)
+
     base = automap_base()
+    event_partitions = EventPartitions(engine)
+
+    reflection_cache = ReflectionCache(REFLECTION_CACHE_FILE)
+
+    # Serializes the reflection and the changes of the shared metadata by concurrent (message handling) threads
+    _reflection_lock = threading.RLock()
+
+    # Fields and GOB types by (catalogue, entity), shared by all handlers of a collection
+    _collection_fields: dict[tuple[str, str], tuple[dict, dict]] = {}
 
     @classmethod
-    def _set_base(cls, update=False, reflection_options: dict = None):
-        reflection_options = reflection_options or {}
-        only = reflection_options.get("only")
-        reflections_exist = only and all(hasattr(cls.base.classes, table) for table in only)
+    def _load_reflection_cache(cls, base, key: tuple) -> bool:
+        """Copy the cached reflection of the full database in the metadata of `base`.
 
-        # no reflection necessary
-        if not (update or reflection_options) or reflections_exist:
-            return
+        :return: True if the cache is valid and has been loaded
+        """
+        if (metadata := cls.reflection_cache.load(key)) is None:
+            return False
 
-        # reflection required, clear first
-        cls.base.metadata.clear()
+        for name, table in metadata.tables.items():
+            if name not in base.metadata.tables:
+                table.to_metadata(base.metadata)
 
-        print(f"Reflecting {only}" if only else "Reflecting database")
+        return True
+
+    @classmethod
+    def _reflect(cls, base, reflection_options: dict):
+        only = reflection_options.get("only")
+
+        # the cache holds the full database, it serves any reflection of (a subset of) the tables
+        use_cache = cls.reflection_cache.enabled and set(reflection_options) <= {"only"}
+        key = cls.reflection_cache.get_key(cls.engine) if use_cache else None
 
         with warnings.catch_warnings():
             # Ignore warnings for unsupported reflection for expression-based indexes
             warnings.simplefilter("ignore", category=sa_exc.SAWarning)
 
-            # Reflect database in metadata, prepare generates mapped classes
-            cls.base.metadata.reflect(cls.engine, **reflection_options)
-            cls.base.prepare()
+            if use_cache and cls._load_reflection_cache(base, key):
+                print("Reflection loaded from cache")
+
+                # tables that are created outside the migrations (eg incremental mv_ tables or rebuilt tables)
+                # do not change the key of the cache, these are reflected from the database
+                if absent := [table for table in only or [] if table not in base.metadata.tables]:
+                    print(f"Reflecting {absent}")
+                    base.metadata.reflect(cls.engine, only=absent)
+            else:
+                print(f"Reflecting {only}" if only else "Reflecting database")
+
+                # Reflect database in metadata, tables that are already in the metadata are kept
+                base.metadata.reflect(cls.engine, **reflection_options)
+
+                if use_cache and not only:
+                    cls.reflection_cache.save(key, base.metadata)
+
+            # prepare generates mapped classes for the tables that are not mapped yet
+            base.prepare()
+
+    @classmethod
+    def _set_base(cls, update=False, reflection_options: dict = None):
+        """Reflect the database in the shared automap base.
+
+        Mapped classes may be in use by other threads, the metadata of the base is never cleared:
+
+        - update=True reflects the full database in a new base, which replaces the base when it is ready
+        - otherwise only the tables that are missing are added to the base
+        """
+        reflection_options = reflection_options or {}
+
+        def missing() -> list[str]:
+            return [table for table in reflection_options.get("only", []) if not hasattr(cls.base.classes, table)]
+
+        # no reflection necessary
+        if not (update or reflection_options) or (reflection_options.get("only") and not missing()):
+            return
+
+        with cls._reflection_lock:
+            if update:
+                base = automap_base()
+                cls._reflect(base, reflection_options)
+                cls.base = base
+                return
+
+            # the tables may have been reflected by another thread while waiting for the lock
+            if "only" in reflection_options:
+                if not (tables := missing()):
+                    return
+                reflection_options = reflection_options | {"only": tables}
+
+            cls._reflect(cls.base, reflection_options)
 
     EVENTS_TABLE = "events"
+    COMMIT_DECISIONS_TABLE = "apply_commit_decisions"
+    UPLOAD_FINGERPRINTS_TABLE = "upload_fingerprints"
+    EVENT_WATERMARKS_TABLE = "event_watermarks"
+    EVENT_PARTITIONS_TABLE = "event_partitions"
+    EVENT_ARCHIVES_TABLE = "event_archives"
+    STORAGE_FINGERPRINTS_TABLE = "storage_fingerprints"
+    MATERIALIZED_VIEW_REFRESHES_TABLE = "materialized_view_refreshes"
+    DEFERRED_FOREIGN_KEYS_TABLE = "deferred_foreign_keys"
+    MATERIALIZED_VIEW_WATERMARKS_TABLE = "materialized_view_watermarks"
+
+    # Entities are looked up by tid and the highest eventid of a source is read while applying events,
+    # deferred_indexes keeps the indexes on these columns
+    APPLY_INDEX_COLUMNS = (FIELD.TID, FIELD.SOURCE, FIELD.LAST_EVENT)
+
+    # Prefix for the ids of two-phase apply transactions
+    APPLY_XID_PREFIX = "gob_apply"
+
+    # Advisory lock class of the tables whose foreign keys are deferred, the table is identified by its hash
+    FOREIGN_KEYS_LOCK = 19935913
+
+    # Advisory lock class of the two-phase applies, the collection and source are identified by their hash
+    APPLY_LOCK = 19935914
 
     user_name = f"({GOB_DB['username']}@{GOB_DB['host']}:{GOB_DB['port']})"
 
@@ -186,8 +341,7 @@ class GOBStorageHandler:
         self.session: StreamSession | None = None
 
         if gob_metadata:
-            self._fields = self.get_collection_model()["all_fields"]
-            self._field_types = {field: get_gob_type(self._fields[field]["type"]) for field in self._fields}
+            self._fields, self._field_types = self._get_collection_fields()
             self.tablename_temp = self._generate_temp_tablename(gob_metadata)
 
             reflection_options["only"] = [self.EVENTS_TABLE, self.tablename] + reflection_options.get("only", [])
@@ -202,13 +356,16 @@ class GOBStorageHandler:
     def init_storage(
         self,
         force_migrate=False,
-        recreate_materialized_views: Union[bool, list] = False
-    ):
+        recreate_materialized_views: Union[bool, list] = False,
+        background_indexes=False
+    ) -> IndexBuilder | None:
         """Check if the necessary tables (for events, and for the entities in gobmodel) are present
         If not, they are required
 
         :param force_migrate: Don't wait for any migrations to finish before continuing
         :param recreate_materialized_views: List of mv's to recreate, True for all, False for none
+        :param background_indexes: Create the missing indexes in the background, after the storage is initialised
+        :return: the index builder if the indexes are created in the background
         """
         MIGRATION_LOCK = 19935910
 
@@ -219,22 +376,26 @@ class GOBStorageHandler:
             alembic_cfg = alembic.config.Config('alembic.ini')
             script = alembic.script.ScriptDirectory.from_config(alembic_cfg)
 
+            head = script.get_current_head()
+
             with self.engine.begin() as conn:
                 context = migration.MigrationContext.configure(conn)
-                up_to_date = context.get_current_revision() == script.get_current_head()
+                up_to_date = context.get_current_revision() == head
 
             if not up_to_date:
                 print('Migrating storage')
+                self.reflection_cache.invalidate()
                 alembic.config.main(argv=['--raiseerr', 'upgrade', 'head'])
 
             # refresh reflected base
             self._set_base(update=True)
 
-            # Create necessary indexes
-            self._init_indexes()
+            definitions = self._get_storage_definitions()
+            fingerprint = self._get_fingerprint(definitions)
 
-            # Initialise materialized views for relations
-            self._init_relation_materialized_views(recreate_materialized_views)
+            index_builder = self._reconcile_storage(head, fingerprint, definitions, recreate_materialized_views)
+            self.restore_deferred_foreign_keys()
+            index_builder = self._build_indexes(index_builder, background_indexes, head, fingerprint, definitions)
 
         except Exception as err:
             print(f'Storage migration failed: {str(err)}')
@@ -246,6 +407,130 @@ class GOBStorageHandler:
 
         self._check_configuration()
 
+        if index_builder:
+            print('Creating indexes in the background')
+            index_builder.start(
+                on_complete=functools.partial(self.save_storage_fingerprint, head, fingerprint, definitions)
+            )
+
+        return index_builder
+
+    def _reconcile_storage(
+        self, head: str, fingerprint: str, definitions: dict, recreate_materialized_views: Union[bool, list]
+    ) -> IndexBuilder | None:
+        """Reconcile the indexes and materialized views with the definitions, if they have changed.
+
+        :return: the builder of the missing indexes, None if nothing has changed
+        """
+        stored = self.get_storage_fingerprint()
+
+        if recreate_materialized_views or stored is None or stored.revision != head:
+            # Create necessary indexes
+            index_builder = self._init_indexes()
+
+            # Initialise materialized views for relations
+            self._init_relation_materialized_views(recreate_materialized_views)
+            return index_builder
+
+        if stored.fingerprint != fingerprint:
+            return self._apply_storage_changes(stored.definitions, definitions)
+
+        print('Indexes and materialized views are up-to-date')
+        return None
+
+    def _build_indexes(
+        self, index_builder: IndexBuilder | None, background: bool, head: str, fingerprint: str, definitions: dict
+    ) -> IndexBuilder | None:
+        """Build the indexes and save the fingerprint, or leave the build to the background.
+
+        :return: the index builder if the indexes are built in the background, started by init_storage
+        """
+        if index_builder and background:
+            # the fingerprint is saved when the indexes have been built
+            self.invalidate_storage_fingerprint()
+            return index_builder
+
+        if index_builder:
+            index_builder.build()
+
+        self.save_storage_fingerprint(head, fingerprint, definitions)
+        return None
+
+    def _get_storage_definitions(self) -> dict:
+        """Returns the definitions of the managed indexes and the materialized views, as stored in JSON."""
+        definitions = {
+            "indexes": get_indexes(gob_model),
+            "materialized_views": {mv.name: mv.get_definition() for mv in MaterializedViews().get_all()},
+        }
+        return json.loads(json.dumps(definitions, default=str))
+
+    @staticmethod
+    def _get_fingerprint(definitions: dict) -> str:
+        return hashlib.sha256(json.dumps(definitions, sort_keys=True).encode()).hexdigest()
+
+    def get_storage_fingerprint(self) -> Row | None:
+        """Get the alembic revision, fingerprint and definitions of the last reconciled indexes and materialized views
+
+        :return: the stored fingerprint, None if the storage has to be reconciled completely
+        """
+        query = f"""
+SELECT revision, fingerprint, definitions
+FROM {self.STORAGE_FINGERPRINTS_TABLE}
+WHERE name = 'storage'
+"""
+        with self.engine.connect() as connection:
+            return connection.execute(text(query)).first()
+
+    def save_storage_fingerprint(self, revision: str, fingerprint: str, definitions: dict):
+        query = f"""
+INSERT INTO {self.STORAGE_FINGERPRINTS_TABLE} (name, revision, fingerprint, definitions)
+VALUES ('storage', :revision, :fingerprint, :definitions)
+ON CONFLICT (name) DO UPDATE SET
+    revision = EXCLUDED.revision,
+    fingerprint = EXCLUDED.fingerprint,
+    definitions = EXCLUDED.definitions
+"""
+        params = {"revision": revision, "fingerprint": fingerprint, "definitions": json.dumps(definitions)}
+        with self.engine.begin() as connection:
+            connection.execute(text(query), params)
+
+    def invalidate_storage_fingerprint(self):
+        """Reconcile all indexes and materialized views on the next start, eg after managed objects are dropped."""
+        self.execute(f"DELETE FROM {self.STORAGE_FINGERPRINTS_TABLE}")
+
+    def _apply_storage_changes(self, old: dict, new: dict) -> IndexBuilder:
+        """Drop and create the indexes and materialized views that differ between the `old` and `new` definitions.
+
+        :return: the builder of the changed indexes, the materialized views are created already
+        """
+        old_indexes, new_indexes = old.get("indexes", {}), new["indexes"]
+        changed = {name: definition for name, definition in new_indexes.items() if old_indexes.get(name) != definition}
+        dropped = [name for name in old_indexes if name not in new_indexes]
+
+        with self.engine.begin() as connection:
+            for name in [*dropped, *(name for name in changed if name in old_indexes)]:
+                connection.execute(text(f'DROP INDEX IF EXISTS "{name}"'))
+
+        self._apply_materialized_view_changes(old.get("materialized_views", {}), new["materialized_views"])
+
+        print(f"Applied changes to {len(changed) + len(dropped)} indexes and the materialized views")
+        return IndexBuilder(self, changed, INDEX_WORKERS)
+
+    def _apply_materialized_view_changes(self, old_views: dict, new_views: dict):
+        """Drop, create or reindex the materialized views whose definitions have changed."""
+        for name in old_views:
+            if name not in new_views:
+                MaterializedViews.drop(self, name)
+
+        for materialized_view in MaterializedViews().get_all():
+            definition, new_definition = old_views.get(materialized_view.name), new_views[materialized_view.name]
+
+            if definition and definition["query"] == new_definition["query"] and definition != new_definition:
+                # only the indexes have changed, keep the view
+                materialized_view._create_indexes(self, force_recreate=True)
+            elif definition != new_definition:
+                materialized_view.create(self, force_recreate=definition is not None)
+
     def _check_configuration(self):
         with self.engine.connect() as connection:
             for setting, check, message, type_ in self.config_checks:
@@ -259,7 +544,7 @@ class GOBStorageHandler:
 
     def _init_relation_materialized_views(self, recreate=False):
         mv = MaterializedViews()
-        mv.initialise(self, recreate)
+        mv.initialise(self, recreate, MV_WORKERS, MV_LAZY)
 
     def _get_index_type(self, type_: str) -> str:
         return {"geo": "GIST", "json": "GIN"}.get(type_, "BTREE")
@@ -291,37 +576,220 @@ WHERE
             for index in indexes_to_drop:
                 connection.execute(text(f'DROP INDEX IF EXISTS "{index}"'))
 
-    def _get_existing_indexes(self) -> Sequence[str]:
-        query = "SELECT indexname FROM pg_indexes"
-
-        with self.engine.connect() as connection:
-            return connection.execute(text(query)).scalars().all()
-
-    def _init_indexes(self):
-        """Create indexes
+    def _init_indexes(self) -> IndexBuilder:
+        """Drop the indexes that are no longer defined
 
-        :return:
+        :return: the builder of the missing (and invalid) indexes
         """
         indexes = get_indexes(gob_model)
         self._drop_indexes(indexes)
-        existing_indexes = self._get_existing_indexes()
+        return IndexBuilder(self, indexes, INDEX_WORKERS)
+
+    def _create_index_statement(self, name: str, definition: dict, concurrently=False) -> str:
+        columns = ','.join(definition['columns'])
+        index_type = self._get_index_type(definition.get('type'))
+        table = definition["table_name"]
+        create = "CREATE INDEX CONCURRENTLY" if concurrently else "CREATE INDEX"
+        statement = f'{create} IF NOT EXISTS "{name}" ON {table} USING {index_type}({columns})'
+
+        if index_type == "GIST":
+            # Create GIST index for valid geometries (used during spatial relate)
+            statement += f" WHERE ST_IsValid({columns})"
+
+        return statement
+
+    def get_managed_indexes(self) -> dict[str, dict]:
+        """Returns the (non-unique) indexes of the current collection table that are created by _init_indexes."""
+        return {
+            name: definition for name, definition in get_indexes(gob_model).items()
+            if definition.get("table_name") == self.tablename
+        }
+
+    def create_indexes(self, indexes: dict[str, dict], workers: int = 1):
+        """Create the given indexes (if not exists), by `workers` connections in parallel.
+
+        :param indexes: the index definitions by name, as returned by get_managed_indexes
+        :param workers: the number of indexes that are created at the same time
+        """
+        def create(name: str):
+            with self.engine.begin() as connection:
+                connection.execute(text(self._create_index_statement(name, indexes[name])))
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="create_index") as executor:
+            # raises the first exception, if any
+            list(executor.map(create, indexes))
+
+    @contextmanager
+    def deferred_indexes(self, workers: int = 1):
+        """
+        Drops the managed indexes of the current collection table and recreates them on leaving the context.
+        Indexes that are read while applying events (APPLY_INDEX_COLUMNS) are kept.
+
+        Use this to apply large change sets, the indexes are not maintained for every row but rebuilt once.
+        If the process is interrupted the missing indexes are recreated on the next start (see _init_indexes).
+        The storage fingerprint is invalid during the rebuild and is restored once the indexes have been rebuilt.
+
+        :param workers: the number of indexes that are rebuilt at the same time
+        """
+        indexes = {
+            name: definition for name, definition in self.get_managed_indexes().items()
+            if definition["columns"][0] not in self.APPLY_INDEX_COLUMNS
+        }
+
+        # the dropped indexes are recreated on the next start if the process is interrupted,
+        # the fingerprint is restored when the indexes have been rebuilt
+        stored = self.get_storage_fingerprint()
+        self.invalidate_storage_fingerprint()
 
         with self.engine.begin() as connection:
-            for name, definition in indexes.items():
-                if name in existing_indexes:
-                    # Don't run CREATE INDEX IF NOT EXISTS query to prevent unnecessary locks
+            for name in indexes:
+                connection.execute(text(f'DROP INDEX IF EXISTS "{name}"'))
+
+        logger.info(f"Dropped {len(indexes)} indexes on {self.tablename}, rebuilding afterwards")
+
+        try:
+            yield
+        finally:
+            self.create_indexes(indexes, workers)
+            logger.info(f"Rebuilt {len(indexes)} indexes on {self.tablename}")
+            if stored is not None:
+                self.save_storage_fingerprint(stored.revision, stored.fingerprint, stored.definitions)
+
+    def get_foreign_keys(self) -> dict[str, str]:
+        """Returns the definitions of the foreign key constraints of the current collection table by name."""
+        query = f"""
+SELECT conname, pg_get_constraintdef(oid)
+FROM pg_catalog.pg_constraint
+WHERE contype = 'f' AND conrelid = '"{self.tablename}"'::regclass
+"""
+        with self.engine.connect() as connection:
+            rows = connection.execute(text(query)).all()
+
+        # constraints that failed validation before are validated again
+        return {name: definition.removesuffix(" NOT VALID") for name, definition in rows}
+
+    def validate_foreign_keys(self, names: Iterable[str], tablename: str | None = None):
+        """Validate the given foreign key constraints of the current collection table, each in a single table scan.
+
+        :param names: the names of the constraints
+        :param tablename: the table of the constraints, the current collection table by default
+        :raises GOBException: if any of the constraints is violated, the constraints remain NOT VALID
+        """
+        tablename = tablename or self.tablename
+        violated = []
+
+        for name in names:
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(text(f'ALTER TABLE "{tablename}" VALIDATE CONSTRAINT "{name}"'))
+            except sa_exc.IntegrityError as e:
+                logger.error(f"Foreign key {name} is violated: {e.orig}")
+                violated.append(name)
+
+        if violated:
+            raise GOBException(f"Foreign key violations on {tablename}: {', '.join(violated)}")
+
+    def _restore_foreign_keys(self, connection: Connection, tablename: str) -> list[str]:
+        """Add the recorded deferred foreign keys of the table again as NOT VALID and remove the records.
+
+        :return: the names of the restored constraints
+        """
+        query = f"""
+DELETE FROM {self.DEFERRED_FOREIGN_KEYS_TABLE}
+WHERE tablename = :tablename
+RETURNING name, definition
+"""
+        rows = connection.execute(text(query), {"tablename": tablename}).all()
+
+        for name, definition in rows:
+            connection.execute(text(f'ALTER TABLE "{tablename}" ADD CONSTRAINT "{name}" {definition} NOT VALID'))
+
+        return [name for name, _ in rows]
+
+    def _lock_foreign_keys(self, connection: Connection, tablename: str, wait=True) -> bool:
+        params = {"lock": self.FOREIGN_KEYS_LOCK, "tablename": tablename}
+        function = "pg_advisory_lock" if wait else "pg_try_advisory_lock"
+        result = connection.execute(text(f"SELECT {function}(:lock, hashtext(:tablename))"), params).scalar()
+        return wait or bool(result)
+
+    def _unlock_foreign_keys(self, connection: Connection, tablename: str):
+        params = {"lock": self.FOREIGN_KEYS_LOCK, "tablename": tablename}
+        connection.execute(text("SELECT pg_advisory_unlock(:lock, hashtext(:tablename))"), params)
+
+    def restore_deferred_foreign_keys(self):
+        """Restore the foreign keys that have been dropped by an interrupted deferred_foreign_keys.
+
+        The constraints are added as NOT VALID and validated. Tables that are being applied are skipped,
+        their foreign keys are restored by the running apply.
+        """
+        query = f"SELECT DISTINCT tablename FROM {self.DEFERRED_FOREIGN_KEYS_TABLE}"
+
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_connection:
+            for tablename in lock_connection.execute(text(query)).scalars().all():
+                if not self._lock_foreign_keys(lock_connection, tablename, wait=False):
                     continue
 
-                columns = ','.join(definition['columns'])
-                index_type = self._get_index_type(definition.get('type'))
-                table = definition["table_name"]
-                statement = f'CREATE INDEX IF NOT EXISTS "{name}" ON {table} USING {index_type}({columns})'
+                try:
+                    with self.engine.begin() as connection:
+                        names = self._restore_foreign_keys(connection, tablename)
+                finally:
+                    self._unlock_foreign_keys(lock_connection, tablename)
+
+                print(f"Restored {len(names)} foreign keys on {tablename} of an interrupted apply")
+                try:
+                    self.validate_foreign_keys(names, tablename)
+                except GOBException as e:
+                    print(f"ERROR: {e}, the constraints remain NOT VALID")
+
+    @contextmanager
+    def deferred_foreign_keys(self):
+        """
+        Drops the foreign key constraints of the current collection table and restores them on leaving the context.
+
+        The constraints are restored as NOT VALID, they are enforced again for new rows but the existing rows are not
+        checked. When the context is left without errors the constraints are validated in one pass per constraint,
+        instead of a lookup in the referenced table for every inserted or updated row.
+
+        The dropped constraints are recorded in the same transaction, if the process is interrupted they are restored
+        on the next start (see restore_deferred_foreign_keys). The table is locked meanwhile, the constraints of a
+        table that is being applied are not restored.
+
+        Use this to apply large relation change sets.
+        """
+        record = f"""
+INSERT INTO {self.DEFERRED_FOREIGN_KEYS_TABLE} (tablename, name, definition)
+VALUES (:tablename, :name, :definition)
+"""
+
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_connection:
+            self._lock_foreign_keys(lock_connection, self.tablename)
+
+            try:
+                # constraints that have been left dropped by an interrupted apply are restored first
+                with self.engine.begin() as connection:
+                    self._restore_foreign_keys(connection, self.tablename)
 
-                if index_type == "GIST":
-                    # Create GIST index for valid geometries (used during spatial relate)
-                    statement += f" WHERE ST_IsValid({columns})"
+                foreign_keys = self.get_foreign_keys()
 
-                connection.execute(text(statement))
+                with self.engine.begin() as connection:
+                    for name, definition in foreign_keys.items():
+                        connection.execute(text(f'ALTER TABLE "{self.tablename}" DROP CONSTRAINT IF EXISTS "{name}"'))
+                        connection.execute(
+                            text(record), {"tablename": self.tablename, "name": name, "definition": definition}
+                        )
+
+                logger.info(f"Dropped {len(foreign_keys)} foreign keys on {self.tablename}, validating afterwards")
+
+                try:
+                    yield
+                finally:
+                    with self.engine.begin() as connection:
+                        self._restore_foreign_keys(connection, self.tablename)
+            finally:
+                self._unlock_foreign_keys(lock_connection, self.tablename)
+
+        self.validate_foreign_keys(foreign_keys)
+        logger.info(f"Validated {len(foreign_keys)} foreign keys on {self.tablename}")
 
     @with_session
     def create_temporary_table(self):
@@ -340,13 +808,15 @@ WHERE
             JSON.get_column_definition("_original_value")
         ]
 
-        table = Table(
-            self.tablename_temp,
-            self.base.metadata,
-            *columns,
-            implicit_returning=False,  # no returning on insert
-            prefixes=["TEMPORARY"]     # CREATE TEMPORARY TABLE <table>
-        )
+        # the metadata is shared with other threads
+        with self._reflection_lock:
+            table = Table(
+                self.tablename_temp,
+                self.base.metadata,
+                *columns,
+                implicit_returning=False,  # no returning on insert
+                prefixes=["TEMPORARY"]     # CREATE TEMPORARY TABLE <table>
+            )
         table.create(bind=self.session.bind)
 
     @with_session
@@ -452,12 +922,104 @@ WHERE
                 connection.invalidate()
 
                 # make sure temp table is removed from the (base) metadata class var
-                if self.metadata and self.tablename_temp in self.base.metadata.tables:
-                    self.base.metadata.remove(self.base.metadata.tables[self.tablename_temp])
+                with self._reflection_lock:
+                    if self.metadata and self.tablename_temp in self.base.metadata.tables:
+                        self.base.metadata.remove(self.base.metadata.tables[self.tablename_temp])
 
             session.close()
             self.session = None
 
+    @contextmanager
+    def get_prepared_session(self, transaction: PreparedTransaction) -> StreamSession:
+        """
+        Exposes a database session in the two-phase `transaction` as a managed context.
+        On leaving the context the session is flushed and the transaction is prepared, not committed.
+        The transaction is rolled back if an error occurs.
+
+        :param transaction: The two-phase transaction to prepare
+        """
+        session = self.Session(bind=transaction.connection)
+        self.session = session
+
+        try:
+            yield session
+            session.flush()
+            transaction.prepare()
+        except Exception as err:
+            logger.error(repr(err))
+            transaction.rollback()
+            raise
+        finally:
+            session.close()
+            self.session = None
+
+    def get_apply_xid(self, page: str, shard: Union[int, str]) -> str:
+        """Returns the id of the two-phase transaction for `shard` of `page` for the current collection and source."""
+        return f"{self.APPLY_XID_PREFIX}.{self.tablename}.{self.metadata.source}.{page}.{shard}"
+
+    @contextmanager
+    def apply_lock(self):
+        """Holds the advisory lock of the two-phase applies of the current collection and source, in all processes.
+
+        The lock is held while the prepared transactions are applied or recovered, the prepared transactions of a
+        running apply are never recovered.
+        """
+        params = {"lock": self.APPLY_LOCK, "name": f"{self.tablename}.{self.metadata.source}"}
+
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            connection.execute(text("SELECT pg_advisory_lock(:lock, hashtext(:name))"), params)
+            try:
+                yield
+            finally:
+                connection.execute(text("SELECT pg_advisory_unlock(:lock, hashtext(:name))"), params)
+
+    def add_commit_decision(self, page: str, applied_eventid: int):
+        """Records the decision to commit all prepared transactions for `page` of the current collection.
+
+        The applied eventid watermark is advanced to the last eventid of the page in the same transaction.
+        """
+        query = f"INSERT INTO {self.COMMIT_DECISIONS_TABLE} (xid) VALUES (:xid)"
+        with self.engine.begin() as connection:
+            connection.execute(text(query), {"xid": self.get_apply_xid(page, shard="")})
+            self.advance_applied_eventid(applied_eventid, connection)
+
+    def delete_commit_decision(self, page: str):
+        query = f"DELETE FROM {self.COMMIT_DECISIONS_TABLE} WHERE xid = :xid"
+        with self.engine.begin() as connection:
+            connection.execute(text(query), {"xid": self.get_apply_xid(page, shard="")})
+
+    def recover_prepared_transactions(self):
+        """Finishes the two-phase apply transactions of the current collection and source left by an interrupted apply.
+
+        Transactions of a page with a commit decision are committed, all other transactions are rolled back.
+        The entities are consistent with the events afterwards, so the highest entity eventid is a valid
+        point to resume applying events. Waits for a running apply of the collection and source to finish first.
+        """
+        query = "SELECT gid FROM pg_prepared_xacts WHERE database = current_database() AND gid ^@ :prefix"
+        prefix = self.get_apply_xid(page="", shard="")[:-1]
+
+        with (
+            self.apply_lock(),
+            self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection
+        ):
+            gids = connection.execute(text(query), {"prefix": prefix}).scalars().all()
+            if not gids:
+                return
+
+            decisions = connection.execute(
+                text(f"SELECT xid FROM {self.COMMIT_DECISIONS_TABLE} WHERE xid ^@ :prefix"), {"prefix": prefix}
+            ).scalars().all()
+
+            for gid in gids:
+                # the decision xid is the gid without the shard number
+                action = "COMMIT" if gid[:gid.rindex(".") + 1] in decisions else "ROLLBACK"
+                logger.warning(f"{action} PREPARED transaction {gid} of an interrupted apply")
+                connection.execute(text(f"{action} PREPARED '{gid}'"))
+
+            connection.execute(
+                text(f"DELETE FROM {self.COMMIT_DECISIONS_TABLE} WHERE xid ^@ :prefix"), {"prefix": prefix}
+            )
+
     def get_entity_max_eventid(self) -> int:
         """Get the highest last_event property of entity
 
@@ -474,9 +1036,11 @@ WHERE
             return conn.execute(query).scalar() or 0
 
     def get_last_eventid(self) -> int:
-        """Get the highest last_event property of entity
+        """Get the highest eventid of the current collection
 
-        :return: The highest last_event
+        Archived events are no longer in the events table, the last archived eventid is used if all are archived.
+
+        :return: The highest eventid
         """
         events = self.DbEvent
         query = (
@@ -488,35 +1052,164 @@ WHERE
             .limit(1)
         )
         with self.engine.connect() as conn:
-            return conn.execute(query).scalar() or 0
+            return conn.execute(query).scalar() or self.get_archived_eventid()
 
-    def get_events_starting_after(self, eventid: int, limit: int = 10_000) -> Sequence[DbEvent]:
+    def get_last_event_archive(self) -> Row | None:
+        """Get the last archive checkpoint of the current collection (see archive.py)
+
+        :return: the checkpoint, None if no events have been archived
         """
-        Return chunks of events with eventid starting at `eventid`.
-        Example with size=2: ([event1, event2], [event3, event4], [event5])
-        This process can take a long time for big collections, keep this in a seperate session.
-        Use pagination by eventid instead of streaming results to prevent locking the events table.
+        query = f"""
+SELECT archived_eventid, snapshot_eventid, events_file, snapshot_file
+FROM {self.EVENT_ARCHIVES_TABLE}
+WHERE catalogue = :catalogue AND entity = :entity AND source = :source
+ORDER BY archived_eventid DESC
+LIMIT 1
+"""
+        with self.engine.connect() as connection:
+            return connection.execute(text(query), self._collection_params()).first()
+
+    def get_archived_eventid(self) -> int:
+        """Get the highest archived eventid of the current collection (see archive.py)
 
-        :param eventid: minimal eventid (0 for all)
-        :param limit: limit returned result to this size
-        :return: Iterator containing lists of events
+        :return: The highest archived eventid, 0 if no events have been archived
         """
-        Event = self.DbEvent
-        stmt = (
-            select(Event)
-            .where(
-                Event.source == self.metadata.source,
-                Event.catalogue == self.metadata.catalogue,
-                Event.entity == self.metadata.entity,
-                Event.eventid > eventid
-            )
-            .order_by(Event.eventid.asc())
-            .limit(limit)
+        query = f"""
+SELECT max(archived_eventid)
+FROM {self.EVENT_ARCHIVES_TABLE}
+WHERE catalogue = :catalogue AND entity = :entity AND source = :source
+"""
+        with self.engine.connect() as connection:
+            return connection.execute(text(query), self._collection_params()).scalar() or 0
+
+    def _collection_params(self) -> dict[str, str]:
+        return {
+            "catalogue": self.metadata.catalogue,
+            "entity": self.metadata.entity,
+            "source": self.metadata.source,
+        }
+
+    def get_event_watermarks(self) -> tuple[int, int] | None:
+        """Get the highest applied eventid and the highest stored eventid of the current collection
+
+        :return: (applied eventid, last eventid), None if the watermarks have not been initialized
+        """
+        query = f"""
+SELECT applied_eventid, last_eventid
+FROM {self.EVENT_WATERMARKS_TABLE}
+WHERE catalogue = :catalogue AND entity = :entity AND source = :source
+"""
+        with self.engine.connect() as connection:
+            row = connection.execute(text(query), self._collection_params()).first()
+
+        return (row.applied_eventid, row.last_eventid) if row else None
+
+    def rebuild_event_watermarks(self, reset: bool = False) -> tuple[int, int]:
+        """Set the watermarks of the current collection to the eventids in the entity and events tables
+
+        The applied eventid is the last eventid that has been processed by an apply. Events that change no entity
+        (skipped or no-op events) advance it beyond the highest entity eventid, a stored applied eventid between the
+        highest entity eventid and the last eventid is therefore kept.
+
+        :param reset: set the applied eventid to the highest entity eventid, also if a higher one is stored,
+            eg after the table has been rebuilt (events applied to the old table are applied again)
+        :return: (applied eventid, last eventid)
+        """
+        applied_eventid = "EXCLUDED.applied_eventid" if reset else \
+            "GREATEST(EXCLUDED.applied_eventid, LEAST(w.applied_eventid, EXCLUDED.last_eventid))"
+
+        query = f"""
+INSERT INTO {self.EVENT_WATERMARKS_TABLE} AS w (catalogue, entity, source, applied_eventid, last_eventid)
+VALUES (:catalogue, :entity, :source, :applied_eventid, :last_eventid)
+ON CONFLICT (catalogue, entity, source) DO UPDATE SET
+    applied_eventid = {applied_eventid},
+    last_eventid = EXCLUDED.last_eventid
+RETURNING applied_eventid, last_eventid
+"""
+        params = self._collection_params() | {
+            "applied_eventid": self.get_entity_max_eventid(),
+            "last_eventid": self.get_last_eventid()
+        }
+        with self.engine.begin() as connection:
+            row = connection.execute(text(query), params).one()
+
+        return row.applied_eventid, row.last_eventid
+
+    def verify_event_watermarks(self, rebuild: bool = False) -> bool:
+        """Compare the watermarks of the current collection with the eventids in the entity and events tables
+
+        The watermarks are consistent if the last eventid is the highest eventid of the events and the applied
+        eventid lies between the highest entity eventid and the last eventid (see rebuild_event_watermarks).
+
+        :param rebuild: rebuild the watermarks if they are not consistent
+        :return: True if the watermarks are consistent
+        """
+        stored = self.get_event_watermarks()
+        entity_max_eventid, last_eventid = self.get_entity_max_eventid(), self.get_last_eventid()
+
+        if stored and stored[1] == last_eventid and entity_max_eventid <= stored[0] <= last_eventid:
+            return True
+
+        logger.warning(
+            f"Event watermarks of {self.tablename} {self.metadata.source} are {stored}, "
+            f"expected an applied eventid from {entity_max_eventid} to {last_eventid} and last eventid {last_eventid}"
         )
 
-        with StreamSession(self.engine) as session:
-            session.expire_on_commit = False  # allows getting object attributes after closing session
-            return session.scalars(stmt).all()
+        if rebuild:
+            self.rebuild_event_watermarks()
+
+        return False
+
+    def get_event_watermark_collections(self) -> Sequence[Row]:
+        """Get the catalogue, entity and source of all collections with event watermarks."""
+        query = f"SELECT catalogue, entity, source FROM {self.EVENT_WATERMARKS_TABLE} ORDER BY 1, 2, 3"
+        with self.engine.connect() as connection:
+            return connection.execute(text(query)).all()
+
+    def advance_applied_eventid(self, eventid: int, connection: Connection | None = None):
+        """Raise the applied eventid watermark of the current collection to `eventid`
+
+        :param eventid: the id of the last processed event, including events that changed no entity
+        :param connection: the connection of the transaction that applied the event, default the current session
+        """
+        query = f"""
+UPDATE {self.EVENT_WATERMARKS_TABLE}
+SET applied_eventid = GREATEST(applied_eventid, :eventid)
+WHERE catalogue = :catalogue AND entity = :entity AND source = :source
+"""
+        (connection or self.session).execute(text(query), self._collection_params() | {"eventid": eventid})
+
+    def count_events_after(self, eventid: int) -> int:
+        """Count the events of the current collection with an eventid greater than `eventid`
+
+        :return: The number of events
+        """
+        events = self.DbEvent
+        query = (
+            select(func.count())
+            .where(events.source == self.metadata.source)
+            .where(events.catalogue == self.metadata.catalogue)
+            .where(events.entity == self.metadata.entity)
+            .where(events.eventid > eventid)
+        )
+        with self.engine.connect() as conn:
+            return conn.execute(query).scalar()
+
+    def get_table_size_estimate(self) -> int:
+        """Get the estimated number of rows in the current collection table
+
+        The rows are counted if the table has no estimate, it has never been analyzed or is empty.
+
+        :return: The estimated number of rows
+        """
+        query = f"SELECT reltuples FROM pg_class WHERE oid = '{self.tablename}'::regclass"
+        estimate = int(self.get_query_value(query) or 0)
+
+        # -1 if never analyzed, 0 before PostgreSQL 14
+        if estimate > 0:
+            return estimate
+
+        return self.get_query_value(f'SELECT COUNT(*) FROM "{self.tablename}"')
 
     def has_any_event(self, filter_: dict) -> bool:
         """True if any event matches the filter condition
@@ -547,6 +1240,18 @@ WHERE
         with self.engine.connect() as connection:
             return connection.execute(query).first() is not None
 
+    def _get_collection_fields(self) -> tuple[dict, dict]:
+        """Returns the fields and the GOB types of the fields of the current collection, from the registry."""
+        key = (self.metadata.catalogue, self.metadata.entity)
+
+        with self._reflection_lock:
+            if key not in self._collection_fields:
+                fields = self.get_collection_model()["all_fields"]
+                field_types = {field: get_gob_type(fields[field]["type"]) for field in fields}
+                self._collection_fields[key] = fields, field_types
+
+            return self._collection_fields[key]
+
     def get_collection_model(self) -> dict | None:
         if self.metadata.catalogue in gob_model:
             return gob_model[self.metadata.catalogue]['collections'].get(self.metadata.entity)
@@ -673,12 +1378,21 @@ WHERE
         return self.session.scalars(query).all()
 
     @with_session
-    def add_add_events(self, events):
-        # make sure _tid is filled from events.tid, not always present in event.contents
-        rows = [event.get_attribute_dict() | {"_last_event": event.id, "_tid": event.tid} for event in events]
+    def add_entities(self, rows: list[dict[str, Any]]):
+        """
+        Bulk insert the given entity rows, columns that are missing in a row are inserted as NULL
+
+        :param rows: the column values of the entities to insert
+        :return: None
+        """
+        columns = dict.fromkeys(key for row in rows for key in row)
 
         # invoke bulk insert through the Table object, not the mapped class
-        self.session.execute(self.DbEntity.__table__.insert(), rows)
+        self.session.execute(self.DbEntity.__table__.insert(), [dict.fromkeys(columns) | row for row in rows])
+
+    def get_event_partition(self) -> str:
+        """Returns the name of the events (source) partition of the current collection, it is created if needed."""
+        return self.event_partitions.get(self.metadata.catalogue, self.metadata.entity, self.metadata.source)
 
     @with_session
     def add_events(self, events: list[dict[str, Any]]):
@@ -707,8 +1421,11 @@ WHERE
         entity = self.metadata.entity
         application = self.metadata.application
 
+        # insert into the source partition directly instead of routing every event by insertIntoEvents
+        partition = self.get_event_partition()
+
         quoted_cols = ", ".join(f'"{c}"' for c in columns)
-        sql = f"INSERT INTO {self.EVENTS_TABLE} ({quoted_cols}) VALUES %s"
+        sql = f"INSERT INTO {partition} (eventid, {quoted_cols}) VALUES %s"
         argslist = (
             (
                 # should match column order events table
@@ -727,36 +1444,133 @@ WHERE
         )
 
         # explicitly cast values to prevent infering JSON using to_json
-        template = "(" + ", ".join([f'%s::{typ}' for typ in columns.values()]) + ")"
+        template = f"(nextval('{self.event_partitions.sequence}'), " + \
+                   ", ".join([f'%s::{typ}' for typ in columns.values()]) + ")"
+
+        # eventids are increasing, currval is the highest eventid that has been inserted in this session
+        watermark = f"""
+UPDATE {self.EVENT_WATERMARKS_TABLE}
+SET last_eventid = GREATEST(last_eventid, currval('{self.event_partitions.sequence}'))
+WHERE catalogue = %(catalogue)s AND entity = %(entity)s AND source = %(source)s
+"""
 
         with self.session.bind.connection.cursor() as cur:
             execute_values(cur, sql, argslist, template, page_size=2_000, fetch=False)
 
+            if events:
+                cur.execute(watermark, self._collection_params())
+
     @with_session
-    def apply_confirms(self, confirms: list[dict], timestamp: str):
+    def _stage_confirms(self, tids: Iterable[str]) -> str:
+        """Copy the confirmed tids into a temporary table in one stream, returns the name of the table."""
+        staged = f"tmp_confirms_{random_string(8)}"
+
+        self.session.execute(text(f"CREATE TEMPORARY TABLE {staged} ({FIELD.TID} varchar) ON COMMIT DROP"))
+
+        with self.session.bind.connection.cursor() as cur:
+            cur.copy_expert(f"COPY {staged} ({FIELD.TID}) FROM STDIN WITH (FORMAT csv)", CopyStream(tids))
+
+        self.session.execute(text(f"ANALYZE {staged}"))
+        return staged
+
+    @with_session
+    def apply_confirms_staged(self, tids: Iterable[str], timestamp: str) -> int:
         """
-        Apply a (BULK)CONFIRM event
+        Apply all (BULK)CONFIRM events at once
 
-        :param confirms: list of confirm data
+        The tids are copied into a temporary table in one stream and applied in a single update.
+        Only entities for which the last confirmed timestamp changes are updated.
+
+        :param tids: ids of the confirmed entities
         :param timestamp: Time to set as last_confirmed
-        :return:
+        :return: the number of updated entities
         """
-        timestamp_dt = datetime.datetime.fromisoformat(timestamp)
-        col_confirm = getattr(self.DbEntity, CONFIRM.timestamp_field)
-        values_tid = \
-            values(column("_tid", String), name="tids") \
-            .data([(record["_tid"],) for record in confirms])
+        staged = self._stage_confirms(tids)
+        col_confirm = CONFIRM.timestamp_field
+
+        query = f"""
+UPDATE {self.tablename} AS entity
+SET {col_confirm} = :timestamp
+FROM {staged}
+WHERE entity.{FIELD.TID} = {staged}.{FIELD.TID} AND entity.{col_confirm} IS DISTINCT FROM :timestamp
+"""
+        result = self.session.execute(text(query), {"timestamp": datetime.datetime.fromisoformat(timestamp)})
+        return result.rowcount
 
-        stmt = (
-            update(self.DbEntity)
-            .where(
-                self.DbEntity._tid == values_tid.c._tid,
-                col_confirm != timestamp_dt
-            )
-            .values({col_confirm: timestamp_dt})
-            .execution_options(synchronize_session=False)
-        )
-        self.session.execute(stmt)
+    @with_session
+    def apply_confirm_all(self, timestamp: str) -> int:
+        """
+        Confirm all current entities of the source in a single update
+
+        :param timestamp: Time to set as last_confirmed
+        :return: the number of updated entities
+        """
+        col_confirm = CONFIRM.timestamp_field
+
+        query = f"""
+UPDATE {self.tablename}
+SET {col_confirm} = :timestamp
+WHERE {FIELD.SOURCE} = :source AND {FIELD.DATE_DELETED} IS NULL AND {col_confirm} IS DISTINCT FROM :timestamp
+"""
+        params = {"source": self.metadata.source, "timestamp": datetime.datetime.fromisoformat(timestamp)}
+        return self.session.execute(text(query), params).rowcount
+
+    def get_upload_fingerprint(self, application: str) -> str | None:
+        """
+        Get the fingerprint of the last applied upload of the current collection by `application`
+
+        The fingerprint is only returned if no events have been added since the upload was applied.
+
+        :param application: the application of the upload
+        :return: the fingerprint or None
+        """
+        query = f"""
+SELECT fingerprint, last_eventid
+FROM {self.UPLOAD_FINGERPRINTS_TABLE}
+WHERE catalogue = :catalogue AND entity = :entity AND source = :source AND application = :application
+"""
+        params = {
+            "catalogue": self.metadata.catalogue,
+            "entity": self.metadata.entity,
+            "source": self.metadata.source,
+            "application": application
+        }
+        with self.engine.connect() as connection:
+            row = connection.execute(text(query), params).first()
+
+        if row and row.last_eventid == self._get_watermark_last_eventid():
+            return row.fingerprint
+
+    def save_upload_fingerprint(self, application: str, fingerprint: str):
+        """
+        Save the fingerprint of an applied upload of the current collection by `application`
+
+        :param application: the application of the upload
+        :param fingerprint: the fingerprint of the upload
+        """
+        query = f"""
+INSERT INTO {self.UPLOAD_FINGERPRINTS_TABLE} (catalogue, entity, source, application, fingerprint, last_eventid)
+VALUES (:catalogue, :entity, :source, :application, :fingerprint, :last_eventid)
+ON CONFLICT (catalogue, entity, source, application) DO UPDATE SET
+    fingerprint = EXCLUDED.fingerprint,
+    last_eventid = EXCLUDED.last_eventid,
+    "timestamp" = now()
+"""
+        params = {
+            "catalogue": self.metadata.catalogue,
+            "entity": self.metadata.entity,
+            "source": self.metadata.source,
+            "application": application,
+            "fingerprint": fingerprint,
+            "last_eventid": self._get_watermark_last_eventid()
+        }
+        with self.engine.begin() as connection:
+            connection.execute(text(query), params)
+
+    def _get_watermark_last_eventid(self) -> int:
+        """Get the last eventid of the current collection from the event watermarks."""
+        watermarks = self.get_event_watermarks() or self.rebuild_event_watermarks()
+        return watermarks[1]
 
     def get_query_value(self, query: str) -> Any:
         """Execute a query and return the result value
@@ -772,20 +1586,47 @@ WHERE
     def get_source_catalogue_entity_combinations(
         self, catalogue: str, entity: str, source: str = ""
     ) -> Iterator[Row]:
-        """Return all unique source / catalogue / entity combinations."""
-        # ^@ == startswith
-        query = "SELECT tablename FROM pg_tables WHERE schemaname = :events AND tablename ^@ LOWER(:table)"
-        params = {"events": self.EVENTS_TABLE, "table": f"{catalogue}_{entity}_{source}"}
+        """Return all unique source / catalogue / entity combinations, from the event partition registry."""
+        filters = {
+            "catalogue": "catalogue = :catalogue",
+            "entity": "entity = :entity",
+            "source": "lower(source) = lower(:source)"
+        }
+        params = {"catalogue": catalogue, "entity": entity, "source": source}
+        where = " AND ".join(condition for name, condition in filters.items() if params[name]) or "TRUE"
+
+        query = f"SELECT catalogue, entity, source FROM {self.EVENT_PARTITIONS_TABLE} WHERE {where} ORDER BY 1, 2, 3"
 
         with self.engine.connect() as conn:
-            for table in conn.execute(text(query), params).scalars():
-                row_qry = f"SELECT catalogue, entity, source FROM {self.EVENTS_TABLE}.{table} LIMIT 1"
-                yield from conn.execute(text(row_qry))
+            yield from conn.execute(text(query), params)
+
+    def backfill_event_partitions(self) -> int:
+        """Register the existing event partitions in the partition registry.
+
+        :return: the number of registered partitions
+        """
+        with self.engine.begin() as connection:
+            connection.execute(text(queries.get_backfill_event_partitions_query(
+                self.EVENTS_TABLE, self.EVENT_PARTITIONS_TABLE
+            )))
+
+        return self.get_query_value(f"SELECT COUNT(*) FROM {self.EVENT_PARTITIONS_TABLE}")
+
+    def get_table_statistics(self) -> Row | None:
+        """Returns the number of live, dead and modified (since the last analyze) rows of the table."""
+        query = f"""
+SELECT n_live_tup, n_dead_tup, n_mod_since_analyze
+FROM pg_stat_user_tables
+WHERE relid = '"{self.tablename}"'::regclass
+"""
+        with self.engine.connect() as connection:
+            return connection.execute(text(query)).one_or_none()
 
-    def analyze_table(self):
-        """Runs VACUUM ANALYZE on table
+    def analyze_table(self, vacuum: bool = True):
+        """Runs VACUUM ANALYZE on table, or only ANALYZE if `vacuum` is False
 
         :return:
         """
+        command = "VACUUM ANALYZE" if vacuum else "ANALYZE"
         with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
-            connection.execute(text(f"VACUUM ANALYZE {self.tablename}"))
+            connection.execute(text(f"{command} {self.tablename}"))
@@ -0,0 +1,197 @@
+"""
+Index builder
+
+Creates the missing managed indexes (see gobcore.model.sa.indexes.get_indexes) with CREATE INDEX CONCURRENTLY,
+which does not block writes to the table. The indexes are created by a small pool of workers, each with its own
+autocommit connection (CREATE INDEX CONCURRENTLY can not run inside a transaction).
+
+A concurrent build that fails or is interrupted leaves an invalid index behind (pg_index.indisvalid = false).
+Invalid indexes are dropped (concurrently) and built again.
+
+Only one builder runs at a time, builders of other processes wait for an advisory lock. The builder can run in
+the background, the progress is available by IndexBuilder.progress and in pg_stat_progress_create_index.
+
+Usage:
+
+    builder = IndexBuilder(storage_handler, get_indexes(gob_model), workers=2)
+    builder.build()     # or builder.start() to build in the background
+
+"""
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable
+
+from sqlalchemy import text, exc as sa_exc
+from sqlalchemy.engine import Connection
+
+from gobcore.exceptions import GOBException
+
+INDEX_LOCK = 19935911
+
+
+@dataclass
+class IndexBuildProgress:
+    total: int = 0
+    created: list[str] = field(default_factory=list)
+    failed: list[str] = field(default_factory=list)
+    building: list[str] = field(default_factory=list)
+    finished: bool = False
+
+    @property
+    def done(self) -> int:
+        return len(self.created) + len(self.failed)
+
+
+class IndexBuilder:
+
+    def __init__(self, storage_handler, indexes: dict[str, dict], workers: int = 1):
+        """
+        :param storage_handler: the storage handler, used for its engine and index statements
+        :param indexes: the index definitions by name, as returned by get_indexes
+        :param workers: the number of indexes that are created at the same time
+        """
+        self.storage_handler = storage_handler
+        self.indexes = indexes
+        self.workers = max(workers, 1)
+
+        self._lock = threading.Lock()
+        self._progress = IndexBuildProgress()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def progress(self) -> IndexBuildProgress:
+        """Returns a copy of the progress of the build."""
+        with self._lock:
+            return IndexBuildProgress(
+                total=self._progress.total,
+                created=list(self._progress.created),
+                failed=list(self._progress.failed),
+                building=list(self._progress.building),
+                finished=self._progress.finished
+            )
+
+    def _connect(self) -> Connection:
+        return self.storage_handler.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+
+    def _get_pending(self, connection: Connection) -> tuple[list[str], set[str]]:
+        """Returns the names of the indexes to build and the names of the invalid ones among them."""
+        query = """
+SELECT c.relname, i.indisvalid
+FROM pg_catalog.pg_index i
+JOIN pg_catalog.pg_class c ON c.oid = i.indexrelid
+WHERE c.relname = ANY(:names)
+"""
+        existing = dict(connection.execute(text(query), {"names": list(self.indexes)}).all())
+        pending = [name for name in self.indexes if not existing.get(name, False)]
+        invalid = {name for name in pending if name in existing}
+        return pending, invalid
+
+    def _build_index(self, connection: Connection, name: str, invalid: bool):
+        if invalid:
+            # IF NOT EXISTS would skip the invalid leftover of an earlier build
+            connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+
+        statement = self.storage_handler._create_index_statement(name, self.indexes[name], concurrently=True)
+        connection.execute(text(statement))
+
+    def _worker(self, names: queue.SimpleQueue, invalid: set[str]):
+        with self._connect() as connection:
+            while True:
+                try:
+                    name = names.get_nowait()
+                except queue.Empty:
+                    return
+
+                with self._lock:
+                    self._progress.building.append(name)
+
+                start = time.perf_counter()
+                try:
+                    self._build_index(connection, name, name in invalid)
+                except sa_exc.SQLAlchemyError as e:
+                    result = self._progress.failed
+                    print(f"ERROR: Failed to create index {name}: {e}")
+                else:
+                    result = self._progress.created
+
+                with self._lock:
+                    self._progress.building.remove(name)
+                    result.append(name)
+                    done, total = self._progress.done, self._progress.total
+
+                print(f"{'Rebuilt' if name in invalid else 'Created'} index {name} "
+                      f"in {time.perf_counter() - start:.1f}s ({done}/{total})")
+
+    def build(self) -> IndexBuildProgress:
+        """Create the missing and invalid indexes, waits for a builder of another process to finish first.
+
+        :return: the progress of the finished build
+        """
+        with self._connect() as connection:
+            connection.execute(text("SELECT pg_advisory_lock(:lock)"), {"lock": INDEX_LOCK})
+
+            try:
+                pending, invalid = self._get_pending(connection)
+
+                with self._lock:
+                    self._progress.total = len(pending)
+
+                if invalid:
+                    print(f"Rebuilding {len(invalid)} invalid indexes: {', '.join(sorted(invalid))}")
+
+                names = queue.SimpleQueue()
+                for name in pending:
+                    names.put(name)
+
+                workers = min(self.workers, len(pending)) or 1
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="index_builder") as executor:
+                    futures = [executor.submit(self._worker, names, invalid) for _ in range(workers)]
+
+                for future in futures:
+                    # raises the first exception, if any
+                    future.result()
+            finally:
+                connection.execute(text("SELECT pg_advisory_unlock(:lock)"), {"lock": INDEX_LOCK})
+
+        with self._lock:
+            self._progress.finished = True
+
+        progress = self.progress
+        if progress.failed:
+            raise GOBException(f"Failed to create indexes: {', '.join(progress.failed)}")
+
+        print(f"Created {len(progress.created)} indexes")
+        return progress
+
+    def _run(self, on_complete: Callable[[], None] | None):
+        try:
+            self.build()
+        except Exception as e:
+            print(f"ERROR: Index build failed, the indexes are built again on the next start: {e}")
+        else:
+            if on_complete:
+                on_complete()
+
+    def start(self, on_complete: Callable[[], None] | None = None) -> threading.Thread:
+        """Build the indexes in a background thread.
+
+        :param on_complete: called when all indexes have been built successfully
+        :return: the thread that builds the indexes
+        """
+        self._thread = threading.Thread(target=self._run, args=(on_complete,), name="index_builder", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Wait for the background build to finish.
+
+        :return: True if the build has finished
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.progress.finished
@@ -0,0 +1,239 @@
+"""
+SQL instrumentation
+
+Records the duration and the number of rows of the SQL statements of a job, to find the statements that make a
+compare, update, apply or relate slow. The instrumentation is opt-in (SQL_INSTRUMENTATION), when enabled it listens
+to the cursor events of the engine of the storage handler, which is used by the sessions (StreamSession) as well.
+
+A job is traced by decorating its function with `instrumented`. Every statement of the job is recorded with:
+
+- the fingerprint of the statement, the statement without literals, with IN lists collapsed and without the random
+  suffix of temporary table names, so the executions of the same statement with other values are aggregated
+- the duration in seconds and the number of rows (the cursor rowcount, None if unknown)
+- the step of the job, eg "apply/gebieden buurten" or "relate/chunk 3" (see `step`)
+
+The totals and the top SQL_TOP_STATEMENTS statements by duration are added to the summary of the result message
+of the job (summary["sql"]). Every execution is written to SQL_TRACE_FILE (JSON lines), if set.
+
+The trace and step of a job are context variables. Worker threads do not inherit them, a function that runs in a
+worker thread is traced when it is wrapped by `in_context`. Statements that bypass SQLAlchemy, eg COPY or
+execute_values on the raw psycopg2 cursor, are not recorded.
+
+Usage:
+
+    @instrumented("apply")
+    def apply(msg):
+        ...
+        with step("gebieden buurten"):
+            ...
+
+"""
+from __future__ import annotations
+
+import contextvars
+import datetime
+import functools
+import hashlib
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Iterator, TextIO
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from gobupload.config import SQL_TOP_STATEMENTS, SQL_TRACE_FILE
+
+# The maximum length of the statement in the summary
+STATEMENT_LENGTH = 200
+
+# temporary tables are named tmp_<name>_<random string of 8> (see random_string)
+_TEMPORARY_TABLES = re.compile(r"\b(tmp_\w+_)[a-z0-9]{8}\b")
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize(statement: str) -> str:
+    """Returns the statement without literals and temporary table suffixes, with IN lists collapsed."""
+    statement = _TEMPORARY_TABLES.sub(r"\1?", statement)
+    statement = _LITERALS.sub("?", statement)
+    statement = _IN_LISTS.sub("IN (?)", statement)
+    return _WHITESPACE.sub(" ", statement).strip()
+
+
+def fingerprint(statement: str) -> str:
+    """Returns the fingerprint of the normalised statement."""
+    return hashlib.sha1(statement.encode()).hexdigest()[:12]
+
+
+@dataclass
+class StatementStats:
+    statement: str
+    calls: int = 0
+    duration: float = 0.0
+    rows: int = 0
+
+
+class SQLTrace:
+    """The statements of a job, aggregated by fingerprint and step."""
+
+    def __init__(self, name: str, jobid: Any = None, file: TextIO | None = None):
+        """
+        :param name: the name of the job, the step of statements outside any other step
+        :param jobid: the id of the job, written to the trace file
+        :param file: the trace file, every execution is written to this file
+        """
+        self.name = name
+        self.jobid = jobid
+        self.file = file
+
+        self._lock = threading.Lock()
+        self._statements: dict[tuple[str, str], StatementStats] = {}
+
+    def record(self, statement: str, step: str, duration: float, rows: int | None, executemany: bool = False):
+        normalized = normalize(statement)
+        key = fingerprint(normalized), step
+
+        with self._lock:
+            stats = self._statements.setdefault(key, StatementStats(normalized))
+            stats.calls += 1
+            stats.duration += duration
+            stats.rows += rows or 0
+
+            if self.file is not None:
+                self.file.write(json.dumps({
+                    "timestamp": datetime.datetime.now().isoformat(),
+                    "job": self.name,
+                    "jobid": self.jobid,
+                    "step": step,
+                    "fingerprint": key[0],
+                    "duration": duration,
+                    "rows": rows,
+                    "executemany": executemany,
+                    "statement": normalized,
+                }) + "\n")
+
+    def summary(self, top: int = SQL_TOP_STATEMENTS) -> dict:
+        """Returns the totals and the `top` statements by duration."""
+        with self._lock:
+            statements = sorted(self._statements.items(), key=lambda item: item[1].duration, reverse=True)
+
+        return {
+            "statements": sum(stats.calls for _, stats in statements),
+            "duration": round(sum(stats.duration for _, stats in statements), 3),
+            "rows": sum(stats.rows for _, stats in statements),
+            "top": [
+                {
+                    "fingerprint": key,
+                    "step": step,
+                    "calls": stats.calls,
+                    "duration": round(stats.duration, 3),
+                    "rows": stats.rows,
+                    "statement": stats.statement[:STATEMENT_LENGTH],
+                }
+                for (key, step), stats in statements[:top]
+            ]
+        }
+
+
+_trace: contextvars.ContextVar[SQLTrace | None] = contextvars.ContextVar("sql_trace", default=None)
+_step: contextvars.ContextVar[str | None] = contextvars.ContextVar("sql_step", default=None)
+
+
+class SQLInstrumentation:
+
+    def __init__(self, trace_file: str | Path | None = None):
+        """
+        :param trace_file: the JSON lines file the executions are appended to, None for no trace file
+        """
+        self.trace_file = Path(trace_file) if trace_file else None
+        self.enabled = False
+
+    def install(self, engine: Engine):
+        """Listen to the cursor events of the engine, the statements of traced jobs are recorded from now on."""
+        if not event.contains(engine, "before_cursor_execute", self._before_cursor_execute):
+            event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        self.enabled = True
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @staticmethod
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info["query_start"].pop()
+
+        if (trace := _trace.get()) is not None:
+            rows = cursor.rowcount if cursor.rowcount >= 0 else None
+            trace.record(statement, _step.get() or trace.name, duration, rows, executemany)
+
+    @contextmanager
+    def trace(self, name: str, jobid: Any = None) -> Iterator[SQLTrace | None]:
+        """Trace the statements of a job, yields None when the instrumentation is not enabled."""
+        if not self.enabled:
+            yield None
+            return
+
+        file = open(self.trace_file, "a") if self.trace_file else None
+        trace = SQLTrace(name, jobid, file)
+        token = _trace.set(trace)
+        step_token = _step.set(name)
+
+        try:
+            yield trace
+        finally:
+            _step.reset(step_token)
+            _trace.reset(token)
+            if file is not None:
+                file.close()
+
+
+sql_instrumentation = SQLInstrumentation(SQL_TRACE_FILE)
+
+
+@contextmanager
+def step(name: str):
+    """The statements within are recorded with the step, nested in the current step."""
+    parent = _step.get()
+    token = _step.set(f"{parent}/{name}" if parent else name)
+    try:
+        yield
+    finally:
+        _step.reset(token)
+
+
+def in_context(func: Callable) -> Callable:
+    """Returns func that runs in (a copy of) the current context, to trace func in a worker thread."""
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # a context can be entered by one thread at a time
+        return context.copy().run(func, *args, **kwargs)
+
+    return wrapper
+
+
+def instrumented(name: str) -> Callable:
+    """Trace the job function, the SQL summary is added to the summary of the result message."""
+    def decorator(func: Callable[[dict], dict]) -> Callable[[dict], dict]:
+        @functools.wraps(func)
+        def wrapper(msg: dict, *args, **kwargs) -> dict:
+            jobid = msg.get("header", {}).get("jobid")
+
+            with sql_instrumentation.trace(name, jobid) as trace:
+                result = func(msg, *args, **kwargs)
+
+            if trace is not None and isinstance(result, dict) and isinstance(result.get("summary"), dict):
+                result["summary"]["sql"] = trace.summary()
+            return result
+
+        return wrapper
+
+    return decorator
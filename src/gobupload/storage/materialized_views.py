@@ -20,6 +20,25 @@ bronwaarde
 
 Also, two indexes are created on the materialized views: One on the src_id column, the other on the dst_id column.
 
+Lazy mode (MV_LAZY):
+Missing views are not created on initialisation but on their first refresh, views that are recreated are dropped.
+
+Refresh:
+The last event of the relation table is recorded at every refresh (materialized_view_refreshes). A refresh is
+skipped when the relation table has not changed since, else the view is refreshed concurrently, backed by the
+unique index on _gobid, so that readers of the view are not blocked.
+
+Incremental mode (MV_INCREMENTAL):
+The mv_ objects are regular tables instead of materialized views, with a unique index on _gobid and the _last_event
+of the relation. Apply maintains the table when the events of the relation have been applied, only the relations
+with a _last_event after the watermark of their source are upserted or deleted. The watermark of a source
+(materialized_view_watermarks) is the applied eventid of the relation collection (event_watermarks), a source with
+a running or interrupted two-phase apply is skipped until its entities have been committed. Relations that are
+committed late, with a lower _last_event than relations of other sources, are therefore never skipped.
+Refreshing applies the changes as well.
+The table can be compared with a full recompute of the view with verify (python -m gobupload
+verify_materialized_views).
+
 Initialisation:
 mv = MaterializedViews()
 mv.initialise(storage_handler)
@@ -27,12 +46,17 @@ mv.initialise(storage_handler)
 Update materialized view for catalog, collection, attribute
 """
 
-from typing import Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Sequence, Union
+
+from sqlalchemy import text
+from sqlalchemy.engine import Row
 
 from gobcore.model.metadata import FIELD
 from gobcore.model import relations as model_relations
 
 from gobupload import gob_model
+from gobupload.config import MV_INCREMENTAL, MV_LAZY
 
 
 class MaterializedView:
@@ -55,11 +79,69 @@ class MaterializedView:
 
         self.attribute_name = split[4:]
 
-    def refresh(self, storage_handler):
-        query = f"REFRESH MATERIALIZED VIEW {self.name}"
-        storage_handler.execute(query)
+        # Maintained as a regular table by apply instead of a materialized view
+        self.incremental = MV_INCREMENTAL
 
-    def create(self, storage_handler, force_recreate=False):
+        # Created on the first refresh if missing
+        self.lazy = MV_LAZY
+
+    @property
+    def kind(self) -> str:
+        """The kind of relation (pg_class.relkind), a table in incremental mode or else a materialized view."""
+        return "r" if self.incremental else "m"
+
+    def exists(self, storage_handler) -> bool:
+        return MaterializedViews.get_kind(storage_handler, self.name) is not None
+
+    def _record_refresh(self, connection, storage_handler, last_event: int):
+        # the refresh is recorded with the start time of the transaction (now())
+        query = f"""
+INSERT INTO {storage_handler.MATERIALIZED_VIEW_REFRESHES_TABLE} (name, last_event, timestamp)
+VALUES (:name, :last_event, now())
+ON CONFLICT (name) DO UPDATE SET last_event = EXCLUDED.last_event, timestamp = EXCLUDED.timestamp
+"""
+        connection.execute(text(query), {"name": self.name, "last_event": last_event})
+
+    def refresh(self, storage_handler, force=False) -> bool:
+        """Refresh the view if the relation table has changed since the last refresh
+
+        :param force: refresh also if the relation table has not changed
+        :return: False if the refresh has been skipped
+        """
+        # read before the refresh, changes that are committed meanwhile are refreshed (again) the next time
+        def get_last_event() -> int:
+            return storage_handler.get_query_value(
+                f"SELECT COALESCE(MAX({FIELD.LAST_EVENT}), 0) FROM {self.relation_table_name}"
+            )
+
+        if self.lazy and not self.exists(storage_handler):
+            # lazy mode, the view is created on its first refresh
+            last_event = get_last_event()
+            self.create(storage_handler)
+
+            if not self.incremental:
+                with storage_handler.engine.begin() as connection:
+                    self._record_refresh(connection, storage_handler, last_event)
+            return True
+
+        if self.incremental:
+            return self.apply_changes(storage_handler) > 0
+
+        last_event = get_last_event()
+        refreshed = storage_handler.get_query_value(
+            f"SELECT last_event FROM {storage_handler.MATERIALIZED_VIEW_REFRESHES_TABLE} WHERE name = '{self.name}'"
+        )
+
+        if last_event == refreshed and not force:
+            return False
+
+        # the refresh is recorded in the same transaction
+        with storage_handler.engine.begin() as connection:
+            connection.execute(text(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {self.name}"))
+            self._record_refresh(connection, storage_handler, last_event)
+        return True
+
+    def _columns(self) -> list[str]:
         include_columns = {
             FIELD.GOBID: True,
             f"src{FIELD.ID}": True,
@@ -71,19 +153,21 @@ class MaterializedView:
             FIELD.SOURCE_VALUE: True,
         }
 
-        fields = ','.join([field for field, include in include_columns.items() if include])
+        return [field for field, include in include_columns.items() if include]
 
-        if force_recreate:
-            storage_handler.execute(f"DROP MATERIALIZED VIEW IF EXISTS {self.name} CASCADE")
+    def _query(self) -> str:
+        fields = ','.join(self._columns())
 
-        query = \
+        if self.incremental:
+            return \
+                f"CREATE TABLE IF NOT EXISTS {self.name} AS SELECT {fields},{FIELD.LAST_EVENT} " \
+                f"FROM {self.relation_table_name} WHERE {FIELD.DATE_DELETED} IS NULL"
+
+        return \
             f"CREATE MATERIALIZED VIEW IF NOT EXISTS {self.name} AS SELECT {fields} " \
             f"FROM {self.relation_table_name} WHERE {FIELD.DATE_DELETED} IS NULL"
-        storage_handler.execute(query)
 
-        self._create_indexes(storage_handler, force_recreate)
-
-    def _create_indexes(self, storage_handler, force_recreate=False):
+    def _indexes(self) -> dict[str, list[str]]:
         indexes = {
             f"src_id_{self.name}": [f"src{FIELD.ID}"],
             f"dst_id_{self.name}": [f"dst{FIELD.ID}"],
@@ -98,29 +182,210 @@ class MaterializedView:
         }
         indexes[f"src_dst_wide_{self.name}"] = [field for field, include in wide_index.items() if include]
 
-        for index_name, columns in indexes.items():
-            if force_recreate:
+        if self.incremental:
+            indexes[f"last_event_{self.name}"] = [FIELD.LAST_EVENT]
+        return indexes
+
+    def _is_unique_index(self, index_name: str) -> bool:
+        # required to refresh concurrently, the table is upserted by _gobid in incremental mode
+        return index_name == f"gobid_{self.name}"
+
+    def get_definition(self) -> dict:
+        """Returns the query and the indexes of the materialized view, a change requires to recreate it."""
+        return {
+            "query": self._query(),
+            "indexes": self._indexes(),
+            "unique_indexes": [name for name in self._indexes() if self._is_unique_index(name)],
+        }
+
+    def create(self, storage_handler, force_recreate=False):
+        kind = MaterializedViews.get_kind(storage_handler, self.name)
+
+        if force_recreate or kind not in (None, self.kind):
+            MaterializedViews.drop(storage_handler, self.name, kind)
+
+        storage_handler.execute(self._query())
+
+        self._create_indexes(storage_handler, force_recreate)
+
+    def _is_non_unique_index(self, storage_handler, index_name: str) -> bool:
+        return bool(storage_handler.get_query_value(
+            f"SELECT NOT indisunique FROM pg_catalog.pg_index WHERE indexrelid = to_regclass('{index_name}')"
+        ))
+
+    def _create_indexes(self, storage_handler, force_recreate=False):
+        for index_name, columns in self._indexes().items():
+            unique = self._is_unique_index(index_name)
+
+            # views that have been created before the index was unique
+            if force_recreate or (unique and self._is_non_unique_index(storage_handler, index_name)):
                 storage_handler.execute(f"DROP INDEX IF EXISTS {index_name}")
 
-            query = f"CREATE INDEX IF NOT EXISTS {index_name} ON {self.name}({','.join(columns)})"
+            query = \
+                f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {index_name} " \
+                f"ON {self.name}({','.join(columns)})"
             storage_handler.execute(query)
 
+    def _get_committed_sources(self, connection, storage_handler) -> Sequence[Row]:
+        """Returns the sources of the relation table of which all applied relations have been committed
+
+        A two-phase (sharded) apply advances the applied eventid before its prepared transactions are committed,
+        sources with a running apply (the apply lock is held) or an interrupted apply are left out.
+
+        :return: the source, the applied eventid of the relation collection and the watermark of the view
+        """
+        query = f"""
+SELECT w.source, w.applied_eventid, v.last_event
+FROM {storage_handler.EVENT_WATERMARKS_TABLE} AS w
+LEFT JOIN {storage_handler.MATERIALIZED_VIEW_WATERMARKS_TABLE} AS v ON v.name = :name AND v.source = w.source
+WHERE w.catalogue = 'rel' AND w.entity = :entity
+"""
+        committed = """
+SELECT pg_try_advisory_xact_lock_shared(:lock, hashtext(:name))
+    AND NOT EXISTS (SELECT FROM pg_prepared_xacts WHERE gid ^@ :prefix)
+"""
+        sources = connection.execute(text(query), {"name": self.name, "entity": self.relation_name}).all()
+
+        return [
+            source for source in sources
+            if connection.execute(text(committed), {
+                "lock": storage_handler.APPLY_LOCK,
+                "name": f"{self.relation_table_name}.{source.source}",
+                "prefix": f"{storage_handler.APPLY_XID_PREFIX}.{self.relation_table_name}.{source.source}."
+            }).scalar()
+        ]
+
+    def _record_watermark(self, connection, storage_handler, source: str, last_event: int):
+        query = f"""
+INSERT INTO {storage_handler.MATERIALIZED_VIEW_WATERMARKS_TABLE} (name, source, last_event)
+VALUES (:name, :source, :last_event)
+ON CONFLICT (name, source) DO UPDATE SET last_event = EXCLUDED.last_event
+"""
+        connection.execute(text(query), {"name": self.name, "source": source, "last_event": last_event})
+
+    def apply_changes(self, storage_handler) -> int:
+        """Apply the changes of the relation table to the table (incremental mode)
+
+        The relations of a source with a _last_event after the watermark of the source are upserted, or deleted if
+        they have been deleted. The watermark is advanced to the applied eventid of the source, which was read
+        before the changes. After a deletion some changes may be applied again, which is harmless.
+
+        :return: the number of upserted and deleted rows
+        """
+        columns = [*self._columns(), FIELD.LAST_EVENT]
+        fields = ','.join(columns)
+        updates = ','.join(f"{column} = EXCLUDED.{column}" for column in columns if column != FIELD.GOBID)
+
+        delete = f"""
+DELETE FROM {self.name} AS mv
+USING {self.relation_table_name} AS rel
+WHERE mv.{FIELD.GOBID} = rel.{FIELD.GOBID}
+    AND rel.{FIELD.SOURCE} = :source
+    AND rel.{FIELD.LAST_EVENT} > :last_event
+    AND rel.{FIELD.DATE_DELETED} IS NOT NULL
+"""
+        upsert = f"""
+INSERT INTO {self.name} ({fields})
+SELECT {fields}
+FROM {self.relation_table_name}
+WHERE {FIELD.SOURCE} = :source AND {FIELD.LAST_EVENT} > :last_event AND {FIELD.DATE_DELETED} IS NULL
+ON CONFLICT ({FIELD.GOBID}) DO UPDATE SET {updates}
+"""
+        changes = 0
+
+        with storage_handler.engine.begin() as connection:
+            # changes are applied by one job at a time
+            connection.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": self.name})
+
+            for source, applied_eventid, last_event in self._get_committed_sources(connection, storage_handler):
+                if last_event is None:
+                    # tables without a watermark for the source continue from their last event
+                    last_event = connection.execute(
+                        text(f"SELECT COALESCE(MAX({FIELD.LAST_EVENT}), 0) FROM {self.name}")
+                    ).scalar()
+
+                params = {"source": source, "last_event": last_event}
+                changes += connection.execute(text(delete), params).rowcount
+                changes += connection.execute(text(upsert), params).rowcount
+
+                self._record_watermark(connection, storage_handler, source, applied_eventid)
+
+        return changes
+
+    def verify(self, storage_handler) -> tuple[int, int]:
+        """Compare the view with a full recompute from the relation table
+
+        :return: the number of missing rows and the number of rows that should not be present
+        """
+        fields = ','.join(self._columns())
+        recompute = f"SELECT {fields} FROM {self.relation_table_name} WHERE {FIELD.DATE_DELETED} IS NULL"
+        current = f"SELECT {fields} FROM {self.name}"
+
+        query = f"""
+SELECT
+    (SELECT COUNT(*) FROM ({recompute} EXCEPT ALL {current}) AS missing),
+    (SELECT COUNT(*) FROM ({current} EXCEPT ALL {recompute}) AS surplus)
+"""
+        with storage_handler.engine.connect() as connection:
+            missing, surplus = connection.execute(text(query)).one()
+        return missing, surplus
+
+    def repair(self, storage_handler):
+        """Recompute the view completely."""
+        if not self.incremental:
+            self.refresh(storage_handler, force=True)
+            return
+
+        fields = ','.join([*self._columns(), FIELD.LAST_EVENT])
+
+        with storage_handler.engine.begin() as connection:
+            connection.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": self.name})
+            sources = self._get_committed_sources(connection, storage_handler)
+
+            connection.execute(text(f"DELETE FROM {self.name}"))
+            connection.execute(text(
+                f"INSERT INTO {self.name} ({fields}) "
+                f"SELECT {fields} FROM {self.relation_table_name} WHERE {FIELD.DATE_DELETED} IS NULL"
+            ))
+
+            # the watermarks of sources with uncommitted relations are kept
+            for source in sources:
+                self._record_watermark(connection, storage_handler, source.source, source.applied_eventid)
+
 
 class MaterializedViews:
 
-    def initialise(self, storage_handler, force_recreate: Union[bool, list] = False):
+    def initialise(
+        self,
+        storage_handler,
+        force_recreate: Union[bool, list] = False,
+        workers: int = 1,
+        lazy: bool = False
+    ):
         """This method creates the materialized view along with its indexes
 
         :param force_recreate: A list with MV's to recreate, True to recreate all
+        :param workers: The number of views that are created at the same time, each on its own connection
+        :param lazy: Don't create missing (or recreated) views, they are created on their first refresh
         :return:
         """
         materialized_views = self.get_all()
         force_recreate = force_recreate or []
 
-        for materialized_view in materialized_views:
+        def initialise_view(materialized_view: MaterializedView):
             recreate = bool(force_recreate is True or materialized_view.name in force_recreate)
+
+            if lazy and (recreate or not materialized_view.exists(storage_handler)):
+                if recreate:
+                    self.drop(storage_handler, materialized_view.name)
+                return
+
             materialized_view.create(storage_handler, recreate)
 
+        with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="materialized_view") as executor:
+            # raises the first exception, if any
+            list(executor.map(initialise_view, materialized_views))
+
     def get_all(self):
         """Returns definitions of materialized views
 
@@ -146,3 +411,20 @@ class MaterializedViews:
 
     def get_by_relation_name(self, relation_name):
         return MaterializedView(relation_name)
+
+    @staticmethod
+    def get_kind(storage_handler, name: str) -> str | None:
+        """Returns whether `name` is a materialized view (m) or a table (r), None if it does not exist."""
+        return storage_handler.get_query_value(
+            f"SELECT relkind FROM pg_catalog.pg_class WHERE relname = '{name}' AND relkind IN ('m', 'r')"
+        )
+
+    @staticmethod
+    def drop(storage_handler, name: str, kind: str | None = None):
+        """Drops the materialized view or table (incremental mode) `name`, if it exists."""
+        kind = kind or MaterializedViews.get_kind(storage_handler, name)
+        relation = "TABLE" if kind == "r" else "MATERIALIZED VIEW"
+        storage_handler.execute(
+            f"DELETE FROM {storage_handler.MATERIALIZED_VIEW_WATERMARKS_TABLE} WHERE name = '{name}'"
+        )
+        storage_handler.execute(f"DROP {relation} IF EXISTS {name} CASCADE")
@@ -0,0 +1,111 @@
+"""
+Event partitions
+
+The events table is partitioned by catalogue, entity and source (see migration ea556acbed92):
+
+    events                                          PARTITION BY LIST (catalogue)
+    events.<catalogue>                              PARTITION BY LIST (entity)
+    events.<catalogue>_<entity>                     PARTITION BY LIST (source)
+    events.<catalogue>_<entity>_<lower(source)>     the source (leaf) partition
+
+An insert into the events table is routed to the leaf partition by the insertIntoEvents rule and function,
+for every single row. EventPartitions creates the partitions of a collection up front (if they do not exist)
+and caches the name of the leaf partition, so that events can be inserted into the leaf partition directly.
+
+The names are not quoted, exactly as in insertIntoEvents, so both resolve to the same tables.
+"""
+from __future__ import annotations
+
+import threading
+
+from sqlalchemy import text, exc as sa_exc
+from sqlalchemy.engine import Connection, Engine
+
+
+def _literal(value: str) -> str:
+    """Returns `value` as a SQL string literal (quote_literal)."""
+    return "'" + value.replace("'", "''") + "'"
+
+
+class EventPartitions:
+
+    def __init__(self, engine: Engine, events: str = "events", registry: str = "event_partitions"):
+        self.engine = engine
+        self.events = events
+        self.registry = registry
+
+        self._lock = threading.Lock()
+        self._leaves: dict[tuple[str, str, str], str] = {}
+        self._sequence: str | None = None
+
+    def get_names(self, catalogue: str, entity: str, source: str) -> tuple[str, str, str]:
+        """Returns the names of the catalogue, entity and source partition of a collection."""
+        catalogue_partition = f"{self.events}.{catalogue}"
+        entity_partition = f"{catalogue_partition}_{entity}"
+        source_partition = f"{entity_partition}_{source.lower()}"
+        return catalogue_partition, entity_partition, source_partition
+
+    @property
+    def sequence(self) -> str:
+        """The sequence of the eventids."""
+        if self._sequence is None:
+            with self.engine.connect() as connection:
+                self._sequence = connection.execute(
+                    text("SELECT pg_get_serial_sequence(:events, 'eventid')"), {"events": self.events}
+                ).scalar()
+        return self._sequence
+
+    def get(self, catalogue: str, entity: str, source: str) -> str:
+        """Returns the name of the source partition of a collection, the partitions are created if needed.
+
+        :return: the schema qualified name of the source partition
+        """
+        key = (catalogue, entity, source)
+
+        with self._lock:
+            if key not in self._leaves:
+                self._leaves[key] = self._create(catalogue, entity, source)
+
+            return self._leaves[key]
+
+    def _exists(self, connection: Connection, partition: str) -> bool:
+        query = text("SELECT to_regclass(:partition)")
+        return connection.execute(query, {"partition": partition}).scalar() is not None
+
+    def _register(self, connection: Connection, catalogue: str, entity: str, source: str, partition: str):
+        query = f"""
+INSERT INTO {self.registry} (catalogue, entity, source, tablename)
+VALUES (:catalogue, :entity, :source, :tablename)
+ON CONFLICT DO NOTHING
+"""
+        params = {"catalogue": catalogue, "entity": entity, "source": source, "tablename": partition.split(".")[1]}
+        connection.execute(text(query), params)
+
+    def _create(self, catalogue: str, entity: str, source: str) -> str:
+        catalogue_partition, entity_partition, source_partition = self.get_names(catalogue, entity, source)
+
+        statements = [
+            f"CREATE TABLE IF NOT EXISTS {catalogue_partition} PARTITION OF {self.events} "
+            f"FOR VALUES IN ({_literal(catalogue)}) PARTITION BY LIST (entity)",
+            f"CREATE TABLE IF NOT EXISTS {entity_partition} PARTITION OF {catalogue_partition} "
+            f"FOR VALUES IN ({_literal(entity)}) PARTITION BY LIST (source)",
+            f"CREATE TABLE IF NOT EXISTS {source_partition} PARTITION OF {entity_partition} "
+            f"FOR VALUES IN ({_literal(source)})",
+        ]
+
+        try:
+            with self.engine.begin() as connection:
+                if not self._exists(connection, source_partition):
+                    for statement in statements:
+                        connection.execute(text(statement))
+
+                self._register(connection, catalogue, entity, source, source_partition)
+        except sa_exc.DBAPIError:
+            # the partitions may have been created concurrently (by insertIntoEvents or another process)
+            with self.engine.begin() as connection:
+                if not self._exists(connection, source_partition):
+                    raise
+
+                self._register(connection, catalogue, entity, source, source_partition)
+
+        return source_partition
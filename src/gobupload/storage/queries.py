@@ -65,3 +65,38 @@ WHERE (
 WHERE type != 'SKIP' AND (_source = '{source}' OR _entity_source = '{source}')
 ORDER BY type
 """
+
+
+def get_backfill_event_partitions_query(events: str = "events", registry: str = "event_partitions") -> str:
+    """
+    Registers all source partitions of the events table that are not in the partition registry yet, the
+    catalogue, entity and source are read from the first event in the partition (empty partitions are skipped).
+    Registrations of partitions that no longer exist are removed.
+
+    :param events: the events table, the partitions are in the schema with the same name
+    :param registry: the partition registry table
+    :return: the backfill statement
+    """
+    return f"""
+DO $$
+DECLARE
+    part RECORD;
+BEGIN
+    DELETE FROM {registry} WHERE to_regclass(quote_ident('{events}') || '.' || quote_ident(tablename)) IS NULL;
+
+    FOR part IN
+        SELECT c.relname
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = '{events}' AND c.relkind = 'r' AND c.relispartition
+        AND c.relname NOT IN (SELECT tablename FROM {registry})
+    LOOP
+        EXECUTE format(
+            'INSERT INTO {registry} (catalogue, entity, source, tablename) '
+            'SELECT catalogue, entity, source, %L FROM %I.%I LIMIT 1 ON CONFLICT DO NOTHING',
+            part.relname, '{events}', part.relname
+        );
+    END LOOP;
+END
+$$
+"""
@@ -0,0 +1,82 @@
+"""
+Reflection cache
+
+Reflecting the database (GOBStorageHandler._set_base) queries the catalog for every table, which makes up most of
+the startup time of the service. The reflected metadata is stored in a local file (REFLECTION_CACHE_FILE) and
+loaded instead of reflecting the database when it is still valid.
+
+The cache is valid as long as the key is unchanged:
+
+- the alembic revision of the database, every change of the tables is a migration
+- the version of GOB-Core, which defines the model
+- the version of SQLAlchemy, which pickles the metadata
+
+The cache is disabled when REFLECTION_CACHE_FILE is not set.
+"""
+from __future__ import annotations
+
+import os
+import pickle
+from importlib.metadata import version, PackageNotFoundError
+from pathlib import Path
+
+import sqlalchemy
+from alembic.runtime import migration
+from sqlalchemy import MetaData
+from sqlalchemy.engine import Engine
+
+
+def _get_model_version() -> str:
+    try:
+        return version("gobcore")
+    except PackageNotFoundError:
+        return ""
+
+
+class ReflectionCache:
+
+    def __init__(self, path: str | Path | None):
+        self.path = Path(path) if path else None
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def get_key(self, engine: Engine) -> tuple[str | None, str, str]:
+        """Returns the key of the reflected metadata of the database of `engine`."""
+        with engine.connect() as connection:
+            revision = migration.MigrationContext.configure(connection).get_current_revision()
+
+        return revision, _get_model_version(), sqlalchemy.__version__
+
+    def load(self, key: tuple) -> MetaData | None:
+        """Returns the cached metadata, None if there is no cache or if it has been stored with another key."""
+        if not self.enabled:
+            return None
+
+        try:
+            with open(self.path, "rb") as file:
+                cached_key, metadata = pickle.load(file)
+        except (OSError, EOFError, pickle.PickleError, AttributeError, ImportError, ValueError):
+            return None
+
+        return metadata if cached_key == key else None
+
+    def save(self, key: tuple, metadata: MetaData):
+        """Stores the metadata, the file is replaced at once so that concurrent loads never read a partial file."""
+        if not self.enabled:
+            return
+
+        partial = self.path.with_name(f"{self.path.name}.{os.getpid()}")
+
+        try:
+            with open(partial, "wb") as file:
+                pickle.dump((key, metadata), file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(partial, self.path)
+        except (OSError, pickle.PickleError) as e:
+            partial.unlink(missing_ok=True)
+            print(f"WARNING: Reflection cache not saved: {e}")
+
+    def invalidate(self):
+        if self.enabled:
+            self.path.unlink(missing_ok=True)
@@ -10,6 +10,7 @@ from gobcore.events.import_message import ImportMessage
 from gobcore.logging.logger import logger
 from gobcore.utils import ProgressTicker
 from gobupload.storage.handler import GOBStorageHandler
+from gobupload.storage.instrumentation import instrumented
 from gobupload.update.event_collector import EventCollector
 from gobupload.update.update_statistics import UpdateStatistics
 from gobupload.utils import get_event_ids, is_corrupted
@@ -36,6 +37,9 @@ def _store_events(
     logger.info("Store events")
     chunksize = 10_000
 
+    # Create the events partition before the events transaction starts, the events are inserted into it directly
+    storage.get_event_partition()
+
     with (
         ProgressTicker("Store events", chunksize) as progress,
         storage.get_session() as session,
@@ -86,6 +90,7 @@ def _process_events(storage, events, stats):
         logger.warning("Model is out of date, Further processing has stopped")
 
 
+@instrumented("update")
 def full_update(msg):
     """Store the events for the current dataset
 
@@ -118,11 +123,13 @@ def full_update(msg):
 
     results.update(logger.get_summary())
 
-    # Return the result message, with no log, no contents but pass-through any confirms
+    # Return the result message, with no log, no contents but pass-through any confirms and the fingerprint
     message = {
         "header": msg["header"],
         "summary": results,
         "contents": None,
-        "confirms": msg.get('confirms')
+        "confirms": msg.get('confirms'),
+        "confirm_all": msg.get('confirm_all'),
+        "fingerprint": msg.get('fingerprint')
     }
     return message
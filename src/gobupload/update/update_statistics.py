@@ -52,6 +52,20 @@ class UpdateStatistics:
     def add_applied(self, action, count):
         self.applied[action] += count
 
+    def merge(self, other: "UpdateStatistics"):
+        """Add the statistics of another update process, eg for another collection
+
+        :param other:
+        :return:
+        """
+        for process in ["stored", "skipped", "applied"]:
+            for action, n in getattr(other, process).items():
+                getattr(self, process)[action] += n
+
+        self.num_events += other.num_events
+        self.num_single_events += other.num_single_events
+        self.num_bulk_events += other.num_bulk_events
+
     def results(self):
         """Get statistics in a dictionary
 
@@ -20,11 +20,16 @@ def is_corrupted(entity_max_eventid, last_eventid):
 def get_event_ids(storage):
     """Get the highest event id from the entities and the eventid of the most recent event
 
+    The eventids are read from the event watermarks, these are initialized from the entities and events
+    the first time they are requested for a collection.
+
     :param storage: GOB (events + entities)
     :return:highest entity eventid and last eventid
     """
-    entity_max_eventid = storage.get_entity_max_eventid()
-    last_eventid = storage.get_last_eventid()
+    if (watermarks := storage.get_event_watermarks()) is None:
+        watermarks = storage.rebuild_event_watermarks()
+
+    entity_max_eventid, last_eventid = watermarks
     return entity_max_eventid, last_eventid
 
 
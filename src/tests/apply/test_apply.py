@@ -10,8 +10,10 @@ from gobcore.exceptions import GOBException
 from gobcore.logging.logger import logger
 from gobupload.apply.event_applicator import EventApplicator
 
-from gobupload.apply.main import _should_analyze, apply, apply_confirm_events, \
-    apply_events
+from gobupload.apply.main import apply, apply_confirm_events, \
+    apply_events, apply_events_sql, _apply_combinations, save_upload_fingerprint, _index_maintenance, \
+    _foreign_key_maintenance
+from gobupload.apply.sql_applicator import SQLEventApplicator
 from gobupload.storage.handler import GOBStorageHandler
 from gobupload.update.update_statistics import UpdateStatistics
 from tests import fixtures
@@ -35,16 +37,25 @@ class TestApply(TestCase):
         self.mock_storage = MagicMock(spec=GOBStorageHandler)
         self.stats = MagicMock(spec=UpdateStatistics)
 
+        # the staged confirms are streamed, consume them like the database does
+        self.staged_tids = []
+        self.mock_storage.apply_confirms_staged.side_effect = lambda tids, timestamp: self.staged_tids.extend(tids)
+
+        patcher = patch("gobupload.apply.main.maintenance_scheduler")
+        self.mock_scheduler = patcher.start()
+        self.addCleanup(patcher.stop)
+
     def tearDown(self):
         logging.disable(logging.NOTSET)
 
+    @patch("gobupload.apply.main.EventReader")
     @patch("gobupload.apply.main.EventApplicator", autospec=EventApplicator)
     @patch('gobupload.apply.main.logger', MagicMock())
-    def test_apply_events(self, mock_applicator, _):
+    def test_apply_events(self, mock_applicator, mock_reader, _):
         event = fixtures.get_event_fixure()
         event.eventid = 100
         event.contents = '{"_entity_source_id": "{fixtures.random_string()}", "entity": {}}'
-        self.mock_storage.get_events_starting_after.side_effect = [[event], []]
+        mock_reader.return_value.__enter__.return_value.__iter__.return_value = iter([[event]])
         stats = MagicMock(spec=UpdateStatistics)
 
         apply_events(self.mock_storage, set(), 1, stats)
@@ -56,8 +67,44 @@ class TestApply(TestCase):
         self.mock_storage.get_session.assert_called_once()
         self.mock_storage.get_session.return_value.__enter__.assert_called_once()
         self.mock_storage.get_session.return_value.__exit__.assert_called_once()
+        self.mock_storage.advance_applied_eventid.assert_called_once_with(100)
 
-        self.mock_storage.get_events_starting_after.has_calls([call(1, 10_000), call(100, 10_000)])
+        mock_reader.assert_called_with(self.mock_storage, 1, 10_000, prefetch=True)
+
+    @patch("gobupload.apply.main.APPLY_SQL", True)
+    @patch("gobupload.apply.main.SQLEventApplicator")
+    @patch("gobupload.apply.main.apply_events_sql")
+    def test_apply_events_sql_supported(self, mock_apply_sql, mock_sql_applicator, _):
+        stats = MagicMock(spec=UpdateStatistics)
+
+        mock_sql_applicator.supports.return_value = True
+        apply_events(self.mock_storage, set(), 1, stats)
+        mock_apply_sql.assert_called_with(self.mock_storage, 1, stats)
+
+        # fallback to the event applicator for unsupported types
+        mock_apply_sql.reset_mock()
+        mock_sql_applicator.supports.return_value = False
+        with patch("gobupload.apply.main.EventReader") as mock_reader:
+            mock_reader.return_value.__enter__.return_value.__iter__.return_value = iter([])
+            apply_events(self.mock_storage, set(), 1, stats)
+            mock_reader.assert_called_with(self.mock_storage, 1, 10_000, prefetch=True)
+        mock_apply_sql.assert_not_called()
+
+    @patch("gobupload.apply.main.SQLEventApplicator", autospec=SQLEventApplicator)
+    @patch('gobupload.apply.main.logger', MagicMock())
+    def test_apply_events_sql(self, mock_sql_applicator, _):
+        stats = MagicMock(spec=UpdateStatistics)
+        mock_sql_applicator.return_value.apply_page.side_effect = [(10_000, 10_001), (5, 10_006), (0, 10_006)]
+
+        apply_events_sql(self.mock_storage, 1, stats)
+
+        mock_sql_applicator.assert_called_with(self.mock_storage, stats)
+        mock_sql_applicator.return_value.apply_page.assert_has_calls([
+            call(1, 10_000), call(10_001, 10_000), call(10_006, 10_000)
+        ])
+        self.assertEqual(self.mock_storage.get_session.call_count, 3)
+        self.mock_storage.advance_applied_eventid.assert_has_calls([call(10_001), call(10_006)])
+        self.assertEqual(self.mock_storage.advance_applied_eventid.call_count, 2)
 
     @patch('gobupload.apply.main.add_notification')
     @patch('gobupload.apply.main.EventNotification')
@@ -105,25 +152,57 @@ class TestApply(TestCase):
         with self.assertRaises(GOBException):
             apply({"header": {}})
 
+    @patch('gobupload.apply.main.MaterializedViews')
+    @patch('gobupload.apply.main.logger', MagicMock())
+    @patch('gobupload.apply.main.get_event_ids', lambda s: (1, 2))
+    @patch('gobupload.apply.main.apply_events', MagicMock())
+    def test_apply_relation_materialized_view(self, mock_views, mock):
+        mock.return_value = self.mock_storage
+        view = mock_views.return_value.get_by_relation_name.return_value
+        view.apply_changes.return_value = 5
+
+        self.mock_storage.get_source_catalogue_entity_combinations.return_value = [
+            MockCombination("GOB", "rel", "mbn_mbt_gbd_brt_ligt_in_buurt")
+        ]
+        apply({"header": {"catalogue": "rel", "entity": "mbn_mbt_gbd_brt_ligt_in_buurt"}})
+
+        mock_views.return_value.get_by_relation_name.assert_called_with("mbn_mbt_gbd_brt_ligt_in_buurt")
+        view.apply_changes.assert_called_with(self.mock_storage)
+
+        # lazy, the missing table is created on the first refresh
+        view.reset_mock()
+        view.lazy = True
+        view.exists.return_value = False
+        apply({"header": {"catalogue": "rel", "entity": "mbn_mbt_gbd_brt_ligt_in_buurt"}})
+        view.apply_changes.assert_not_called()
+
+        # materialized views are refreshed
+        view.reset_mock()
+        view.incremental = False
+        apply({"header": {"catalogue": "rel", "entity": "mbn_mbt_gbd_brt_ligt_in_buurt"}})
+        view.apply_changes.assert_not_called()
+
     def test_apply_confirms_bulkconfirm_event(self, _):
         msg = {"header": {"timestamp": "any timestamp"}}
-        item = {"event": "BULKCONFIRM", "data": {"confirms": [{"_tid": "confirm1"}]}}
+        item = {"event": "BULKCONFIRM", "data": {"confirms": [{"_tid": "confirm1"}, {"_tid": "confirm2"}]}}
 
         with NamedTemporaryFile(mode="w", delete=False) as tmpfile:
             json.dump(item, tmpfile)
             msg["confirms"] = tmpfile.name
 
-        apply_confirm_events(self.mock_storage, MagicMock(), msg)
+        stats = MagicMock(spec=UpdateStatistics)
+        apply_confirm_events(self.mock_storage, stats, msg)
+
+        self.mock_storage.apply_confirms_staged.assert_called_with(ANY, timestamp="any timestamp")
+        self.assertEqual(self.staged_tids, ["confirm1", "confirm2"])
+        stats.add_applied.assert_called_with("CONFIRM", 2)
 
-        self.mock_storage.apply_confirms.assert_called_with(
-            [{"_tid": "confirm1"}], timestamp="any timestamp"
-        )
         assert not Path(tmpfile.name).exists()
         assert msg.get("confirms") is None
 
     def test_apply_confirms_confirm_event(self, _):
         msg = {"header": {"timestamp": "any timestamp"}}
-        item = {"event": "CONFIRM", "data": {"some key": "any data"}}
+        item = {"event": "CONFIRM", "data": {"_tid": "confirm1"}}
 
         with NamedTemporaryFile(mode="w", delete=False) as tmpfile:
             json.dump(item, tmpfile)
@@ -131,9 +210,8 @@ class TestApply(TestCase):
 
         apply_confirm_events(self.mock_storage, MagicMock(), msg)
 
-        self.mock_storage.apply_confirms.assert_called_with(
-            [{"some key": "any data"}], timestamp="any timestamp"
-        )
+        self.mock_storage.apply_confirms_staged.assert_called_with(ANY, timestamp="any timestamp")
+        self.assertEqual(self.staged_tids, ["confirm1"])
         assert not Path(tmpfile.name).exists()
         assert msg.get("confirms") is None
 
@@ -152,6 +230,29 @@ class TestApply(TestCase):
         assert not Path(tmpfile.name).exists()
         assert "confirms" not in msg
 
+    @patch("gobupload.apply.main._apply_confirms")
+    def test_apply_confirm_all(self, mock_apply, _):
+        stats = MagicMock(spec=UpdateStatistics)
+        msg = {"header": {"timestamp": "any timestamp", "mode": "full"}, "confirms": None, "confirm_all": 10}
+
+        apply_confirm_events(self.mock_storage, stats, msg)
+
+        self.mock_storage.apply_confirm_all.assert_called_with("any timestamp")
+        stats.add_applied.assert_called_with("CONFIRM", 10)
+        mock_apply.assert_not_called()
+        assert "confirm_all" not in msg
+
+    def test_save_upload_fingerprint(self, _):
+        msg = {"header": {"application": "any application"}, "fingerprint": "any fingerprint"}
+
+        save_upload_fingerprint(self.mock_storage, msg)
+        self.mock_storage.save_upload_fingerprint.assert_called_with("any application", "any fingerprint")
+        assert "fingerprint" not in msg
+
+        self.mock_storage.reset_mock()
+        save_upload_fingerprint(self.mock_storage, msg)
+        self.mock_storage.save_upload_fingerprint.assert_not_called()
+
     @patch("gobupload.apply.main._apply_confirms")
     def test_apply_confirms_empty(self, mock_apply, _):
         apply_confirm_events(MagicMock(), MagicMock(), {'header': {}})
@@ -192,61 +293,54 @@ class TestApply(TestCase):
         self.assertEqual(result, {'header': {"catalogue": "any_cat"}, 'summary': ANY})
         mock_apply.assert_not_called()
 
-    def test_should_analyze(self, mock):
-        stats = MagicMock()
-        stats.get_applied_stats = lambda: {
-            'CONFIRM': {
-                'relative': 0.2,
-                'absolute': 1,
-            }
-        }
-
-        self.assertTrue(_should_analyze(stats))
-
-        stats.get_applied_stats = lambda: {
-            'CONFIRM': {
-                'relative': 0,
-                'absolute': 0,
-            }
-        }
-        self.assertFalse(_should_analyze(stats))
-
-        stats.get_applied_stats = lambda: {
-            'CONFIRM': {
-                'relative': 0.8,
-                'absolute': 2,
-            }
-        }
-
-        self.assertFalse(_should_analyze(stats))
+    @patch("gobupload.apply.main.logger", MagicMock())
+    def test_index_maintenance(self, _):
+        self.mock_storage.count_events_after.return_value = 600
+        self.mock_storage.get_table_size_estimate.return_value = 1000
+
+        with patch("gobupload.apply.main.APPLY_DEFER_INDEXES_FRACTION", 0):
+            _index_maintenance(self.mock_storage, 10)
+            self.mock_storage.count_events_after.assert_not_called()
+
+        with patch("gobupload.apply.main.APPLY_DEFER_INDEXES_FRACTION", 0.5):
+            result = _index_maintenance(self.mock_storage, 10)
+            self.mock_storage.count_events_after.assert_called_with(10)
+            self.assertEqual(result, self.mock_storage.deferred_indexes.return_value)
+
+        with patch("gobupload.apply.main.APPLY_DEFER_INDEXES_FRACTION", 0.75):
+            result = _index_maintenance(self.mock_storage, 10)
+            self.assertNotEqual(result, self.mock_storage.deferred_indexes.return_value)
+
+    @patch("gobupload.apply.main.logger", MagicMock())
+    def test_foreign_key_maintenance(self, _):
+        self.mock_storage.count_events_after.return_value = 600
+        self.mock_storage.get_table_size_estimate.return_value = 1000
+
+        with patch("gobupload.apply.main.APPLY_DEFER_FOREIGN_KEYS_FRACTION", 0.5):
+            self.mock_storage.metadata.catalogue = "meetbouten"
+            result = _foreign_key_maintenance(self.mock_storage, 10)
+            self.assertNotEqual(result, self.mock_storage.deferred_foreign_keys.return_value)
+
+            self.mock_storage.metadata.catalogue = "rel"
+            result = _foreign_key_maintenance(self.mock_storage, 10)
+            self.assertEqual(result, self.mock_storage.deferred_foreign_keys.return_value)
+
+        with patch("gobupload.apply.main.APPLY_DEFER_FOREIGN_KEYS_FRACTION", 0):
+            result = _foreign_key_maintenance(self.mock_storage, 10)
+            self.assertNotEqual(result, self.mock_storage.deferred_foreign_keys.return_value)
 
     @patch("gobupload.apply.main.UpdateStatistics")
-    @patch("gobupload.apply.main._should_analyze")
     @patch("gobupload.apply.main.get_event_ids", lambda x: (1, 1))
     @patch("gobupload.apply.main.is_corrupted", lambda x, y: True)
-    def test_apply_trigger_analyze(self, mock_should_analyze, mock_statistics, mock_storage_handler):
+    def test_apply_schedules_maintenance(self, mock_statistics, mock_storage_handler):
         mock_storage_handler.return_value.get_source_catalogue_entity_combinations.return_value = [type('Res', (), {
             'source': 'the source',
             'catalogue': 'the catalogue',
             'entity': 'the entity',
         })]
 
-        # Should analyze is True and mode is full
-        msg = {'header': {'mode': 'full', "catalogue": "any_cat"}}
-        mock_should_analyze.return_value = True
-        apply(msg)
-        mock_storage_handler.return_value.analyze_table.assert_called_once()
-        mock_storage_handler.reset_mock()
-
-        # Should analyze is True and mode is not full
-        msg = {'header': {'mode': 'notfull', "catalogue": "any_cat"}}
-        apply(msg)
-        mock_storage_handler.return_value.analyze_table.assert_not_called()
-
-        # Should analyze is False and mode is full
-        msg = {'header': {'mode': 'full', "catalogue": "any_cat"}}
-        mock_should_analyze.return_value = False
-        apply(msg)
+        apply({'header': {'mode': 'full', "catalogue": "any_cat"}})
+        self.mock_scheduler.schedule.assert_called_once_with(mock_storage_handler.return_value)
         mock_storage_handler.return_value.analyze_table.assert_not_called()
 
     @patch("gobupload.apply.main.add_notification")
@@ -256,7 +350,6 @@ class TestApply(TestCase):
     @patch("gobupload.apply.main.UpdateStatistics")
     @patch("gobupload.apply.main.apply_confirm_events", MagicMock())
     @patch("gobupload.apply.main.apply_events", MagicMock())
-    @patch("gobupload.apply.main._should_analyze", lambda *args: False)
     @patch("gobupload.apply.main.is_corrupted", lambda *args: False)
     def test_apply_notification_eventids(self, mock_statistics, mock_notification, mock_get_event_ids,
                                          mock_get_combinations, mock_add_notification, mock_storage_handler):
@@ -296,3 +389,48 @@ class TestApply(TestCase):
         mock_get_combinations.return_value = []
         apply({'header': {}})
         mock_add_notification.assert_not_called()
+
+    @patch("gobupload.apply.main.APPLY_WORKERS", 4)
+    @patch("gobupload.apply.main.gob_model")
+    @patch("gobupload.apply.main._get_source_catalog_entity_combinations")
+    @patch("gobupload.apply.main._apply_combination")
+    def test_apply_combinations_parallel(self, mock_apply_combination, mock_get_combinations, mock_model,
+                                         mock_storage_handler):
+        mock_model.get_table_name = lambda catalogue, entity: f"{catalogue}_{entity}"
+        combinations = [MockCombination("src", "cat", f"ent{i}") for i in range(10)]
+        mock_get_combinations.return_value = iter(combinations)
+        mock_apply_combination.side_effect = lambda result, msg: (result.entity, 1, 2)
+
+        msg = {"header": {"catalogue": "cat"}}
+        result = list(_apply_combinations(msg))
+
+        # results are returned in order of the combinations
+        self.assertEqual(result, [(f"ent{i}", 1, 2) for i in range(10)])
+        mock_apply_combination.assert_any_call(combinations[0], msg=msg)
+
+        # all tables are reflected before the workers start
+        mock_storage_handler.assert_called_once_with(
+            only=[mock_storage_handler.EVENTS_TABLE, *[f"cat_ent{i}" for i in range(10)]]
+        )
+
+        # confirms are applied serially
+        mock_storage_handler.reset_mock()
+        mock_get_combinations.return_value = iter(combinations[:2])
+        msg["confirms"] = "any file"
+        self.assertEqual(len(list(_apply_combinations(msg))), 2)
+        mock_storage_handler.assert_not_called()
+
+    @patch("gobupload.apply.main.add_notification")
+    @patch("gobupload.apply.main.EventNotification")
+    @patch("gobupload.apply.main._apply_combinations")
+    def test_apply_merge(self, mock_apply_combinations, mock_event_notification, mock_add_notification, _):
+        stats1 = UpdateStatistics()
+        stats1.add_applied("ADD", 2)
+        stats2 = UpdateStatistics()
+        stats2.add_applied("ADD", 1)
+        stats2.add_applied("MODIFY", 3)
+
+        mock_apply_combinations.return_value = iter([(stats1, 10, 12), (stats2, 5, 9)])
+        apply({"header": {"catalogue": "cat"}})
+
+        mock_event_notification.assert_called_with({"ADD": 3, "MODIFY": 3}, [5, 12])
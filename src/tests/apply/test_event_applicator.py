@@ -39,7 +39,7 @@ class TestEventApplicator(TestCase):
     def test_constructor(self):
         applicator = EventApplicator(self.storage, set("1"), self.stats)
 
-        assert applicator.inserts == []
+        assert applicator.inserts == {}
         assert applicator.updates == {}
         assert applicator.updates_total == 0
         assert applicator.last_events == set("1")
@@ -71,7 +71,7 @@ class TestEventApplicator(TestCase):
             applicator.flush()
 
         assert len(applicator.inserts) == 0
-        self.storage.add_add_events.assert_called()
+        self.storage.add_entities.assert_called()
         self.stats.add_applied.assert_called_with("ADD", 1)
 
     def test_apply_new_add_exception(self):
@@ -96,7 +96,7 @@ class TestEventApplicator(TestCase):
         applicator.load(event)
 
         applicator._add_insert.assert_not_called()
-        applicator._flush_inserts.assert_called_once()
+        applicator._flush_inserts.assert_not_called()
         applicator._add_update.assert_called_once()
 
     def test_add_update(self):
@@ -201,8 +201,7 @@ class TestEventApplicator(TestCase):
     def test_apply_event_batch_add_delete(self):
         """
         Test if a batch of events with ADD -> DELETE -> ADD of the same entity is handled correctly.
-        We expect the second ADD event to be handled as an 'other' event, because it needs to revive the deleted
-        entity.
+        We expect all events to be folded into the insert of the new entity.
         """
         applicator = EventApplicator(self.storage, set(), self.stats)
 
@@ -218,13 +217,10 @@ class TestEventApplicator(TestCase):
             event_object = dict_to_object(self.mock_event)
             applicator.load(event_object)
 
-        # Expect the first add event to be applied, and a DELETE and ADD event in other events
-        # we can't check the parameter, which is removed by self.add_events.clear()
-        self.storage.add_add_events.assert_called_once()
-        assert len(applicator.inserts) == 0
-        assert applicator.updates["tid"][0].action == "DELETE"
-        assert applicator.updates["tid"][1].action == "ADD"
-        assert applicator.updates_total == 2
+        # Expect nothing to be written before the flush, and no updates for the new entity
+        self.storage.add_entities.assert_not_called()
+        assert [event.action for event in applicator.inserts["tid"]] == ["ADD", "DELETE", "ADD"]
+        assert applicator.updates_total == 0
 
     def test_apply_event_batch_modifies(self):
         """
@@ -247,5 +243,50 @@ class TestEventApplicator(TestCase):
 
         # Expect all 3 modify events to be added to other events
         assert len(applicator.inserts) == 0
+        self.storage.add_entities.assert_not_called()
         assert applicator.updates_total == 3
         assert all(obj.action == "MODIFY" for obj in applicator.updates["any source id"])
+
+    def test_coalesce_insert(self):
+        """
+        Test if the events of a new entity are folded into a single insert with the values of the last event.
+        """
+        class MockEntity:
+            __table__ = MagicMock()
+            __table__.columns.keys.return_value = ["_tid", "_last_event", "_date_deleted", "name"]
+
+            def __init__(self, **kwargs):
+                self._date_deleted = None
+                self.__dict__.update(kwargs)
+
+        storage = MagicMock()
+        storage.DbEntity = MockEntity
+        applicator = EventApplicator(storage, set(), self.stats)
+
+        add_event = MagicMock(spec=GOB.ADD)
+        add_event.id = 1
+        add_event.tid = "any tid"
+        add_event.get_attribute_dict.return_value = {"name": "first"}
+
+        modify_event = MagicMock(spec=GOB.MODIFY)
+        modify_event.id = 2
+        modify_event.action = "MODIFY"
+        modify_event.apply_to.side_effect = lambda entity: setattr(entity, "name", "second")
+
+        delete_event = MagicMock(spec=GOB.DELETE)
+        delete_event.id = 3
+        delete_event.action = "DELETE"
+        delete_event.apply_to.side_effect = lambda entity: setattr(entity, "_date_deleted", "any date")
+
+        applicator.inserts["any tid"] = [add_event, modify_event, delete_event]
+        applicator._flush_inserts()
+
+        storage.add_entities.assert_called_with([
+            {"_date_deleted": "any date", "name": "second", "_last_event": 3, "_tid": "any tid"}
+        ])
+        assert applicator.inserts == {}
+
+        # the applied statistics count every event
+        self.stats.add_applied.assert_any_call("ADD", 1)
+        self.stats.add_applied.assert_any_call("MODIFY", 1)
+        self.stats.add_applied.assert_any_call("DELETE", 1)
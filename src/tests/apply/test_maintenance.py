@@ -0,0 +1,79 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from gobupload.apply.maintenance import get_maintenance, MaintenanceScheduler, VACUUM, ANALYZE
+from tests.fixtures import dict_to_object
+
+
+def _storage(live, dead, modified, tablename="any_table"):
+    storage = MagicMock()
+    storage.tablename = tablename
+    storage.get_table_statistics.return_value = dict_to_object({
+        "n_live_tup": live, "n_dead_tup": dead, "n_mod_since_analyze": modified
+    })
+    return storage
+
+
+@patch("gobupload.apply.maintenance.MAINTENANCE_VACUUM_FRACTION", 0.2)
+@patch("gobupload.apply.maintenance.MAINTENANCE_ANALYZE_FRACTION", 0.1)
+class TestGetMaintenance(TestCase):
+
+    def test_get_maintenance(self):
+        self.assertEqual(get_maintenance(_storage(100_000, 30_000, 0)), VACUUM)
+        self.assertEqual(get_maintenance(_storage(100_000, 10_000, 30_000)), ANALYZE)
+        self.assertIsNone(get_maintenance(_storage(100_000, 10_000, 5_000)))
+
+        # small tables are left to autovacuum
+        self.assertIsNone(get_maintenance(_storage(100, 500, 500)))
+
+        storage = MagicMock()
+        storage.get_table_statistics.return_value = None
+        self.assertIsNone(get_maintenance(storage))
+
+
+@patch("gobupload.apply.maintenance.logger", MagicMock())
+@patch("gobupload.apply.maintenance.get_maintenance")
+class TestMaintenanceScheduler(TestCase):
+
+    def test_schedule(self, mock_get_maintenance):
+        scheduler = MaintenanceScheduler(2)
+        storage = _storage(0, 0, 0)
+
+        mock_get_maintenance.return_value = None
+        self.assertIsNone(scheduler.schedule(storage))
+
+        mock_get_maintenance.return_value = ANALYZE
+        scheduler.schedule(storage).result()
+        storage.analyze_table.assert_called_once_with(vacuum=False)
+
+        mock_get_maintenance.return_value = VACUUM
+        scheduler.schedule(storage).result()
+        storage.analyze_table.assert_called_with(vacuum=True)
+
+    def test_schedule_once(self, mock_get_maintenance):
+        scheduler = MaintenanceScheduler(1)
+        scheduler.executor = MagicMock()
+        mock_get_maintenance.return_value = VACUUM
+
+        self.assertIsNotNone(scheduler.schedule(_storage(0, 0, 0)))
+        self.assertIsNone(scheduler.schedule(_storage(0, 0, 0)))
+        self.assertIsNotNone(scheduler.schedule(_storage(0, 0, 0, tablename="other_table")))
+        self.assertEqual(scheduler.executor.submit.call_count, 2)
+
+    def test_schedule_inline(self, mock_get_maintenance):
+        scheduler = MaintenanceScheduler(0)
+        storage = _storage(0, 0, 0)
+        mock_get_maintenance.return_value = VACUUM
+
+        self.assertIsNone(scheduler.schedule(storage))
+        storage.analyze_table.assert_called_once_with(vacuum=True)
+
+    def test_run_error(self, mock_get_maintenance):
+        scheduler = MaintenanceScheduler(1)
+        storage = _storage(0, 0, 0)
+        storage.analyze_table.side_effect = Exception("any error")
+        mock_get_maintenance.return_value = VACUUM
+
+        # errors are logged, the table can be scheduled again
+        scheduler.schedule(storage).result()
+        self.assertEqual(scheduler._scheduled, set())
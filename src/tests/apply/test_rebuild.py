@@ -0,0 +1,126 @@
+import gzip
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from gobcore.exceptions import GOBException
+
+from gobupload.apply.rebuild import TableRebuilder, RebuildResult
+from gobupload.update.update_statistics import UpdateStatistics
+from tests.fixtures import dict_to_object
+
+
+def _stats(applied: int) -> UpdateStatistics:
+    stats = UpdateStatistics()
+    stats.add_applied("ADD", applied)
+    return stats
+
+
+@patch("gobupload.apply.rebuild.logger", MagicMock())
+@patch("gobupload.apply.rebuild.MaterializedViews", MagicMock())
+@patch("gobupload.apply.rebuild.GOBStorageHandler")
+@patch("gobupload.apply.rebuild.SQLEventApplicator")
+class TestTableRebuilder(TestCase):
+
+    def setUp(self):
+        self.source = dict_to_object({"catalogue": "meetbouten", "entity": "metingen", "source": "AMSBI"})
+
+        self.storage = MagicMock()
+        self.storage.tablename = "meetbouten_metingen"
+        self.storage.metadata = self.source
+        self.storage.get_source_catalogue_entity_combinations.return_value = iter([self.source])
+        self.storage.get_managed_indexes.return_value = {
+            "tid_index": {"table_name": "meetbouten_metingen", "columns": ["_tid"]},
+            "other_index": {"table_name": "meetbouten_metingen", "columns": ["identificatie"]},
+        }
+        self.storage.get_foreign_keys.return_value = {}
+        self.storage.get_query_value.return_value = 2
+        self.storage._create_index_statement.side_effect = lambda name, definition: \
+            f"CREATE INDEX {name} ON {definition['table_name']}"
+
+        self.connection = self.storage.engine.begin.return_value.__enter__.return_value
+        self.storage.engine.connect.return_value.__enter__.return_value.execute.return_value.all.return_value = []
+
+    def _statements(self):
+        return [str(args[0][0]) for args in self.connection.execute.call_args_list]
+
+    def test_rebuild(self, mock_applicator, mock_storage):
+        mock_storage.return_value.get_last_event_archive.return_value = None
+        rebuilder = TableRebuilder(self.storage, workers=2)
+        rebuilder._replay_shard = MagicMock(side_effect=[_stats(3), _stats(2)])
+
+        result = rebuilder.rebuild()
+
+        self.assertEqual(result.events, 5)
+        self.assertEqual(result.entities, 2)
+        self.assertEqual(sorted(args[0][1:] for args in rebuilder._replay_shard.call_args_list), [(0, 0), (1, 0)])
+
+        shadow = rebuilder.shadow
+        statements = self._statements()
+        self.assertEqual(statements[:2], [
+            f"DROP TABLE IF EXISTS {shadow}",
+            f'CREATE UNLOGGED TABLE {shadow} (LIKE "meetbouten_metingen" INCLUDING DEFAULTS)',
+        ])
+        self.assertIn(f"CREATE INDEX {rebuilder._temporary_name('tid_index')} ON {shadow}", statements)
+        self.assertIn(f"ALTER TABLE {shadow} SET LOGGED", statements)
+        self.assertIn('DROP TABLE "meetbouten_metingen" CASCADE', statements)
+        self.assertIn(f'ALTER TABLE {shadow} RENAME TO "meetbouten_metingen"', statements)
+        self.assertIn(f'ALTER INDEX "{rebuilder._temporary_name("other_index")}" RENAME TO "other_index"', statements)
+
+        # the other indexes are built after replaying the events
+        indexes = self.storage.create_indexes.call_args[0][0]
+        self.assertEqual(list(indexes.values()), [{"table_name": shadow, "columns": ["identificatie"]}])
+
+        # the applied eventid is reset to the rebuilt table
+        mock_storage.return_value.rebuild_event_watermarks.assert_called_once_with(reset=True)
+
+    def test_rebuild_not_supported(self, mock_applicator, mock_storage):
+        mock_applicator.supports.return_value = False
+
+        with self.assertRaises(GOBException):
+            TableRebuilder(self.storage).rebuild()
+
+        self.connection.execute.assert_not_called()
+
+    def test_replay_shard(self, mock_applicator, mock_storage):
+        rebuilder = TableRebuilder(self.storage, workers=4)
+        storage = MagicMock()
+        mock_applicator.return_value.apply_page.side_effect = [(10, 20), (5, 25), (0, 25)]
+
+        rebuilder._replay_shard(storage, 3, 10)
+
+        self.assertEqual(mock_applicator.call_args[0][2:], (rebuilder.shadow, 3, 4))
+        self.assertEqual(
+            [args[0][0] for args in mock_applicator.return_value.apply_page.call_args_list], [10, 20, 25]
+        )
+
+    def test_load_snapshot(self, mock_applicator, mock_storage):
+        rebuilder = TableRebuilder(self.storage)
+        storage = MagicMock()
+
+        storage.get_last_event_archive.return_value = None
+        self.assertEqual(rebuilder._load_snapshot(storage), 0)
+
+        storage.get_last_event_archive.return_value = dict_to_object(
+            {"archived_eventid": 10, "snapshot_eventid": 12, "snapshot_file": "snapshot.csv.gz"}
+        )
+        with self.assertRaises(GOBException):
+            rebuilder._load_snapshot(storage)
+
+        with tempfile.TemporaryDirectory() as directory:
+            with gzip.open(Path(directory) / "snapshot.csv.gz", "wt") as file:
+                file.write("_gobid,_tid\n1,a\n")
+
+            rebuilder.snapshot_directory = Path(directory)
+            self.assertEqual(rebuilder._load_snapshot(storage), 12)
+
+        cursor = self.connection.connection.cursor.return_value.__enter__.return_value
+        self.assertEqual(
+            cursor.copy_expert.call_args[0][0],
+            f"COPY {rebuilder.shadow} (_gobid,_tid) FROM STDIN WITH (FORMAT csv, HEADER)"
+        )
+
+    def test_result(self, mock_applicator, mock_storage):
+        self.assertEqual(RebuildResult(100, 10, 4.0).events_per_second, 25)
+        self.assertEqual(RebuildResult(0, 0, 0).events_per_second, 0)
@@ -0,0 +1,99 @@
+import zlib
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from gobupload.apply.sharded_applicator import ShardedEventApplicator, ShardWorker
+from gobupload.update.update_statistics import UpdateStatistics
+from tests.fixtures import dict_to_object
+
+
+def _event(eventid, tid):
+    return dict_to_object({"eventid": eventid, "tid": tid})
+
+
+@patch("gobupload.apply.sharded_applicator.EventApplicator")
+@patch("gobupload.apply.sharded_applicator.GOBStorageHandler")
+class TestShardWorker(TestCase):
+
+    @patch("gobupload.apply.sharded_applicator.PreparedTransaction")
+    def test_apply(self, mock_transaction, mock_storage, mock_applicator):
+        storage = MagicMock()
+        worker = ShardWorker(storage, {"1"}, 2)
+
+        mock_storage.assert_called_with(storage.metadata)
+        mock_applicator.assert_called_with(worker.storage, {"1"}, worker.stats)
+
+        events = [_event(11, "1"), _event(12, "1")]
+        result = worker.apply("11", events)
+
+        self.assertEqual(result, mock_transaction.return_value)
+        worker.storage.get_apply_xid.assert_called_with("11", 2)
+        mock_transaction.assert_called_with(worker.storage.engine, worker.storage.get_apply_xid.return_value)
+        worker.storage.get_prepared_session.assert_called_with(mock_transaction.return_value)
+
+        self.assertEqual(worker.event_applicator.load.call_count, 2)
+        worker.event_applicator.flush.assert_called_once()
+
+
+@patch("gobupload.apply.sharded_applicator.ShardWorker")
+class TestShardedEventApplicator(TestCase):
+
+    def setUp(self):
+        self.storage = MagicMock()
+        self.stats = MagicMock(spec=UpdateStatistics)
+
+    @patch("gobupload.apply.sharded_applicator.logger")
+    def test_supports(self, mock_logger, _):
+        self.storage.get_query_value.return_value = "4"
+        self.assertTrue(ShardedEventApplicator.supports(self.storage, 4))
+
+        self.storage.get_query_value.return_value = "0"
+        self.assertFalse(ShardedEventApplicator.supports(self.storage, 4))
+        mock_logger.warning.assert_called_once()
+
+    def test_shard(self, _):
+        applicator = ShardedEventApplicator(self.storage, set(), self.stats, 3)
+        events = [_event(eventid, tid) for eventid, tid in enumerate(["1", "2", "3", "1", "4", "2"])]
+
+        shards = applicator._shard(events)
+
+        # every tid is in one shard only, the order of the events is kept
+        for shard, shard_events in shards.items():
+            for event in shard_events:
+                self.assertEqual(zlib.crc32(event.tid.encode()) % 3, shard)
+            self.assertEqual(shard_events, sorted(shard_events, key=lambda e: e.eventid))
+        self.assertEqual(sum(len(shard_events) for shard_events in shards.values()), 6)
+
+    def test_apply_page(self, mock_worker):
+        with ShardedEventApplicator(self.storage, set(), self.stats, 2) as applicator:
+            applicator._shard = MagicMock(return_value={0: ["event 1"], 1: ["event 2"]})
+            applicator.apply_page([_event(11, "1"), _event(12, "2")])
+
+        self.assertIsNone(applicator.executor)
+
+        # the apply lock of the collection and source is held while applying
+        self.storage.apply_lock.return_value.__enter__.assert_called_once()
+        self.storage.apply_lock.return_value.__exit__.assert_called_once()
+
+        mock_worker.return_value.apply.assert_any_call("11", ["event 1"])
+        mock_worker.return_value.apply.assert_any_call("11", ["event 2"])
+
+        self.storage.add_commit_decision.assert_called_with("11", 12)
+        self.assertEqual(mock_worker.return_value.apply.return_value.commit.call_count, 2)
+        self.storage.delete_commit_decision.assert_called_with("11")
+
+        # statistics of the workers are merged
+        self.assertEqual(self.stats.merge.call_count, 2)
+
+    def test_apply_page_error(self, mock_worker):
+        prepared = MagicMock()
+        mock_worker.return_value.apply.side_effect = [prepared, ValueError("any error")]
+
+        with self.assertRaisesRegex(ValueError, "any error"):
+            with ShardedEventApplicator(self.storage, set(), self.stats, 2) as applicator:
+                applicator._shard = MagicMock(return_value={0: ["event 1"], 1: ["event 2"]})
+                applicator.apply_page([_event(11, "1"), _event(12, "2")])
+
+        prepared.rollback.assert_called_once()
+        prepared.commit.assert_not_called()
+        self.storage.add_commit_decision.assert_not_called()
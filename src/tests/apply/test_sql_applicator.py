@@ -0,0 +1,157 @@
+import sqlite3
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from gobcore.exceptions import GOBException
+
+from gobupload.apply.sql_applicator import SQLEventApplicator
+from gobupload.storage.handler import GOBStorageHandler
+from gobupload.update.update_statistics import UpdateStatistics
+from tests.fixtures import dict_to_object
+
+
+class MockMeta:
+    source = "AMSBI"
+    catalogue = "meetbouten"
+    entity = "meetbouten"
+
+
+class TestSQLEventApplicator(TestCase):
+
+    @patch("gobupload.apply.sql_applicator.random_string", MagicMock(return_value="abcdefgh"))
+    def setUp(self):
+        self.stats = MagicMock(spec=UpdateStatistics)
+        self.storage = MagicMock()
+        self.storage.EVENTS_TABLE = GOBStorageHandler.EVENTS_TABLE
+        self.storage.tablename = "meetbouten_meetbouten"
+        self.storage.metadata = MockMeta
+        self.storage.DbEntity.__table__.columns.keys.return_value = ["_gobid", "_tid", "identificatie"]
+
+        self.session = self.storage.session
+        self.applicator = SQLEventApplicator(self.storage, self.stats)
+
+    def test_init(self):
+        self.assertEqual(self.applicator.staged, "tmp_apply_abcdefgh")
+        self.assertEqual(self.applicator.columns, ["_tid", "identificatie"])
+
+    def test_supports(self):
+        self.storage._fields = {"identificatie": {"type": "GOB.String"}, "_tid": {"type": "GOB.String"}}
+        self.assertTrue(SQLEventApplicator.supports(self.storage))
+
+        self.storage._fields["geometrie"] = {"type": "GOB.Geometry"}
+        self.assertFalse(SQLEventApplicator.supports(self.storage))
+
+    def test_queries(self):
+        stage = self.applicator._stage_query()
+        self.assertIn("CREATE TEMPORARY TABLE tmp_apply_abcdefgh ON COMMIT DROP AS", stage)
+        self.assertIn("LEFT JOIN meetbouten_meetbouten AS entity ON entity._tid = page.tid", stage)
+
+        insert = self.applicator._insert_query()
+        self.assertIn('INSERT INTO meetbouten_meetbouten ("_tid", "identificatie")', insert)
+        self.assertIn("jsonb_populate_record(NULL::meetbouten_meetbouten", insert)
+        self.assertIn("staged.state = 'absent'", insert)
+
+        update = self.applicator._update_query()
+        self.assertIn('SET ("_tid", "identificatie") = (SELECT record."_tid", record."identificatie"', update)
+        self.assertIn("jsonb_populate_record(entity, patch.patch)", update)
+        self.assertIn("round = :round AND state <> 'absent'", update)
+
+    def _stage(self, events: list[tuple], entities: list[tuple]) -> dict[int, str]:
+        """Stages `events` (eventid, action, tid) on `entities` (tid, date_deleted), returns the states by eventid.
+
+        The staging query is not sharded, its SELECT also runs on sqlite.
+        """
+        connection = sqlite3.connect(":memory:")
+        connection.execute(
+            'CREATE TABLE events '
+            '(eventid, action, tid, "timestamp", source, application, contents, catalogue, entity)'
+        )
+        connection.execute("CREATE TABLE meetbouten_meetbouten (_tid, _date_deleted)")
+        connection.executemany(
+            "INSERT INTO events VALUES (?, ?, ?, NULL, 'AMSBI', 'app', '{}', 'meetbouten', 'meetbouten')", events
+        )
+        connection.executemany("INSERT INTO meetbouten_meetbouten VALUES (?, ?)", entities)
+
+        query = self.applicator._stage_query().replace(
+            "CREATE TEMPORARY TABLE tmp_apply_abcdefgh ON COMMIT DROP AS", ""
+        )
+        params = {"catalogue": "meetbouten", "entity": "meetbouten", "source": "AMSBI", "start_after": 0, "limit": 100}
+        return {row[0]: row[-1] for row in connection.execute(query, params)}
+
+    def test_stage_state(self):
+        # skipped events on a missing entity leave it absent
+        self.assertEqual(self._stage([(1, "MODIFY", "1"), (2, "MODIFY", "1")], []), {1: "absent", 2: "absent"})
+        self.assertEqual(
+            self._stage([(1, "DELETE", "1"), (2, "CONFIRM", "1"), (3, "ADD", "1"), (4, "MODIFY", "1")], []),
+            {1: "absent", 2: "absent", 3: "absent", 4: "current"}
+        )
+
+        # ADD makes an entity current, DELETE makes it deleted
+        self.assertEqual(
+            self._stage([(1, "MODIFY", "1"), (2, "DELETE", "1"), (3, "CONFIRM", "1"), (4, "ADD", "1"),
+                         (5, "MODIFY", "1"), (6, "DELETE", "1"), (7, "ADD", "1")], [("1", None)]),
+            {1: "current", 2: "current", 3: "deleted", 4: "deleted", 5: "current", 6: "current", 7: "deleted"}
+        )
+        self.assertEqual(
+            self._stage([(1, "ADD", "1"), (2, "MODIFY", "1")], [("1", "2020-01-01")]), {1: "deleted", 2: "current"}
+        )
+
+    def test_sharded(self):
+        applicator = SQLEventApplicator(self.storage, self.stats, "rebuild_table", 1, 4)
+        self.session.execute.return_value.one.return_value = (0, None, None)
+
+        stage = applicator._stage_query()
+        self.assertIn("AND abs(hashtext(tid)::bigint) % :shards = :shard", stage)
+        self.assertIn("LEFT JOIN rebuild_table AS entity", stage)
+        self.assertIn("INSERT INTO rebuild_table", applicator._insert_query())
+        self.assertIn("UPDATE rebuild_table AS entity", applicator._update_query())
+
+        applicator.apply_page(10, 100)
+        params = self.session.execute.call_args_list[0][0][1]
+        self.assertEqual((params["shard"], params["shards"]), (1, 4))
+
+        # not sharded
+        self.assertNotIn(":shards", self.applicator._stage_query())
+
+    def test_apply_page_empty(self):
+        self.session.execute.return_value.one.return_value = (0, None, None)
+
+        self.assertEqual(self.applicator.apply_page(10, 100), (0, 10))
+
+        params = self.session.execute.call_args_list[0][0][1]
+        self.assertEqual(params, {
+            "catalogue": "meetbouten", "entity": "meetbouten", "source": "AMSBI", "start_after": 10, "limit": 100
+        })
+        self.assertEqual(self.session.execute.call_count, 2)
+        self.stats.add_applied.assert_not_called()
+
+    def test_apply_page(self):
+        self.session.execute.return_value.one.return_value = (3, 13, 2)
+        self.session.execute.return_value.first.return_value = None
+        self.session.execute.return_value.__iter__.return_value = [
+            dict_to_object({"action": "ADD", "count": 2}),
+            dict_to_object({"action": "MODIFY", "count": 1}),
+        ]
+
+        self.assertEqual(self.applicator.apply_page(10, 100), (3, 13))
+
+        rounds = [call[0][1] for call in self.session.execute.call_args_list if len(call[0]) > 1][1:]
+        self.assertEqual(rounds, [{"round": 1}, {"round": 1}, {"round": 2}, {"round": 2}])
+
+        self.stats.add_applied.assert_any_call("ADD", 2)
+        self.stats.add_applied.assert_any_call("MODIFY", 1)
+
+    def test_apply_page_invalid(self):
+        self.session.execute.return_value.one.return_value = (1, 11, 1)
+
+        self.session.execute.return_value.first.return_value = \
+            dict_to_object({"eventid": 11, "action": "ADD", "tid": "1", "last_event": None})
+        with self.assertRaisesRegex(GOBException, "Trying to 'ADD' an existing"):
+            self.applicator.apply_page(10, 100)
+
+        self.session.execute.return_value.first.return_value = \
+            dict_to_object({"eventid": 11, "action": "MODIFY", "tid": "1", "last_event": 5})
+        with self.assertRaisesRegex(GOBException, "Trying to 'MODIFY' a deleted entity"):
+            self.applicator.apply_page(10, 100)
+
+        self.stats.add_applied.assert_not_called()
@@ -75,6 +75,35 @@ class TestCompare(TestCase):
         result = compare(message)
         self.assertNotEqual(result, None)
 
+    @patch("gobupload.compare.main.UploadFingerprint")
+    def test_compare_identical_upload(self, mock_fingerprint, storage_mock):
+        storage_mock.return_value = self.mock_storage
+        mock_fingerprint.return_value.value = "any fingerprint"
+        mock_fingerprint.return_value.count = 3
+
+        # the upload is identical to the last applied upload
+        self.mock_storage.has_any_entity.return_value = True
+        self.mock_storage.get_upload_fingerprint.return_value = "any fingerprint"
+        message = fixtures.get_message_fixture(contents=[])
+
+        result = compare(message)
+
+        self.mock_storage.compare_temporary_data.assert_not_called()
+        self.assertEqual(result["confirm_all"], 3)
+        self.assertIsNone(result["confirms"])
+        self.assertEqual(result["fingerprint"], "any fingerprint")
+        self.assertEqual(result["summary"]["CONFIRM events"], 3)
+
+        # a different upload is compared
+        self.mock_storage.get_upload_fingerprint.return_value = "other fingerprint"
+        self.mock_storage.compare_temporary_data.return_value = []
+
+        result = compare(fixtures.get_message_fixture(contents=[]))
+
+        self.mock_storage.compare_temporary_data.assert_called_once()
+        self.assertIsNone(result["confirm_all"])
+        self.assertEqual(result["fingerprint"], "any fingerprint")
+
     def test_compare_invalid_type(self, storage_mock):
         storage_mock.return_value = self.mock_storage
         original_value = {"_last_event": 123}
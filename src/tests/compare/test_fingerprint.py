@@ -0,0 +1,35 @@
+from unittest import TestCase
+
+from gobupload.compare.fingerprint import UploadFingerprint
+
+
+class TestUploadFingerprint(TestCase):
+
+    def _fingerprint(self, entities):
+        fingerprint = UploadFingerprint()
+        for entity in entities:
+            fingerprint.add(entity)
+        return fingerprint
+
+    def test_fingerprint(self):
+        entities = [{"_tid": str(tid), "_hash": f"hash{tid}"} for tid in range(5)]
+
+        fingerprint = self._fingerprint(entities)
+        self.assertEqual(fingerprint.count, 5)
+        self.assertRegex(fingerprint.value, r"^5:[0-9a-f]{64}$")
+
+        # order independent
+        self.assertEqual(self._fingerprint(reversed(entities)).value, fingerprint.value)
+
+        # a changed hash or tid changes the fingerprint
+        changed = entities[:4] + [{"_tid": "4", "_hash": "other"}]
+        self.assertNotEqual(self._fingerprint(changed).value, fingerprint.value)
+
+        changed = entities[:4] + [{"_tid": "5", "_hash": "hash4"}]
+        self.assertNotEqual(self._fingerprint(changed).value, fingerprint.value)
+
+        # a missing entity changes the fingerprint
+        self.assertNotEqual(self._fingerprint(entities[:4]).value, fingerprint.value)
+
+    def test_empty(self):
+        self.assertEqual(UploadFingerprint().value, f"0:{0:064x}")
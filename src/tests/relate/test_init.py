@@ -344,10 +344,11 @@ class TestInit(TestCase):
         with self.assertRaises(GOBException):
             _get_materialized_view('cat', 'col', 'attr')
 
+    @patch("gobupload.relate.refresh_coordinator")
     @patch("gobupload.relate.datetime")
     @patch("gobupload.relate._get_materialized_view")
     @patch("gobupload.relate.GOBStorageHandler")
-    def test_update_materialized_view(self, mock_storage_handler, mock_get_mv, mock_datetime):
+    def test_update_materialized_view(self, mock_storage_handler, mock_get_mv, mock_datetime, mock_coordinator):
         mock_datetime.datetime.utcnow.return_value.isoformat.return_value = 'DATETIME'
 
         msg = {
@@ -370,7 +371,7 @@ class TestInit(TestCase):
         self.assertEqual(expected_result_msg, update_materialized_view(msg))
 
         mock_get_mv.assert_called_with('catalog', 'collection', 'attribute')
-        mock_get_mv.return_value.refresh.assert_called_with(mock_storage_handler.return_value)
+        mock_coordinator.refresh.assert_called_with(mock_get_mv.return_value, mock_storage_handler.return_value)
 
     @patch("gobupload.relate.gob_model", MockModel())
     @patch("gobupload.relate.GOBSources", MockSources)
@@ -0,0 +1,78 @@
+import datetime
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from gobupload.relate.refresh import RefreshCoordinator, REFRESH_LOCK
+
+
+class TestRefreshCoordinator(TestCase):
+
+    def setUp(self):
+        self.view = MagicMock()
+        self.view.name = "mv_name"
+
+        self.storage = MagicMock()
+        self.storage.MATERIALIZED_VIEW_REFRESHES_TABLE = "materialized_view_refreshes"
+
+        mock_connect = self.storage.engine.connect.return_value
+        self.connection = mock_connect.execution_options.return_value.__enter__.return_value
+
+        # now() is a timestamp with time zone
+        self.requested = datetime.datetime(2026, 10, 18, 12, 0, 0, tzinfo=datetime.timezone.utc)
+
+    def _statements(self):
+        return [str(args[0][0]) for args in self.connection.execute.call_args_list]
+
+    def _last_refresh(self, covered):
+        # request time, whether the last refresh started after the request (None if never refreshed)
+        self.connection.execute.return_value.scalar.side_effect = [self.requested, covered]
+
+    @patch("gobupload.relate.refresh.time.sleep")
+    def test_refresh(self, mock_sleep):
+        self._last_refresh(False)
+        self.view.refresh.return_value = True
+
+        coordinator = RefreshCoordinator(window=5)
+        self.assertEqual(coordinator.refresh(self.view, self.storage), RefreshCoordinator.REFRESHED)
+
+        mock_sleep.assert_called_with(5)
+        self.view.refresh.assert_called_with(self.storage)
+
+        statements = self._statements()
+        self.assertEqual(statements[1], "SELECT pg_advisory_lock(:lock, hashtext(:name))")
+        self.assertEqual(statements[-1], "SELECT pg_advisory_unlock(:lock, hashtext(:name))")
+
+        # the timestamp of the last refresh is compared with now() in the database
+        self.assertIn("timestamp >= :requested", statements[2])
+        params = self.connection.execute.call_args_list[2][0][1]
+        self.assertEqual(params, {"name": "mv_name", "requested": self.requested})
+        self.assertEqual(self.connection.execute.call_args[0][1], {"lock": REFRESH_LOCK, "name": "mv_name"})
+
+    @patch("gobupload.relate.refresh.time.sleep")
+    def test_refresh_unchanged(self, mock_sleep):
+        self._last_refresh(None)
+        self.view.refresh.return_value = False
+
+        coordinator = RefreshCoordinator()
+        self.assertEqual(coordinator.refresh(self.view, self.storage), RefreshCoordinator.UNCHANGED)
+        mock_sleep.assert_not_called()
+
+    def test_refresh_covered(self):
+        # another request has refreshed the view after this request has been made
+        self._last_refresh(True)
+
+        coordinator = RefreshCoordinator()
+        self.assertEqual(coordinator.refresh(self.view, self.storage), RefreshCoordinator.COVERED)
+
+        self.view.refresh.assert_not_called()
+        self.assertIn("pg_advisory_unlock", self._statements()[-1])
+
+    def test_refresh_error(self):
+        self._last_refresh(None)
+        self.view.refresh.side_effect = ValueError("any error")
+
+        with self.assertRaises(ValueError):
+            RefreshCoordinator().refresh(self.view, self.storage)
+
+        # the lock is released
+        self.assertIn("pg_advisory_unlock", self._statements()[-1])
@@ -0,0 +1,85 @@
+import gzip
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from gobupload.storage.archive import EventArchiver, ArchiveResult
+from tests.fixtures import dict_to_object
+
+
+def _copy_expert(sql, file):
+    file.write(b"eventid,action\n1,ADD\n")
+
+
+@patch("gobupload.storage.archive.logger", MagicMock())
+class TestEventArchiver(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+        self.storage = MagicMock()
+        self.storage.metadata = dict_to_object({"catalogue": "meetbouten", "entity": "metingen", "source": "AMSBI"})
+        self.storage.tablename = "meetbouten_metingen"
+        self.storage.EVENT_ARCHIVES_TABLE = "event_archives"
+        self.storage.event_partitions.get.return_value = "events.meetbouten_metingen_amsbi"
+        self.storage.get_archived_eventid.return_value = 10
+
+        mock_connect = self.storage.engine.connect.return_value
+        self.connection = mock_connect.execution_options.return_value.__enter__.return_value
+        self.cursor = self.connection.connection.cursor.return_value.__enter__.return_value
+        self.cursor.mogrify.return_value = b"SELECT * FROM any_table"
+        self.cursor.copy_expert.side_effect = _copy_expert
+        self.cursor.rowcount = 1
+
+        self.archiver = EventArchiver(self.storage, self.directory.name)
+        self.archiver._get_size = MagicMock(side_effect=[2_000, 1_000])
+        self.archiver._scan = MagicMock(side_effect=[2.0, 1.0])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_archive(self):
+        # the last applied event
+        self.connection.execute.return_value.scalar.return_value = 50
+
+        result = self.archiver.archive(40)
+
+        self.assertEqual(result.archived_eventid, 40)
+        self.assertEqual(result.snapshot_eventid, 50)
+        self.assertEqual(result.events, 1)
+        self.assertEqual(result.reclaimed, 1_000)
+        self.assertEqual(result.scan_after, 1.0)
+
+        files = sorted(path.name for path in Path(self.directory.name).iterdir())
+        self.assertEqual(files, [
+            "meetbouten_metingen_amsbi_events_10_40.csv.gz", "meetbouten_metingen_amsbi_snapshot_50.csv.gz"
+        ])
+        with gzip.open(result.events_file, "rt") as file:
+            self.assertEqual(file.read(), "eventid,action\n1,ADD\n")
+
+        self.assertEqual(self.cursor.mogrify.call_args_list[0][0][1], {"start_after": 10, "end": 40})
+        self.assertIn("COPY (SELECT * FROM any_table) TO STDOUT", self.cursor.copy_expert.call_args[0][0])
+
+        # the events are deleted and the checkpoint is recorded in one transaction
+        delete, checkpoint = self.storage.engine.begin.return_value.__enter__.return_value.execute.call_args_list
+        self.assertIn("DELETE FROM events.meetbouten_metingen_amsbi", str(delete[0][0]))
+        self.assertEqual(delete[0][1], {"start_after": 10, "end": 40})
+        self.assertIn("INSERT INTO event_archives", str(checkpoint[0][0]))
+        self.assertEqual(checkpoint[0][1]["events_file"], "meetbouten_metingen_amsbi_events_10_40.csv.gz")
+
+    def test_archive_limited_to_applied(self):
+        self.connection.execute.return_value.scalar.return_value = 30
+
+        self.assertEqual(self.archiver.archive(40).archived_eventid, 30)
+
+    def test_archive_nothing(self):
+        self.connection.execute.return_value.scalar.return_value = 10
+
+        self.assertIsNone(self.archiver.archive(40))
+        self.cursor.copy_expert.assert_not_called()
+        self.storage.engine.begin.assert_not_called()
+
+    def test_archive_result(self):
+        result = ArchiveResult(10, 10, 1, Path("events"), Path("snapshot"), 100, 40, 1.0, 0.5)
+        self.assertEqual(result.reclaimed, 60)
@@ -0,0 +1,99 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy import Column, Integer, String, DateTime, JSON
+from sqlalchemy.orm import declarative_base
+
+from gobupload.storage.event_reader import EventReader
+from tests.fixtures import dict_to_object
+
+Base = declarative_base()
+
+
+class MockEvents(Base):
+    __tablename__ = "events"
+
+    eventid = Column(Integer, primary_key=True)
+    timestamp = Column(DateTime)
+    catalogue = Column(String)
+    entity = Column(String)
+    version = Column(String)
+    action = Column(String)
+    source = Column(String)
+    source_id = Column(String)
+    contents = Column(JSON)
+    application = Column(String)
+    tid = Column(String)
+
+
+class MockMeta:
+    source = "AMSBI"
+    catalogue = "meetbouten"
+    entity = "meetbouten"
+
+
+def _event(eventid):
+    event = dict_to_object({})
+    event.eventid = eventid
+    return event
+
+
+class TestEventReader(TestCase):
+
+    def setUp(self):
+        self.storage = MagicMock()
+        self.storage.DbEvent = MockEvents
+        self.storage.metadata = MockMeta
+        self.connection = self.storage.engine.connect.return_value.execution_options.return_value
+
+        self.pages = [[_event(11), _event(12)], [_event(13)], []]
+        self.connection.execute.return_value.all.side_effect = self.pages
+
+    def test_query(self):
+        reader = EventReader(self.storage, 10, page_size=2)
+        query = str(reader._query(10))
+
+        self.assertIn("SELECT events.eventid, events.timestamp, events.catalogue", query)
+        self.assertIn("events.eventid > :eventid_1 ORDER BY events.eventid ASC", query)
+        self.assertIn("LIMIT :param_1", query)
+
+    def test_read(self):
+        with EventReader(self.storage, 10, page_size=2) as reader:
+            self.assertEqual(list(reader), self.pages[:2])
+
+        self.storage.engine.connect.return_value.execution_options.assert_called_with(isolation_level="AUTOCOMMIT")
+        self.assertEqual(self.connection.execute.call_count, 3)
+
+        # keyset pagination on the last eventid of the previous page
+        params = [call[0][0].compile().params["eventid_1"] for call in self.connection.execute.call_args_list]
+        self.assertEqual(params, [10, 12, 13])
+
+        self.connection.close.assert_called_once()
+        self.assertIsNone(reader._connection)
+
+    def test_read_prefetch(self):
+        with EventReader(self.storage, 10, page_size=2, prefetch=True) as reader:
+            self.assertEqual(list(reader), self.pages[:2])
+
+        self.assertIsNone(reader._thread)
+        self.connection.close.assert_called_once()
+
+    def test_read_prefetch_exception(self):
+        self.connection.execute.return_value.all.side_effect = ValueError("any error")
+
+        with self.assertRaisesRegex(ValueError, "any error"):
+            with EventReader(self.storage, 10, prefetch=True) as reader:
+                list(reader)
+
+        self.assertIsNone(reader._thread)
+
+    @patch.object(EventReader, "_PUT_TIMEOUT", 0.01)
+    def test_read_prefetch_stopped(self):
+        # the reader thread stops when the consumer leaves the context early
+        self.connection.execute.return_value.all.side_effect = None
+        self.connection.execute.return_value.all.return_value = [_event(1)]
+
+        with EventReader(self.storage, 10, prefetch=True) as reader:
+            self.assertEqual(len(next(iter(reader))), 1)
+
+        self.assertIsNone(reader._thread)
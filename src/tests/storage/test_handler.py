@@ -9,13 +9,14 @@ from sqlalchemy.orm import declarative_base
 
 from gobcore.events.import_message import ImportMessage
 from gobcore.exceptions import GOBException
+from gobcore.typesystem import get_gob_type
 
 import sqlalchemy as sa
 from sqlalchemy.util.langhelpers import symbol
 
 from gobupload.compare.populate import Populator
 from gobupload.storage import queries
-from gobupload.storage.handler import GOBStorageHandler, StreamSession
+from gobupload.storage.handler import GOBStorageHandler, StreamSession, CopyStream
 from tests import fixtures
 
 
@@ -87,6 +88,7 @@ class TestStorageHandler(unittest.TestCase):
     @patch("gobupload.storage.handler.automap_base", MagicMock())
     @patch('gobupload.storage.handler.create_engine', MagicMock())
     def setUp(self):
+        GOBStorageHandler._collection_fields.clear()
         self.msg = fixtures.get_message_fixture()
         model = {
             "entity_id": "identificatie",
@@ -121,10 +123,14 @@ class TestStorageHandler(unittest.TestCase):
         GOBStorageHandler._set_base()
         mock_base.prepare.assert_not_called()
 
-        # automap is called, update = True
+        # automap is called, update = True, the database is reflected in a new base
         mock_base.reset_mock()
         GOBStorageHandler._set_base(update=True)
-        mock_base.prepare.assert_called_once()
+        mock_base.return_value.prepare.assert_called_once()
+        mock_base.prepare.assert_not_called()
+        mock_base.metadata.clear.assert_not_called()
+        assert GOBStorageHandler.base is mock_base.return_value
+        GOBStorageHandler.base = mock_base
 
         # no reflection, update = False
         mock_base.reset_mock()
@@ -142,6 +148,83 @@ class TestStorageHandler(unittest.TestCase):
         GOBStorageHandler._set_base(reflection_options={"only": ["table1"]})
         mock_base.metadata.reflect.assert_not_called()
 
+    @patch("gobupload.storage.handler.GOBStorageHandler.reflection_cache")
+    @patch("gobupload.storage.handler.automap_base")
+    def test_base_reflection_cache(self, mock_base, cache):
+        GOBStorageHandler.base = mock_base
+        new_base = mock_base.return_value
+        mock_table = MagicMock()
+
+        # valid cache
+        cache.load.return_value.tables = {"table1": mock_table}
+        GOBStorageHandler._set_base(update=True)
+        cache.load.assert_called_with(cache.get_key.return_value)
+        mock_table.to_metadata.assert_called_with(new_base.metadata)
+        new_base.metadata.reflect.assert_not_called()
+        new_base.prepare.assert_called_once()
+
+        # invalid cache, the full reflection is saved
+        cache.load.return_value = None
+        GOBStorageHandler._set_base(update=True)
+        new_base.metadata.reflect.assert_called_with(GOBStorageHandler.engine)
+        cache.save.assert_called_with(cache.get_key.return_value, new_base.metadata)
+
+        # a partial reflection is not saved
+        cache.reset_mock()
+        cache.load.return_value = None
+        GOBStorageHandler.base = mock_base
+        mock_base.classes = MagicMock(spec=[])
+        GOBStorageHandler._set_base(reflection_options={"only": ["table2"]})
+        mock_base.metadata.reflect.assert_called_with(GOBStorageHandler.engine, only=["table2"])
+        cache.save.assert_not_called()
+
+        # a valid cache without some of the tables, eg created outside the migrations, these are reflected
+        cache.reset_mock()
+        cache.load.return_value = MagicMock(tables={"table1": mock_table})
+        mock_base.metadata.reset_mock()
+        mock_base.metadata.tables = {"table1": mock_table}
+        GOBStorageHandler._set_base(reflection_options={"only": ["table1", "mv_table"]})
+        mock_base.metadata.reflect.assert_called_once_with(GOBStorageHandler.engine, only=["mv_table"])
+
+        mock_base.metadata.reset_mock()
+        mock_base.metadata.tables = {"table1": mock_table, "mv_table": mock_table}
+        GOBStorageHandler._set_base(reflection_options={"only": ["table1", "mv_table"]})
+        mock_base.metadata.reflect.assert_not_called()
+
+        # other reflection options bypass the cache
+        cache.reset_mock()
+        GOBStorageHandler._set_base(reflection_options={"views": True})
+        cache.load.assert_not_called()
+
+        cache.enabled = False
+        GOBStorageHandler._set_base(update=True)
+        cache.load.assert_not_called()
+
+    @patch("gobupload.storage.handler.automap_base")
+    def test_base_incremental(self, mock_base):
+        GOBStorageHandler.base = mock_base
+        mock_base.classes = MagicMock(spec=["events"])
+
+        # only the missing tables are reflected, the metadata is not cleared
+        GOBStorageHandler._set_base(reflection_options={"only": ["events", "table1"]})
+        mock_base.metadata.reflect.assert_called_with(GOBStorageHandler.engine, only=["table1"])
+        mock_base.metadata.clear.assert_not_called()
+        mock_base.prepare.assert_called_once()
+        assert GOBStorageHandler.base is mock_base
+
+    @patch("gobupload.storage.handler.GOBStorageHandler.get_collection_model")
+    def test_get_collection_fields(self, mock_model):
+        mock_model.return_value = {"all_fields": {"_tid": {"type": "GOB.String"}}}
+        GOBStorageHandler._collection_fields.clear()
+
+        fields, field_types = self.storage._get_collection_fields()
+        assert fields == {"_tid": {"type": "GOB.String"}}
+        assert field_types["_tid"] is get_gob_type("GOB.String")
+
+        # shared by all handlers of the collection
+        assert GOBStorageHandler(self.storage.metadata)._fields is fields
+        mock_model.assert_called_once()
+
     @patch("gobupload.storage.handler.GOBStorageHandler._set_base")
     def test_init(self, mock_set_base):
         storage = GOBStorageHandler()
@@ -163,6 +246,107 @@ class TestStorageHandler(unittest.TestCase):
         assert storage.metadata == MockMeta
         mock_set_base.assert_called_with(reflection_options={"only": ["events", "meetbouten_meetbouten", "table2"]})
 
+    @patch("gobupload.storage.handler.alembic.config")
+    @patch('gobupload.storage.handler.alembic.script')
+    @patch("gobupload.storage.handler.migration")
+    def test_init_storage_fingerprint(self, mock_alembic, mock_script, mock_config):
+        mock_alembic.MigrationContext.configure.return_value.get_current_revision.return_value = "revision 1"
+        mock_script.ScriptDirectory.from_config.return_value.get_current_head.return_value = "revision 1"
+
+        self.storage._set_base = MagicMock()
+        self.storage._init_indexes = MagicMock()
+        self.storage._init_relation_materialized_views = MagicMock()
+        self.storage._apply_storage_changes = MagicMock()
+        self.storage._check_configuration = MagicMock()
+        self.storage.restore_deferred_foreign_keys = MagicMock()
+        self.storage.save_storage_fingerprint = MagicMock()
+        self.storage._get_storage_definitions = MagicMock(return_value={"indexes": {}, "materialized_views": {}})
+        fingerprint = self.storage._get_fingerprint({"indexes": {}, "materialized_views": {}})
+
+        # unchanged, nothing to reconcile
+        self.storage.get_storage_fingerprint = MagicMock(return_value=fixtures.dict_to_object(
+            {"revision": "revision 1", "fingerprint": fingerprint, "definitions": {}}
+        ))
+        self.storage.init_storage()
+        self.storage._init_indexes.assert_not_called()
+        self.storage._init_relation_materialized_views.assert_not_called()
+        self.storage._apply_storage_changes.assert_not_called()
+        self.storage.save_storage_fingerprint.assert_called_with(
+            "revision 1", fingerprint, {"indexes": {}, "materialized_views": {}}
+        )
+
+        # foreign keys of an interrupted apply are restored
+        self.storage.restore_deferred_foreign_keys.assert_called_once()
+
+        # changed definitions are applied
+        self.storage.get_storage_fingerprint.return_value.fingerprint = "other"
+        self.storage.init_storage()
+        self.storage._apply_storage_changes.assert_called_with({}, {"indexes": {}, "materialized_views": {}})
+        self.storage._init_indexes.assert_not_called()
+
+        # another revision, reconcile all
+        self.storage.get_storage_fingerprint.return_value.revision = "revision 0"
+        self.storage.init_storage()
+        self.storage._init_indexes.assert_called_once()
+        self.storage._init_indexes.return_value.build.assert_called_once()
+        self.storage._init_relation_materialized_views.assert_called_once_with(False)
+
+        # indexes in the background, the fingerprint is saved when they are built
+        self.storage.invalidate_storage_fingerprint = MagicMock()
+        self.storage.save_storage_fingerprint.reset_mock()
+        builder = self.storage.init_storage(background_indexes=True)
+
+        assert builder == self.storage._init_indexes.return_value
+        builder.build.assert_called_once()
+        self.storage.invalidate_storage_fingerprint.assert_called_once()
+        self.storage.save_storage_fingerprint.assert_not_called()
+
+        builder.start.call_args.kwargs["on_complete"]()
+        self.storage.save_storage_fingerprint.assert_called_with(
+            "revision 1", fingerprint, {"indexes": {}, "materialized_views": {}}
+        )
+
+    @patch("gobupload.storage.handler.IndexBuilder")
+    @patch("gobupload.storage.handler.MaterializedViews")
+    def test_apply_storage_changes(self, mock_views, mock_builder):
+        self.storage.execute = MagicMock()
+        mock_conn = self.storage.engine.begin.return_value.__enter__.return_value = MagicMock()
+
+        mv_same, mv_changed, mv_new, mv_indexes = MagicMock(), MagicMock(), MagicMock(), MagicMock()
+        mv_same.name, mv_changed.name, mv_new.name, mv_indexes.name = "mv_same", "mv_changed", "mv_new", "mv_indexes"
+        mock_views.return_value.get_all.return_value = [mv_same, mv_changed, mv_new, mv_indexes]
+
+        old = {
+            "indexes": {"same": {"columns": ["a"]}, "changed": {"columns": ["b"]}, "dropped": {"columns": ["c"]}},
+            "materialized_views": {
+                "mv_same": {"query": "q1"}, "mv_changed": {"query": "q2"}, "mv_dropped": {},
+                "mv_indexes": {"query": "q4", "indexes": {}},
+            },
+        }
+        new = {
+            "indexes": {"same": {"columns": ["a"]}, "changed": {"columns": ["b", "c"]}, "new": {"columns": ["d"]}},
+            "materialized_views": {
+                "mv_same": {"query": "q1"}, "mv_changed": {"query": "q3"}, "mv_new": {},
+                "mv_indexes": {"query": "q4", "indexes": {"gobid": ["_gobid"]}},
+            },
+        }
+        assert self.storage._apply_storage_changes(old, new) == mock_builder.return_value
+
+        statements = [str(args[0][0]) for args in mock_conn.execute.call_args_list]
+        assert statements == ['DROP INDEX IF EXISTS "dropped"', 'DROP INDEX IF EXISTS "changed"']
+        mock_builder.assert_called_with(
+            self.storage, {"changed": {"columns": ["b", "c"]}, "new": {"columns": ["d"]}}, 2
+        )
+
+        mock_views.drop.assert_called_once_with(self.storage, "mv_dropped")
+        mv_same.create.assert_not_called()
+        mv_changed.create.assert_called_with(self.storage, force_recreate=True)
+        mv_new.create.assert_called_with(self.storage, force_recreate=False)
+
+        # only the indexes have changed
+        mv_indexes.create.assert_not_called()
+        mv_indexes._create_indexes.assert_called_with(self.storage, force_recreate=True)
+
     @patch("gobupload.storage.handler.alembic.config")
     @patch('gobupload.storage.handler.alembic.script')
     @patch("gobupload.storage.handler.migration")
@@ -262,13 +446,13 @@ class TestStorageHandler(unittest.TestCase):
         self.storage._init_relation_materialized_views()
 
         mock_materialized_views.assert_called_once()
-        mock_materialized_views.return_value.initialise.assert_called_with(self.storage, False)
+        mock_materialized_views.return_value.initialise.assert_called_with(self.storage, False, 4, False)
 
         mock_materialized_views.reset_mock()
         self.storage._init_relation_materialized_views(True)
 
         mock_materialized_views.assert_called_once()
-        mock_materialized_views.return_value.initialise.assert_called_with(self.storage, True)
+        mock_materialized_views.return_value.initialise.assert_called_with(self.storage, True, 4, False)
 
     def test_indexes_to_drop_query(self):
         expected = """
@@ -319,53 +503,217 @@ WHERE
         )
         mock_text.assert_any_call(self.storage._indexes_to_drop_query.return_value)
 
-    def test_get_existing_indexes(self):
-        mock_conn = self.storage.engine.connect.return_value.__enter__.return_value
-        mock_conn.execute.return_value.scalars.return_value.all.return_value = ['indexA', 'indexB']
+    @patch("gobupload.storage.handler.IndexBuilder")
+    @patch('gobupload.storage.handler.get_indexes')
+    def test_init_indexes(self, mock_get_indexes, mock_builder):
+        self.storage._drop_indexes = MagicMock()
 
-        assert ['indexA', 'indexB'] == self.storage._get_existing_indexes()
+        assert self.storage._init_indexes() == mock_builder.return_value
+
+        self.storage._drop_indexes.assert_called_with(mock_get_indexes.return_value)
+        mock_builder.assert_called_with(self.storage, mock_get_indexes.return_value, 2)
+
+    def test_create_index_statement(self):
+        definitions = {
+            "indexname": {"table_name": "sometable", "columns": ["cola", "colb"]},
+            "geo_index": {"table_name": "table_with_geo", "columns": ["geocol"], "type": "geo"},
+            "json_index": {"table_name": "table_with_json", "columns": ["somejsoncol"], "type": "json"},
+        }
+        statements = [self.storage._create_index_statement(name, definitions[name]) for name in definitions]
+        assert statements == [
+            'CREATE INDEX IF NOT EXISTS "indexname" ON sometable USING BTREE(cola,colb)',
+            'CREATE INDEX IF NOT EXISTS "geo_index" ON table_with_geo USING GIST(geocol) WHERE ST_IsValid(geocol)',
+            'CREATE INDEX IF NOT EXISTS "json_index" ON table_with_json USING GIN(somejsoncol)',
+        ]
+
+        assert self.storage._create_index_statement("indexname", definitions["indexname"], concurrently=True) == \
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS "indexname" ON sometable USING BTREE(cola,colb)'
 
-    @patch("gobupload.storage.handler.text")
     @patch('gobupload.storage.handler.get_indexes')
-    def test_init_indexes(self, mock_get_indexes, mock_text):
+    def test_get_managed_indexes(self, mock_get_indexes):
         mock_get_indexes.return_value = {
-            "indexname": {
-                "table_name": "sometable",
-                "columns": ["cola", "colb"],
-            },
-            "index2name": {
-                "table_name": "someothertable",
-                "columns": ["cola"],
-            },
-            "geo_index": {
-                "table_name": "table_with_geo",
-                "columns": ["geocol"],
-                "type": "geo",
-            },
-            "json_index": {
-                "table_name": "table_with_json",
-                "columns": ["somejsoncol"],
-                "type": "json",
-            },
-            "existing": {
+            "index1": {"table_name": "meetbouten_meetbouten", "columns": ["_tid"]},
+            "index2": {"table_name": "other_table", "columns": ["cola"]},
+        }
+        assert self.storage.get_managed_indexes() == {
+            "index1": {"table_name": "meetbouten_meetbouten", "columns": ["_tid"]}
+        }
 
-            }
+    def test_create_indexes(self):
+        mock_conn = self.storage.engine.begin.return_value.__enter__.return_value = MagicMock()
+        indexes = {
+            "index1": {"table_name": "sometable", "columns": ["cola"]},
+            "index2": {"table_name": "sometable", "columns": ["geocol"], "type": "geo"},
         }
 
-        self.storage._drop_indexes = MagicMock()
-        self.storage._get_existing_indexes = lambda: ['existing']
+        self.storage.create_indexes(indexes, workers=2)
 
-        self.storage._init_indexes()
+        statements = sorted(str(args[0][0]) for args in mock_conn.execute.call_args_list)
+        assert statements == [
+            'CREATE INDEX IF NOT EXISTS "index1" ON sometable USING BTREE(cola)',
+            'CREATE INDEX IF NOT EXISTS "index2" ON sometable USING GIST(geocol) WHERE ST_IsValid(geocol)',
+        ]
+
+    @patch("gobupload.storage.handler.logger", MagicMock())
+    def test_deferred_indexes(self):
+        mock_conn = self.storage.engine.begin.return_value.__enter__.return_value = MagicMock()
+        self.storage.create_indexes = MagicMock()
+        self.storage.invalidate_storage_fingerprint = MagicMock()
+        self.storage.save_storage_fingerprint = MagicMock()
+        stored = MagicMock(revision="head", fingerprint="fp", definitions={"indexes": {}})
+        self.storage.get_storage_fingerprint = MagicMock(return_value=stored)
+        self.storage.get_managed_indexes = MagicMock(return_value={
+            "tid_index": {"table_name": "meetbouten_meetbouten", "columns": ["_tid"]},
+            "source_index": {"table_name": "meetbouten_meetbouten", "columns": ["_source", "_last_event"]},
+            "last_event_index": {"table_name": "meetbouten_meetbouten", "columns": ["_last_event"]},
+            "index1": {"table_name": "meetbouten_meetbouten", "columns": ["cola"]},
+        })
+
+        with self.assertRaises(ValueError):
+            with self.storage.deferred_indexes(workers=3):
+                self.storage.create_indexes.assert_not_called()
+                raise ValueError("any error")
+
+        # the indexes read by the apply are kept, the other indexes are rebuilt, also on errors
+        self.storage.invalidate_storage_fingerprint.assert_called_once()
+        mock_conn.execute.assert_called_once()
+        assert str(mock_conn.execute.call_args[0][0]) == 'DROP INDEX IF EXISTS "index1"'
+        self.storage.create_indexes.assert_called_once_with(
+            {"index1": {"table_name": "meetbouten_meetbouten", "columns": ["cola"]}}, 3
+        )
+        # the indexes have been rebuilt, the fingerprint is restored
+        self.storage.save_storage_fingerprint.assert_called_once_with("head", "fp", {"indexes": {}})
+
+        # the fingerprint is left invalid when the rebuild fails
+        self.storage.save_storage_fingerprint.reset_mock()
+        self.storage.create_indexes.side_effect = ValueError("rebuild error")
+        with self.assertRaises(ValueError):
+            with self.storage.deferred_indexes():
+                pass
+        self.storage.save_storage_fingerprint.assert_not_called()
+
+        # nothing to restore when the storage has not been reconciled yet
+        self.storage.create_indexes.side_effect = None
+        self.storage.get_storage_fingerprint.return_value = None
+        with self.storage.deferred_indexes():
+            pass
+        self.storage.save_storage_fingerprint.assert_not_called()
+
+    def test_get_foreign_keys(self):
+        mock_conn = self.storage.engine.connect.return_value.__enter__.return_value = MagicMock()
+        mock_conn.execute.return_value.all.return_value = [
+            ("fk1", "FOREIGN KEY (src_id) REFERENCES a(_id)"),
+            ("fk2", "FOREIGN KEY (dst_id) REFERENCES b(_id) NOT VALID"),
+        ]
+
+        assert self.storage.get_foreign_keys() == {
+            "fk1": "FOREIGN KEY (src_id) REFERENCES a(_id)",
+            "fk2": "FOREIGN KEY (dst_id) REFERENCES b(_id)",
+        }
+        assert "conrelid = '\"meetbouten_meetbouten\"'::regclass" in str(mock_conn.execute.call_args[0][0])
+
+    @patch("gobupload.storage.handler.logger", MagicMock())
+    def test_validate_foreign_keys(self):
+        mock_conn = self.storage.engine.begin.return_value.__enter__.return_value = MagicMock()
+
+        self.storage.validate_foreign_keys(["fk1"])
+        assert str(mock_conn.execute.call_args[0][0]) == \
+            'ALTER TABLE "meetbouten_meetbouten" VALIDATE CONSTRAINT "fk1"'
+
+        mock_conn.execute.side_effect = [None, sa.exc.IntegrityError("stmt", {}, Exception("violation"))]
+        with self.assertRaisesRegex(GOBException, "meetbouten_meetbouten: fk2"):
+            self.storage.validate_foreign_keys(["fk1", "fk2"])
+
+    @patch("gobupload.storage.handler.logger", MagicMock())
+    def test_deferred_foreign_keys(self):
+        mock_conn = self.storage.engine.begin.return_value.__enter__.return_value = MagicMock()
+        mock_connect = self.storage.engine.connect.return_value
+        lock_conn = mock_connect.execution_options.return_value.__enter__.return_value
+        self.storage.validate_foreign_keys = MagicMock()
+        self.storage.get_foreign_keys = MagicMock(return_value={"fk1": "FOREIGN KEY (src_id) REFERENCES a(_id)"})
+        mock_conn.execute.return_value.all.return_value = []
+
+        def statements():
+            return [str(args[0][0]) for args in mock_conn.execute.call_args_list]
+
+        with self.storage.deferred_foreign_keys():
+            # leftovers of an interrupted apply are restored first
+            assert "DELETE FROM deferred_foreign_keys" in statements()[0]
+
+            # the constraint is dropped and recorded in the same transaction
+            assert statements()[1] == 'ALTER TABLE "meetbouten_meetbouten" DROP CONSTRAINT IF EXISTS "fk1"'
+            assert "INSERT INTO deferred_foreign_keys" in statements()[2]
+            assert mock_conn.execute.call_args[0][1] == {
+                "tablename": "meetbouten_meetbouten",
+                "name": "fk1",
+                "definition": "FOREIGN KEY (src_id) REFERENCES a(_id)"
+            }
+
+            # the table is locked while the foreign keys are deferred
+            assert "pg_advisory_lock" in str(lock_conn.execute.call_args[0][0])
+
+        mock_connect.execution_options.assert_called_with(isolation_level="AUTOCOMMIT")
+        assert "pg_advisory_unlock" in str(lock_conn.execute.call_args[0][0])
+        assert "DELETE FROM deferred_foreign_keys" in statements()[-1]
+        self.storage.validate_foreign_keys.assert_called_once_with({"fk1": ANY})
+
+        # on errors the constraints are restored but not validated
+        self.storage.validate_foreign_keys.reset_mock()
+        mock_conn.execute.reset_mock()
+        with self.assertRaises(ValueError):
+            with self.storage.deferred_foreign_keys():
+                raise ValueError("any error")
 
-        mock_conn = self.storage.engine.begin.return_value.__enter__.return_value
-        mock_text.assert_has_calls([
-            call("CREATE INDEX IF NOT EXISTS \"indexname\" ON sometable USING BTREE(cola,colb)"),
-            call("CREATE INDEX IF NOT EXISTS \"index2name\" ON someothertable USING BTREE(cola)"),
-            call("CREATE INDEX IF NOT EXISTS \"geo_index\" ON table_with_geo USING GIST(geocol) WHERE ST_IsValid(geocol)"),
-            call("CREATE INDEX IF NOT EXISTS \"json_index\" ON table_with_json USING GIN(somejsoncol)"),
-        ])
         assert mock_conn.execute.call_count == 4
-        self.storage._drop_indexes.assert_called_once()
+        assert "pg_advisory_unlock" in str(lock_conn.execute.call_args[0][0])
+        self.storage.validate_foreign_keys.assert_not_called()
+
+    def test_restore_foreign_keys(self):
+        mock_conn = MagicMock()
+        mock_conn.execute.return_value.all.return_value = [("fk1", "FOREIGN KEY (src_id) REFERENCES a(_id)")]
+
+        assert self.storage._restore_foreign_keys(mock_conn, "rel_table") == ["fk1"]
+
+        delete, add = mock_conn.execute.call_args_list
+        assert "DELETE FROM deferred_foreign_keys" in str(delete[0][0])
+        assert "RETURNING name, definition" in str(delete[0][0])
+        assert delete[0][1] == {"tablename": "rel_table"}
+        assert str(add[0][0]) == \
+            'ALTER TABLE "rel_table" ADD CONSTRAINT "fk1" FOREIGN KEY (src_id) REFERENCES a(_id) NOT VALID'
+
+    @patch("builtins.print", MagicMock())
+    def test_restore_deferred_foreign_keys(self):
+        mock_connect = self.storage.engine.connect.return_value
+        lock_conn = mock_connect.execution_options.return_value.__enter__.return_value
+        lock_conn.execute.return_value.scalars.return_value.all.return_value = ["rel_a", "rel_b"]
+        # rel_a is being applied by another process
+        lock_conn.execute.return_value.scalar.side_effect = [False, True, None]
+
+        self.storage._restore_foreign_keys = MagicMock(return_value=["fk1"])
+        self.storage.validate_foreign_keys = MagicMock(side_effect=GOBException("any violation"))
+
+        self.storage.restore_deferred_foreign_keys()
+
+        self.storage._restore_foreign_keys.assert_called_once_with(ANY, "rel_b")
+        self.storage.validate_foreign_keys.assert_called_once_with(["fk1"], "rel_b")
+        assert "pg_try_advisory_lock" in str(lock_conn.execute.call_args_list[1][0][0])
+        assert "pg_advisory_unlock" in str(lock_conn.execute.call_args_list[-1][0][0])
+        assert lock_conn.execute.call_args_list[-1][0][1] == {"lock": 19935913, "tablename": "rel_b"}
+
+    def test_get_table_size_estimate(self):
+        # never analyzed, the rows are counted
+        self.storage.get_query_value = MagicMock(side_effect=[-1.0, 56])
+        assert self.storage.get_table_size_estimate() == 56
+        self.storage.get_query_value.assert_called_with('SELECT COUNT(*) FROM "meetbouten_meetbouten"')
+
+        self.storage.get_query_value = MagicMock(side_effect=[0.0, 0])
+        assert self.storage.get_table_size_estimate() == 0
+
+        self.storage.get_query_value = MagicMock(return_value=1234.0)
+        assert self.storage.get_table_size_estimate() == 1234
+        self.storage.get_query_value.assert_called_with(
+            "SELECT reltuples FROM pg_class WHERE oid = 'meetbouten_meetbouten'::regclass"
+        )
 
     @patch("gobupload.storage.handler.Table")
     def test_create_temporary_table(self, mock_table):
@@ -446,39 +794,28 @@ WHERE
         mock_text.assert_called_with('SELECT * FROM test')
 
     def test_get_source_catalogue_entity_combinations(self):
-        class MockRow:
-            catalogue = "cat"
-            entity = "ent"
-            source = "src"
+        mock_conn = self.storage.engine.connect.return_value.__enter__.return_value = MagicMock()
+        mock_conn.execute.return_value = ["row1", "row2"]
 
-        mock_conn = MagicMock(spec=Connection)
-
-        mock_execute1 = MagicMock()
-        mock_execute1.scalars.return_value = ["table1"]
+        result = list(self.storage.get_source_catalogue_entity_combinations("cat", "ent"))
+        assert result == ["row1", "row2"]
 
-        mock_conn.__enter__.return_value.execute.side_effect = [mock_execute1, [MockRow()]]
-        self.storage.engine.connect.return_value = mock_conn
+        query, params = mock_conn.execute.call_args[0]
+        assert str(query) == "SELECT catalogue, entity, source FROM event_partitions " \
+                             "WHERE catalogue = :catalogue AND entity = :entity ORDER BY 1, 2, 3"
+        assert params == {"catalogue": "cat", "entity": "ent", "source": ""}
 
-        result = next(self.storage.get_source_catalogue_entity_combinations("cat", "ent"))
-        assert result.catalogue == "cat"
-        assert result.entity == "ent"
-        assert result.source == "src"
+        list(self.storage.get_source_catalogue_entity_combinations("cat", None, source="SRC"))
+        query = str(mock_conn.execute.call_args[0][0])
+        assert "WHERE catalogue = :catalogue AND lower(source) = lower(:source) ORDER" in query
 
-        query = mock_conn.__enter__.return_value.execute.call_args[0][0]
-        query = str(query.compile(compile_kwargs={"literal_binds": True}))
-        expected = 'SELECT catalogue, entity, source FROM events.table1 LIMIT 1'
-        assert query == expected
+    def test_backfill_event_partitions(self):
+        mock_conn = self.storage.engine.begin.return_value.__enter__.return_value = MagicMock()
+        self.storage.get_query_value = MagicMock(return_value=12)
 
-        # empty result
-        mock_execute1.scalars.return_value = []
-        mock_conn.__enter__.return_value.execute.side_effect = [mock_execute1, [MockRow()]]
-        result = list(self.storage.get_source_catalogue_entity_combinations("cat", "ent"))
-        assert result == []
-
-        mock_execute1.scalars.return_value = [mock_execute1]
-        mock_conn.__enter__.return_value.execute.side_effect = [mock_execute1, []]
-        result = list(self.storage.get_source_catalogue_entity_combinations("cat", "ent"))
-        assert result == []
+        assert self.storage.backfill_event_partitions() == 12
+        assert "INSERT INTO event_partitions" in str(mock_conn.execute.call_args[0][0])
+        self.storage.get_query_value.assert_called_with("SELECT COUNT(*) FROM event_partitions")
 
     @patch("gobupload.storage.handler.text")
     def test_analyze_table(self, mock_text):
@@ -491,9 +828,32 @@ WHERE
         self.storage.engine.connect.return_value.execution_options.return_value.__enter__.return_value \
             .execute.assert_called_with(mock_text.return_value)
 
+        self.storage.analyze_table(vacuum=False)
+        mock_text.assert_called_with("ANALYZE meetbouten_meetbouten")
+
+    def test_get_table_statistics(self):
+        mock_conn = self.storage.engine.connect.return_value.__enter__.return_value = MagicMock()
+
+        result = self.storage.get_table_statistics()
+        assert result == mock_conn.execute.return_value.one_or_none.return_value
+        assert "relid = '\"meetbouten_meetbouten\"'::regclass" in str(mock_conn.execute.call_args[0][0])
+
+    def test_add_entities(self):
+        self.storage.session = MagicMock()
+        self.storage.add_entities([{"_tid": "1", "name": "a"}, {"_tid": "2", "_date_deleted": "any date"}])
+
+        _, rows = self.storage.session.execute.call_args[0]
+        assert rows == [
+            {"_tid": "1", "name": "a", "_date_deleted": None},
+            {"_tid": "2", "name": None, "_date_deleted": "any date"},
+        ]
+
     @patch("gobupload.storage.handler.execute_values")
     def test_add_events(self, mock_values):
         self.storage.session = MagicMock()
+        self.storage.event_partitions = MagicMock()
+        self.storage.event_partitions.get.return_value = "events.meetbouten_meetbouten_src"
+        self.storage.event_partitions.sequence = "events_eventid_seq"
         metadata = fixtures.get_metadata_fixture()
         event = fixtures.get_event_fixture(metadata, "ADD")
         event["data"] = {
@@ -509,11 +869,11 @@ WHERE
 
         mock_values.assert_called_with(
             self.storage.session.bind.connection.cursor.return_value.__enter__.return_value,
-            'INSERT INTO events ("timestamp", "catalogue", "entity", "version", "action", '
-            '"source", "source_id", "contents", "application", "tid") VALUES %s',
+            'INSERT INTO events.meetbouten_meetbouten_src (eventid, "timestamp", "catalogue", "entity", "version", '
+            '"action", "source", "source_id", "contents", "application", "tid") VALUES %s',
             ANY,
-            '(%s::timestamp, %s::varchar, %s::varchar, %s::varchar, %s::varchar, %s::varchar, '
-            '%s::varchar, %s::jsonb, %s::varchar, %s::varchar)',
+            "(nextval('events_eventid_seq'), %s::timestamp, %s::varchar, %s::varchar, %s::varchar, %s::varchar, "
+            "%s::varchar, %s::varchar, %s::jsonb, %s::varchar, %s::varchar)",
             page_size=2000,
             fetch=False
         )
@@ -534,6 +894,37 @@ WHERE
         )]
         assert list(mock_values.call_args[0][2]) == argslist
 
+        # the last eventid watermark is advanced in the same transaction
+        mock_cursor = self.storage.session.bind.connection.cursor.return_value.__enter__.return_value
+        params = {
+            "catalogue": self.storage.metadata.catalogue,
+            "entity": self.storage.metadata.entity,
+            "source": self.storage.metadata.source,
+        }
+        mock_cursor.execute.assert_called_once_with(ANY, params)
+        assert "currval('events_eventid_seq')" in mock_cursor.execute.call_args[0][0]
+
+        self.storage.event_partitions.get.assert_called_with(
+            "meetbouten", "meetbouten", self.storage.metadata.source
+        )
+
+        # events are added in a session
+        self.storage.session = None
+        with self.assertRaisesRegex(GOBException, "No current session"):
+            self.storage.add_events([event])
+
+    def test_get_event_partition(self):
+        # the partition is created before the events session starts, it has its own connection
+        self.storage.event_partitions = MagicMock()
+        self.storage.session = None
+
+        result = self.storage.get_event_partition()
+
+        self.assertEqual(result, self.storage.event_partitions.get.return_value)
+        self.storage.event_partitions.get.assert_called_with(
+            "meetbouten", "meetbouten", self.storage.metadata.source
+        )
+
     @patch("gobupload.storage.handler.text")
     @patch("gobupload.storage.handler.SessionORM.scalars")
     @patch("gobupload.storage.handler.SessionORM.execute")
@@ -567,55 +958,249 @@ WHERE
         obj.execute(stmt, extra=5)
         mock_execute.assert_called_with(stmt, extra=5)
 
-    def test_apply_confirms(self):
+    def test_apply_confirms_staged(self):
         mock_session = MagicMock(spec=StreamSession)
+        mock_session.bind = MagicMock()
         self.storage.session = mock_session
+        timestamp = datetime.datetime(2023, 6, 6).isoformat()
+
+        with patch("gobupload.storage.handler.random_string", MagicMock(return_value="abcdefgh")):
+            result = self.storage.apply_confirms_staged(iter(["confirm1", "confirm2"]), timestamp)
 
-        confirms = [{"_tid": "confirm1"}, {"_tid": "confirm2"}]
+        assert result == mock_session.execute.return_value.rowcount
+
+        cursor = mock_session.bind.connection.cursor.return_value.__enter__.return_value
+        sql, stream = cursor.copy_expert.call_args[0]
+        assert sql == "COPY tmp_confirms_abcdefgh (_tid) FROM STDIN WITH (FORMAT csv)"
+        assert stream.read() == '"confirm1"\n"confirm2"\n'
+
+        statements = [str(args[0][0]) for args in mock_session.execute.call_args_list]
+        assert statements[0] == "CREATE TEMPORARY TABLE tmp_confirms_abcdefgh (_tid varchar) ON COMMIT DROP"
+        assert "SET _date_confirmed = :timestamp" in statements[-1]
+        assert "entity._date_confirmed IS DISTINCT FROM :timestamp" in statements[-1]
+        assert mock_session.execute.call_args[0][1] == {"timestamp": datetime.datetime(2023, 6, 6)}
+
+    def test_apply_confirm_all(self):
+        mock_session = MagicMock(spec=StreamSession)
+        self.storage.session = mock_session
         timestamp = datetime.datetime(2023, 6, 6).isoformat()
 
-        self.storage.apply_confirms(confirms, timestamp)
+        self.storage.apply_confirm_all(timestamp)
 
-        query = mock_session.execute.call_args[0][0]
-        compiled = query.compile(compile_kwargs={"literal_binds": False})
+        assert mock_session.execute.call_count == 1
+        query, params = mock_session.execute.call_args[0]
+        assert "SET _date_confirmed = :timestamp" in str(query)
+        assert "_source = :source AND _date_deleted IS NULL" in str(query)
+        assert params == {"source": "any source", "timestamp": datetime.datetime(2023, 6, 6)}
 
-        expected = (
-            "UPDATE meetbouten_meetbouten "
-            "SET _date_confirmed=:_date_confirmed "
-            "FROM (VALUES (:param_1), (:param_2)) AS tids (_tid) "
-            "WHERE meetbouten_meetbouten._tid = tids._tid AND "
-            "meetbouten_meetbouten._date_confirmed != :date_confirmed_1"
+    def test_upload_fingerprint(self):
+        self.storage.get_event_watermarks = MagicMock(return_value=(8, 10))
+        self.storage.rebuild_event_watermarks = MagicMock(return_value=(8, 11))
+        mock_conn = self.storage.engine.connect.return_value.__enter__.return_value
+
+        mock_conn.execute.return_value.first.return_value = fixtures.dict_to_object(
+            {"fingerprint": "any fingerprint", "last_eventid": 10}
         )
-        assert str(compiled) == expected
-        assert compiled.params == {
-            '_date_confirmed': datetime.datetime(2023, 6, 6, 0, 0),
-            'date_confirmed_1': datetime.datetime(2023, 6, 6, 0, 0),
-            'param_1': 'confirm1',
-            'param_2': 'confirm2'
+        assert self.storage.get_upload_fingerprint("any application") == "any fingerprint"
+        assert mock_conn.execute.call_args[0][1] == {
+            "catalogue": "meetbouten", "entity": "meetbouten", "source": "any source", "application": "any application"
         }
 
-    @patch("gobupload.storage.handler.StreamSession", spec=StreamSession)
-    def test_get_events_starting_after(self, mock_session):
-        mock_row = MockEvents(eventid=14)
-        mock_sess = mock_session.return_value.__enter__.return_value
-        mock_sess.scalars.return_value.all.return_value = [mock_row]
-
-        result = self.storage.get_events_starting_after(12)
-        assert result[0].eventid == 14
-
-        query = mock_sess.scalars.call_args_list[0][0][0]
-        query = str(query.compile(compile_kwargs={"literal_binds": True}))
-
-        expected = "\n".join([
-            "SELECT events.eventid, events.timestamp, events.catalogue, "
-            "events.entity, events.version, events.action, events.source, "
-            "events.source_id, events.contents, events.application, events.tid ",
-            "FROM events ",
-            "WHERE events.source = 'any source' "
-            "AND events.catalogue = 'meetbouten' "
-            "AND events.entity = 'meetbouten' "
-            "AND events.eventid > 12 "
-            "ORDER BY events.eventid ASC",
-            " LIMIT 10000"
-        ])
-        assert query == expected
+        # events have been added since the upload was applied
+        self.storage.get_event_watermarks.return_value = None
+        assert self.storage.get_upload_fingerprint("any application") is None
+
+        mock_conn.execute.return_value.first.return_value = None
+        assert self.storage.get_upload_fingerprint("any application") is None
+
+        mock_conn = self.storage.engine.begin.return_value.__enter__.return_value = MagicMock()
+        self.storage.save_upload_fingerprint("any application", "any fingerprint")
+
+        query, params = mock_conn.execute.call_args[0]
+        assert "INSERT INTO upload_fingerprints" in str(query)
+        assert params["fingerprint"] == "any fingerprint"
+        assert params["last_eventid"] == 11
+
+    def test_copy_stream(self):
+        stream = CopyStream(['a', 'b"c'])
+        assert stream.read(3) == '"a"'
+        assert stream.read(100) == '\n"b""c"\n'
+        assert stream.read(100) == ''
+
+    def test_get_prepared_session(self):
+        transaction = MagicMock()
+        self.storage.Session = MagicMock()
+        session = self.storage.Session.return_value
+
+        with self.storage.get_prepared_session(transaction) as result:
+            assert result == session
+            assert self.storage.session == session
+
+        self.storage.Session.assert_called_with(bind=transaction.connection)
+        session.flush.assert_called_once()
+        transaction.prepare.assert_called_once()
+        transaction.rollback.assert_not_called()
+        session.close.assert_called_once()
+        assert self.storage.session is None
+
+        transaction.reset_mock()
+        with self.assertRaises(ValueError):
+            with self.storage.get_prepared_session(transaction):
+                raise ValueError("any error")
+
+        transaction.prepare.assert_not_called()
+        transaction.rollback.assert_called_once()
+
+    def test_get_apply_xid(self):
+        assert self.storage.get_apply_xid("100", 2) == "gob_apply.meetbouten_meetbouten.any source.100.2"
+        assert self.storage.get_apply_xid("100", "") == "gob_apply.meetbouten_meetbouten.any source.100."
+
+    def test_commit_decision(self):
+        mock_conn = self.storage.engine.begin.return_value.__enter__.return_value = MagicMock()
+
+        self.storage.add_commit_decision("100", 120)
+        decision, watermark = mock_conn.execute.call_args_list
+        assert decision[0][1] == {"xid": "gob_apply.meetbouten_meetbouten.any source.100."}
+        assert "INSERT INTO apply_commit_decisions" in str(decision[0][0])
+        assert watermark[0][1]["eventid"] == 120
+        assert "UPDATE event_watermarks" in str(watermark[0][0])
+
+        self.storage.delete_commit_decision("100")
+        mock_conn.execute.assert_called_with(ANY, {"xid": "gob_apply.meetbouten_meetbouten.any source.100."})
+        assert "DELETE FROM apply_commit_decisions" in str(mock_conn.execute.call_args[0][0])
+
+    def test_get_last_eventid_archived(self):
+        mock_conn = self.storage.engine.connect.return_value.__enter__.return_value = MagicMock()
+        mock_conn.execute.return_value.scalar.side_effect = [12, None, 10]
+
+        assert self.storage.get_last_eventid() == 12
+
+        # all events have been archived
+        assert self.storage.get_last_eventid() == 10
+        assert "FROM event_archives" in str(mock_conn.execute.call_args[0][0])
+
+    def test_get_last_event_archive(self):
+        mock_conn = self.storage.engine.connect.return_value.__enter__.return_value = MagicMock()
+        mock_conn.execute.return_value.first.return_value = None
+
+        assert self.storage.get_last_event_archive() is None
+        assert "ORDER BY archived_eventid DESC" in str(mock_conn.execute.call_args[0][0])
+
+    def test_get_event_watermarks(self):
+        mock_conn = self.storage.engine.connect.return_value.__enter__.return_value = MagicMock()
+
+        mock_conn.execute.return_value.first.return_value = None
+        assert self.storage.get_event_watermarks() is None
+
+        mock_conn.execute.return_value.first.return_value = fixtures.dict_to_object(
+            {"applied_eventid": 10, "last_eventid": 12}
+        )
+        assert self.storage.get_event_watermarks() == (10, 12)
+        assert mock_conn.execute.call_args[0][1] == {
+            "catalogue": "meetbouten", "entity": "meetbouten", "source": self.storage.metadata.source
+        }
+
+    def test_rebuild_event_watermarks(self):
+        mock_conn = self.storage.engine.begin.return_value.__enter__.return_value = MagicMock()
+        mock_conn.execute.return_value.one.return_value = fixtures.dict_to_object(
+            {"applied_eventid": 11, "last_eventid": 12}
+        )
+        self.storage.get_entity_max_eventid = MagicMock(return_value=10)
+        self.storage.get_last_eventid = MagicMock(return_value=12)
+
+        assert self.storage.rebuild_event_watermarks() == (11, 12)
+
+        # a stored applied eventid beyond the highest entity eventid is kept
+        query = str(mock_conn.execute.call_args[0][0])
+        assert "INSERT INTO event_watermarks" in query
+        assert "GREATEST(EXCLUDED.applied_eventid, LEAST(w.applied_eventid, EXCLUDED.last_eventid))" in query
+        assert mock_conn.execute.call_args[0][1]["applied_eventid"] == 10
+        assert mock_conn.execute.call_args[0][1]["last_eventid"] == 12
+
+    def test_rebuild_event_watermarks_reset(self):
+        mock_conn = self.storage.engine.begin.return_value.__enter__.return_value = MagicMock()
+        mock_conn.execute.return_value.one.return_value = fixtures.dict_to_object(
+            {"applied_eventid": 10, "last_eventid": 12}
+        )
+        # the rebuilt table holds the events up to 10, events 11 and 12 have been applied to the old table
+        self.storage.get_entity_max_eventid = MagicMock(return_value=10)
+        self.storage.get_last_eventid = MagicMock(return_value=12)
+
+        assert self.storage.rebuild_event_watermarks(reset=True) == (10, 12)
+
+        # the stored applied eventid (12) is overwritten, events 11 and 12 are applied again by the next apply
+        query = str(mock_conn.execute.call_args[0][0])
+        assert "applied_eventid = EXCLUDED.applied_eventid," in query
+        assert "GREATEST" not in query
+        assert mock_conn.execute.call_args[0][1]["applied_eventid"] == 10
+
+    @patch("gobupload.storage.handler.logger", MagicMock())
+    def test_verify_event_watermarks(self):
+        self.storage.get_entity_max_eventid = MagicMock(return_value=10)
+        self.storage.get_last_eventid = MagicMock(return_value=12)
+        self.storage.rebuild_event_watermarks = MagicMock()
+
+        self.storage.get_event_watermarks = MagicMock(return_value=(10, 12))
+        assert self.storage.verify_event_watermarks(rebuild=True) is True
+        self.storage.rebuild_event_watermarks.assert_not_called()
+
+        # skipped or no-op events advance the applied eventid beyond the highest entity eventid
+        self.storage.get_event_watermarks.return_value = (12, 12)
+        assert self.storage.verify_event_watermarks(rebuild=True) is True
+        self.storage.rebuild_event_watermarks.assert_not_called()
+
+        for watermarks in [None, (9, 12), (13, 13)]:
+            self.storage.get_event_watermarks.return_value = watermarks
+            assert self.storage.verify_event_watermarks() is False
+
+        self.storage.get_event_watermarks.return_value = (10, 11)
+        assert self.storage.verify_event_watermarks() is False
+        self.storage.rebuild_event_watermarks.assert_not_called()
+
+        assert self.storage.verify_event_watermarks(rebuild=True) is False
+        self.storage.rebuild_event_watermarks.assert_called_once()
+
+    def test_advance_applied_eventid(self):
+        self.storage.session = MagicMock()
+        self.storage.advance_applied_eventid(100)
+        assert "GREATEST(applied_eventid, :eventid)" in str(self.storage.session.execute.call_args[0][0])
+        assert self.storage.session.execute.call_args[0][1]["eventid"] == 100
+
+        connection = MagicMock()
+        self.storage.advance_applied_eventid(101, connection)
+        assert connection.execute.call_args[0][1]["eventid"] == 101
+
+    def test_apply_lock(self):
+        mock_conn = self.storage.engine.connect.return_value.execution_options.return_value.__enter__.return_value
+
+        with self.storage.apply_lock():
+            assert str(mock_conn.execute.call_args[0][0]) == "SELECT pg_advisory_lock(:lock, hashtext(:name))"
+
+        assert str(mock_conn.execute.call_args[0][0]) == "SELECT pg_advisory_unlock(:lock, hashtext(:name))"
+        assert mock_conn.execute.call_args[0][1] == {"lock": 19935914, "name": "meetbouten_meetbouten.any source"}
+
+    def test_recover_prepared_transactions(self):
+        mock_conn = self.storage.engine.connect.return_value.execution_options.return_value.__enter__.return_value
+        self.storage.apply_lock = MagicMock()
+
+        # nothing to recover
+        mock_conn.execute.return_value.scalars.return_value.all.return_value = []
+        self.storage.recover_prepared_transactions()
+        assert mock_conn.execute.call_count == 1
+        assert mock_conn.execute.call_args[0][1] == {"prefix": "gob_apply.meetbouten_meetbouten.any source."}
+
+        # page 100 has a commit decision, page 200 has not
+        mock_conn.reset_mock()
+        mock_conn.execute.return_value.scalars.return_value.all.side_effect = [
+            ["gob_apply.meetbouten_meetbouten.any source.100.0", "gob_apply.meetbouten_meetbouten.any source.200.1"],
+            ["gob_apply.meetbouten_meetbouten.any source.100."]
+        ]
+        self.storage.recover_prepared_transactions()
+
+        # the prepared transactions of a running apply of the collection and source are not recovered
+        self.storage.apply_lock.return_value.__enter__.assert_called()
+
+        statements = [str(args[0][0]) for args in mock_conn.execute.call_args_list]
+        assert "COMMIT PREPARED 'gob_apply.meetbouten_meetbouten.any source.100.0'" in statements
+        assert "ROLLBACK PREPARED 'gob_apply.meetbouten_meetbouten.any source.200.1'" in statements
+        assert statements[-1] == "DELETE FROM apply_commit_decisions WHERE xid ^@ :prefix"
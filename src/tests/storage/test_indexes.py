@@ -0,0 +1,99 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy.exc import OperationalError
+
+from gobcore.exceptions import GOBException
+
+from gobupload.storage.indexes import IndexBuilder, IndexBuildProgress
+
+
+@patch("builtins.print", MagicMock())
+class TestIndexBuilder(TestCase):
+
+    def setUp(self):
+        self.storage = MagicMock()
+        self.storage._create_index_statement.side_effect = \
+            lambda name, definition, concurrently: f"CREATE INDEX {'CONCURRENTLY ' * concurrently}{name}"
+
+        mock_connect = self.storage.engine.connect.return_value
+        self.connection = mock_connect.execution_options.return_value.__enter__.return_value
+        # existing indexes and whether they are valid
+        self.connection.execute.return_value.all.return_value = [("valid", True), ("invalid", False)]
+
+        self.indexes = {
+            "valid": {"table_name": "sometable", "columns": ["a"]},
+            "invalid": {"table_name": "sometable", "columns": ["b"]},
+            "missing": {"table_name": "sometable", "columns": ["c"]},
+        }
+
+    def _statements(self):
+        return [str(args[0][0]) for args in self.connection.execute.call_args_list]
+
+    def test_build(self):
+        builder = IndexBuilder(self.storage, self.indexes, workers=2)
+
+        progress = builder.build()
+
+        self.assertEqual(progress.total, 2)
+        self.assertEqual(sorted(progress.created), ["invalid", "missing"])
+        self.assertTrue(progress.finished)
+        self.assertEqual(progress.done, 2)
+
+        self.storage.engine.connect.return_value.execution_options.assert_called_with(isolation_level="AUTOCOMMIT")
+
+        statements = self._statements()
+        self.assertIn("pg_advisory_lock", statements[0])
+        self.assertIn("pg_advisory_unlock", statements[-1])
+        self.assertIn("CREATE INDEX CONCURRENTLY missing", statements)
+        self.assertNotIn("CREATE INDEX CONCURRENTLY valid", statements)
+
+        # the invalid leftover is dropped before it is built again
+        drop = statements.index('DROP INDEX CONCURRENTLY IF EXISTS "invalid"')
+        self.assertEqual(statements[drop + 1], "CREATE INDEX CONCURRENTLY invalid")
+
+    def test_build_failed(self):
+        def execute(statement, *args):
+            if str(statement) == "CREATE INDEX CONCURRENTLY missing":
+                raise OperationalError("CREATE INDEX", {}, Exception("any error"))
+            return MagicMock(all=MagicMock(return_value=[]))
+
+        self.connection.execute.side_effect = execute
+        builder = IndexBuilder(self.storage, self.indexes)
+
+        with self.assertRaisesRegex(GOBException, "missing"):
+            builder.build()
+
+        # the other indexes are built, the lock is released
+        self.assertEqual(builder.progress.created, ["valid", "invalid"])
+        self.assertEqual(builder.progress.failed, ["missing"])
+        self.assertIn("pg_advisory_unlock", self._statements()[-1])
+
+    def test_start(self):
+        builder = IndexBuilder(self.storage, self.indexes)
+        on_complete = MagicMock()
+
+        builder.start(on_complete)
+
+        self.assertTrue(builder.wait(timeout=10))
+        on_complete.assert_called_once()
+
+        # failed builds do not complete
+        builder = IndexBuilder(self.storage, self.indexes)
+        builder.build = MagicMock(side_effect=GOBException("any error"))
+        on_complete.reset_mock()
+
+        builder.start(on_complete)
+
+        self.assertFalse(builder.wait(timeout=10))
+        on_complete.assert_not_called()
+
+    def test_progress(self):
+        builder = IndexBuilder(self.storage, self.indexes)
+        builder._progress.building.append("missing")
+
+        progress = builder.progress
+        progress.building.clear()
+
+        self.assertEqual(builder.progress.building, ["missing"])
+        self.assertEqual(IndexBuildProgress(total=3, created=["a"], failed=["b"]).done, 2)
@@ -0,0 +1,173 @@
+import json
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from gobupload.storage.instrumentation import (
+    SQLInstrumentation, SQLTrace, normalize, fingerprint, step, in_context, instrumented, _step
+)
+
+
+class TestNormalize(TestCase):
+
+    def test_normalize(self):
+        self.assertEqual(
+            normalize("SELECT *\n  FROM rel_a_2 WHERE id IN (1, 2,3) AND name = 'it''s' AND x > 1.5"),
+            "SELECT * FROM rel_a_2 WHERE id IN (?) AND name = ? AND x > ?"
+        )
+        self.assertEqual(fingerprint(normalize("SELECT 1")), fingerprint(normalize("SELECT  2")))
+
+        # the random suffix of temporary tables
+        self.assertEqual(
+            normalize("INSERT INTO tmp_apply_ab12cd34 SELECT * FROM tmp_meetbouten_meetbouten_12345678"),
+            "INSERT INTO tmp_apply_? SELECT * FROM tmp_meetbouten_meetbouten_?"
+        )
+        self.assertEqual(normalize("ANALYZE tmp_confirms_x1y2z3w4"), "ANALYZE tmp_confirms_?")
+        self.assertEqual(normalize("SELECT tmp_value FROM tmp_a_b"), "SELECT tmp_value FROM tmp_a_b")
+        self.assertNotEqual(fingerprint("SELECT a"), fingerprint("SELECT b"))
+
+
+class TestSQLTrace(TestCase):
+
+    def test_summary(self):
+        trace = SQLTrace("apply")
+        trace.record("SELECT 1", "apply", 0.5, 1)
+        trace.record("SELECT 2", "apply", 1.0, 1)
+        trace.record("SELECT 1", "apply/other", 0.1, None)
+        trace.record("UPDATE a SET b = 1", "apply", 0.2, 10)
+
+        summary = trace.summary(top=2)
+
+        self.assertEqual(summary["statements"], 4)
+        self.assertEqual(summary["duration"], 1.8)
+        self.assertEqual(summary["rows"], 12)
+        self.assertEqual(summary["top"], [
+            {
+                "fingerprint": fingerprint("SELECT ?"),
+                "step": "apply",
+                "calls": 2,
+                "duration": 1.5,
+                "rows": 2,
+                "statement": "SELECT ?",
+            },
+            {
+                "fingerprint": fingerprint("UPDATE a SET b = ?"),
+                "step": "apply",
+                "calls": 1,
+                "duration": 0.2,
+                "rows": 10,
+                "statement": "UPDATE a SET b = ?",
+            },
+        ])
+
+    def test_record_file(self):
+        file = MagicMock()
+        trace = SQLTrace("compare", "any jobid", file)
+
+        trace.record("SELECT 'a'", "compare", 0.5, 1, True)
+
+        line = json.loads(file.write.call_args[0][0])
+        self.assertEqual(line["job"], "compare")
+        self.assertEqual(line["jobid"], "any jobid")
+        self.assertEqual(line["statement"], "SELECT ?")
+        self.assertEqual(line["rows"], 1)
+        self.assertTrue(line["executemany"])
+
+
+class TestSQLInstrumentation(TestCase):
+
+    def _execute(self, statement: str, rowcount: int):
+        conn = MagicMock(info={})
+        cursor = MagicMock(rowcount=rowcount)
+        SQLInstrumentation._before_cursor_execute(conn, cursor, statement, {}, None, False)
+        SQLInstrumentation._after_cursor_execute(conn, cursor, statement, {}, None, False)
+
+    @patch("gobupload.storage.instrumentation.event")
+    def test_install(self, mock_event):
+        instrumentation = SQLInstrumentation()
+        engine = MagicMock()
+        mock_event.contains.return_value = False
+
+        instrumentation.install(engine)
+
+        self.assertTrue(instrumentation.enabled)
+        mock_event.listen.assert_any_call(engine, "before_cursor_execute", instrumentation._before_cursor_execute)
+        mock_event.listen.assert_any_call(engine, "after_cursor_execute", instrumentation._after_cursor_execute)
+
+    def test_trace_disabled(self):
+        with SQLInstrumentation().trace("apply") as trace:
+            self._execute("SELECT 1", 1)
+
+        self.assertIsNone(trace)
+
+    def test_trace(self):
+        instrumentation = SQLInstrumentation()
+        instrumentation.enabled = True
+
+        self._execute("SELECT 1", 1)
+
+        with instrumentation.trace("relate") as trace:
+            self._execute("SELECT 1", 1)
+
+            with step("chunk 1"):
+                self._execute("SELECT 1", -1)
+
+                with step("insert"):
+                    self._execute("INSERT INTO a VALUES (1)", 5)
+
+        self._execute("SELECT 1", 1)
+
+        steps = {(item["step"], item["calls"], item["rows"]) for item in trace.summary()["top"]}
+        self.assertEqual(steps, {("relate", 1, 1), ("relate/chunk 1", 1, 0), ("relate/chunk 1/insert", 1, 5)})
+        self.assertIsNone(_step.get())
+
+    def test_trace_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "trace.jsonl"
+            instrumentation = SQLInstrumentation(path)
+            instrumentation.enabled = True
+
+            with instrumentation.trace("compare", "any jobid"):
+                self._execute("SELECT 1", 1)
+                self._execute("SELECT 2", 1)
+
+            lines = path.read_text().splitlines()
+
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[0])["jobid"], "any jobid")
+
+    def test_in_context(self):
+        instrumentation = SQLInstrumentation()
+        instrumentation.enabled = True
+
+        def work(name):
+            with step(name):
+                self._execute("SELECT 1", 1)
+
+        with instrumentation.trace("apply") as trace:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                list(executor.map(in_context(work), ["a", "b", "c"]))
+
+        steps = sorted(item["step"] for item in trace.summary()["top"])
+        self.assertEqual(steps, ["apply/a", "apply/b", "apply/c"])
+
+
+class TestInstrumented(TestCase):
+
+    @patch("gobupload.storage.instrumentation.sql_instrumentation")
+    def test_instrumented(self, mock_instrumentation):
+        trace = mock_instrumentation.trace.return_value.__enter__.return_value
+        job = instrumented("apply")(lambda msg: {"header": msg["header"], "summary": {"warnings": []}})
+
+        result = job({"header": {"jobid": "any jobid"}})
+
+        mock_instrumentation.trace.assert_called_with("apply", "any jobid")
+        self.assertEqual(result["summary"], {"warnings": [], "sql": trace.summary.return_value})
+
+        # not enabled
+        mock_instrumentation.trace.return_value.__enter__.return_value = None
+
+        result = job({"header": {}})
+        self.assertEqual(result["summary"], {"warnings": []})
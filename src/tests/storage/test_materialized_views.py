@@ -41,12 +41,55 @@ class TestMaterializedView(TestCase):
 
     def test_refresh(self):
         storage_handler = MagicMock()
-        self.mv.refresh(storage_handler)
-        storage_handler.execute.assert_called_with(f"REFRESH MATERIALIZED VIEW {self.mv.name}")
+        storage_handler.MATERIALIZED_VIEW_REFRESHES_TABLE = "materialized_view_refreshes"
+
+        connection = storage_handler.engine.begin.return_value.__enter__.return_value
+
+        # last event of the relation table, last event at the last refresh
+        storage_handler.get_query_value.side_effect = [20, 10]
+        self.assertTrue(self.mv.refresh(storage_handler))
+
+        # the refresh is recorded in the same transaction
+        refresh, record = connection.execute.call_args_list
+        self.assertEqual(str(refresh[0][0]), f"REFRESH MATERIALIZED VIEW CONCURRENTLY {self.mv.name}")
+        self.assertIn("INSERT INTO materialized_view_refreshes", str(record[0][0]))
+        self.assertEqual(record[0][1], {"name": self.mv.name, "last_event": 20})
+        self.assertIn(f"FROM {self.mv.relation_table_name}", storage_handler.get_query_value.call_args_list[0][0][0])
+
+        # unchanged, skipped unless forced
+        connection.execute.reset_mock()
+        storage_handler.get_query_value.side_effect = [20, 20]
+        self.assertFalse(self.mv.refresh(storage_handler))
+        connection.execute.assert_not_called()
+
+        storage_handler.get_query_value.side_effect = [20, 20]
+        self.assertTrue(self.mv.refresh(storage_handler, force=True))
+        connection.execute.assert_called()
+
+        # never refreshed before
+        storage_handler.get_query_value.side_effect = [0, None]
+        self.assertTrue(self.mv.refresh(storage_handler))
+
+        # lazy, a missing view is created on its first refresh
+        self.mv.lazy = True
+        self.mv.create = MagicMock()
+        connection.execute.reset_mock()
+        storage_handler.get_query_value.side_effect = [None, 30]
+        self.assertTrue(self.mv.refresh(storage_handler))
+        self.mv.create.assert_called_with(storage_handler)
+        self.assertEqual(connection.execute.call_args[0][1], {"name": self.mv.name, "last_event": 30})
+        self.mv.lazy = False
+
+        # incremental, the changes are applied
+        self.mv.incremental = True
+        self.mv.apply_changes = MagicMock(return_value=0)
+        self.assertFalse(self.mv.refresh(storage_handler))
+        self.mv.apply_changes.assert_called_with(storage_handler)
 
     def test_create(self):
         self.mv._create_indexes = MagicMock()
         storage_handler = MagicMock()
+        storage_handler.get_query_value.return_value = None
 
         self.mv.create(storage_handler, False)
         storage_handler.execute.assert_called_with(
@@ -78,6 +121,7 @@ class TestMaterializedView(TestCase):
     def test_create_force_recreate(self):
         self.mv._create_indexes = MagicMock()
         storage_handler = MagicMock()
+        storage_handler.get_query_value.return_value = "m"
 
         self.mv.create(storage_handler, True)
         storage_handler.execute.assert_has_calls([
@@ -89,8 +133,132 @@ class TestMaterializedView(TestCase):
 
         self.mv._create_indexes.assert_called_with(storage_handler, True)
 
+    def test_create_incremental(self):
+        self.mv._create_indexes = MagicMock()
+        self.mv.incremental = True
+        storage_handler = MagicMock()
+
+        # the materialized view of the non-incremental mode is replaced by a table
+        storage_handler.get_query_value.return_value = "m"
+        self.mv.create(storage_handler)
+        storage_handler.execute.assert_has_calls([
+            call(f"DROP MATERIALIZED VIEW IF EXISTS {self.mv.name} CASCADE"),
+            call(f"CREATE TABLE IF NOT EXISTS {self.mv.name} AS "
+                 f"SELECT _gobid,src_id,src_volgnummer,dst_id,begin_geldigheid,eind_geldigheid,bronwaarde,_last_event "
+                 f"FROM {self.mv.relation_table_name} WHERE _date_deleted IS NULL"),
+        ])
+
+        storage_handler.execute.reset_mock()
+        storage_handler.get_query_value.return_value = "r"
+        self.mv.create(storage_handler)
+        storage_handler.execute.assert_called_once()
+
+        self.mv.create(storage_handler, True)
+        storage_handler.execute.assert_any_call(f"DROP TABLE IF EXISTS {self.mv.name} CASCADE")
+
+    def test_create_indexes_incremental(self):
+        storage_handler = MagicMock()
+        self.mv.incremental = True
+        self.mv._create_indexes(storage_handler)
+
+        storage_handler.execute.assert_any_call(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS gobid_{self.mv.name} ON {self.mv.name}(_gobid)"
+        )
+        storage_handler.execute.assert_called_with(
+            f"CREATE INDEX IF NOT EXISTS last_event_{self.mv.name} ON {self.mv.name}(_last_event)"
+        )
+
+    def test_get_committed_sources(self):
+        storage_handler = MagicMock(APPLY_LOCK=19935914, APPLY_XID_PREFIX="gob_apply")
+        connection = MagicMock()
+        connection.execute.return_value.all.return_value = [
+            MagicMock(source="source a"), MagicMock(source="source b")
+        ]
+        # source b has a running or interrupted two-phase apply
+        connection.execute.return_value.scalar.side_effect = [True, False]
+
+        sources = self.mv._get_committed_sources(connection, storage_handler)
+        self.assertEqual([source.source for source in sources], ["source a"])
+
+        query, committed_a, committed_b = connection.execute.call_args_list
+        self.assertEqual(query[0][1], {"name": self.mv.name, "entity": self.relation_name})
+        self.assertIn("pg_try_advisory_xact_lock_shared", str(committed_a[0][0]))
+        self.assertIn("pg_prepared_xacts", str(committed_a[0][0]))
+        self.assertEqual(committed_b[0][1], {
+            "lock": 19935914,
+            "name": f"{self.mv.relation_table_name}.source b",
+            "prefix": f"gob_apply.{self.mv.relation_table_name}.source b."
+        })
+
+    def test_apply_changes(self):
+        storage_handler = MagicMock()
+        connection = storage_handler.engine.begin.return_value.__enter__.return_value
+        connection.execute.return_value.scalar.return_value = 10
+        connection.execute.return_value.rowcount = 2
+
+        self.mv._get_committed_sources = MagicMock(return_value=[("source a", 30, 20), ("source b", 40, None)])
+
+        self.assertEqual(self.mv.apply_changes(storage_handler), 8)
+
+        lock, delete_a, upsert_a, watermark_a, last_event, delete_b, upsert_b, watermark_b = \
+            connection.execute.call_args_list
+        self.assertIn("pg_advisory_xact_lock", str(lock[0][0]))
+        self.assertIn(f"DELETE FROM {self.mv.name} AS mv", str(delete_a[0][0]))
+        self.assertEqual(delete_a[0][1], {"source": "source a", "last_event": 20})
+        self.assertIn("ON CONFLICT (_gobid) DO UPDATE SET src_id = EXCLUDED.src_id", str(upsert_a[0][0]))
+        self.assertEqual(upsert_a[0][1], {"source": "source a", "last_event": 20})
+
+        # the watermark advances to the applied eventid of the source
+        self.assertIn("ON CONFLICT (name, source)", str(watermark_a[0][0]))
+        self.assertEqual(watermark_a[0][1], {"name": self.mv.name, "source": "source a", "last_event": 30})
+
+        # no watermark yet, continue from the last event in the table
+        self.assertEqual(str(last_event[0][0]), f"SELECT COALESCE(MAX(_last_event), 0) FROM {self.mv.name}")
+        self.assertEqual(upsert_b[0][1], {"source": "source b", "last_event": 10})
+        self.assertEqual(watermark_b[0][1], {"name": self.mv.name, "source": "source b", "last_event": 40})
+
+    def test_verify(self):
+        storage_handler = MagicMock()
+        connection = storage_handler.engine.connect.return_value.__enter__.return_value
+        connection.execute.return_value.one.return_value = (1, 2)
+
+        self.assertEqual(self.mv.verify(storage_handler), (1, 2))
+        self.assertIn("EXCEPT ALL", str(connection.execute.call_args[0][0]))
+
+    def test_repair(self):
+        storage_handler = MagicMock()
+        connection = storage_handler.engine.begin.return_value.__enter__.return_value
+
+        self.mv.refresh = MagicMock()
+        self.mv.repair(storage_handler)
+        self.mv.refresh.assert_called_with(storage_handler, force=True)
+        connection.execute.assert_not_called()
+
+        self.mv.incremental = True
+        self.mv._get_committed_sources = MagicMock(return_value=[MagicMock(source="source a", applied_eventid=30)])
+        self.mv.repair(storage_handler)
+        statements = [str(args[0][0]) for args in connection.execute.call_args_list]
+        self.assertEqual(statements[1], f"DELETE FROM {self.mv.name}")
+        self.assertTrue(statements[2].startswith(f"INSERT INTO {self.mv.name}"))
+        self.assertEqual(connection.execute.call_args[0][1], {
+            "name": self.mv.name, "source": "source a", "last_event": 30
+        })
+
+    def test_get_definition(self):
+        definition = self.mv.get_definition()
+        self.assertIn(f"CREATE MATERIALIZED VIEW IF NOT EXISTS {self.mv.name}", definition["query"])
+        self.assertEqual(definition["indexes"][f"src_id_{self.mv.name}"], ["src_id"])
+        self.assertEqual(list(definition["indexes"]), [
+            f"src_id_{self.mv.name}",
+            f"dst_id_{self.mv.name}",
+            f"gobid_{self.mv.name}",
+            f"src_dst_wide_{self.mv.name}",
+        ])
+        self.assertEqual(definition["unique_indexes"], [f"gobid_{self.mv.name}"])
+
     def test_create_indexes(self):
         storage_handler = MagicMock()
+        storage_handler.get_query_value.return_value = None
         self.mv.dst_has_states = True
         self.mv.src_has_states = True
         self.mv._create_indexes(storage_handler)
@@ -98,11 +266,20 @@ class TestMaterializedView(TestCase):
         storage_handler.execute.assert_has_calls([
             call(f"CREATE INDEX IF NOT EXISTS src_id_{self.mv.name} ON {self.mv.name}(src_id)"),
             call(f"CREATE INDEX IF NOT EXISTS dst_id_{self.mv.name} ON {self.mv.name}(dst_id)"),
-            call(f"CREATE INDEX IF NOT EXISTS gobid_{self.mv.name} ON {self.mv.name}(_gobid)"),
+            call(f"CREATE UNIQUE INDEX IF NOT EXISTS gobid_{self.mv.name} ON {self.mv.name}(_gobid)"),
             call(f"CREATE INDEX IF NOT EXISTS src_dst_wide_{self.mv.name} ON "
                  f"{self.mv.name}(src_id,src_volgnummer,dst_id,dst_volgnummer)")
         ])
 
+        # a non-unique _gobid index of an existing view is replaced
+        storage_handler.get_query_value.return_value = True
+        self.mv._create_indexes(storage_handler)
+        storage_handler.execute.assert_has_calls([
+            call(f"DROP INDEX IF EXISTS gobid_{self.mv.name}"),
+            call(f"CREATE UNIQUE INDEX IF NOT EXISTS gobid_{self.mv.name} ON {self.mv.name}(_gobid)"),
+        ])
+        self.assertIn(f"to_regclass('gobid_{self.mv.name}')", storage_handler.get_query_value.call_args[0][0])
+
 
 class TestMaterializedViews(TestCase):
 
@@ -126,6 +303,35 @@ class TestMaterializedViews(TestCase):
         mv.initialise(storage_handler, ["some view"])
         mocked_view.create.assert_called_with(storage_handler, True)
 
+    def test_initialise_parallel_lazy(self):
+        mv = MaterializedViews()
+        mv.drop = MagicMock()
+        storage_handler = MagicMock()
+
+        existing, missing, recreated = MagicMock(), MagicMock(), MagicMock()
+        existing.name, missing.name, recreated.name = "existing", "missing", "recreated"
+        existing.exists.return_value = True
+        missing.exists.return_value = False
+        recreated.exists.return_value = True
+        mv.get_all = MagicMock(return_value=[existing, missing, recreated])
+
+        mv.initialise(storage_handler, ["recreated"], workers=3, lazy=True)
+
+        # missing and recreated views are created on their first refresh
+        existing.create.assert_called_with(storage_handler, False)
+        missing.create.assert_not_called()
+        recreated.create.assert_not_called()
+        mv.drop.assert_called_once_with(storage_handler, "recreated")
+
+        mv.initialise(storage_handler, ["recreated"], workers=3)
+        missing.create.assert_called_with(storage_handler, False)
+        recreated.create.assert_called_with(storage_handler, True)
+
+        # errors are raised
+        missing.create.side_effect = ValueError("any error")
+        with self.assertRaises(ValueError):
+            mv.initialise(storage_handler, workers=3)
+
     @patch("gobupload.storage.materialized_views.model_relations.get_relations")
     @patch("gobupload.storage.materialized_views.MaterializedView")
     def test_get_all(self, mock_materialized_view, mock_get_relations):
@@ -157,6 +363,18 @@ class TestMaterializedViews(TestCase):
         mv.get_by_relation_name.assert_called_with('cat_col_attr')
         self.assertEqual(mv.get_by_relation_name.return_value, res)
 
+    def test_drop(self):
+        storage_handler = MagicMock(MATERIALIZED_VIEW_WATERMARKS_TABLE="materialized_view_watermarks")
+
+        storage_handler.get_query_value.return_value = "r"
+        MaterializedViews.drop(storage_handler, "mv_name")
+        storage_handler.execute.assert_any_call("DELETE FROM materialized_view_watermarks WHERE name = 'mv_name'")
+        storage_handler.execute.assert_called_with("DROP TABLE IF EXISTS mv_name CASCADE")
+        self.assertIn("relname = 'mv_name'", storage_handler.get_query_value.call_args[0][0])
+
+        MaterializedViews.drop(storage_handler, "mv_name", "m")
+        storage_handler.execute.assert_called_with("DROP MATERIALIZED VIEW IF EXISTS mv_name CASCADE")
+
     @patch("gobupload.storage.materialized_views.MaterializedView")
     def test_get_by_relation_name(self, mock_materialized_view):
         self.assertEqual(mock_materialized_view.return_value,
@@ -0,0 +1,83 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from sqlalchemy import exc as sa_exc
+
+from gobupload.storage.partitions import EventPartitions
+
+
+class TestEventPartitions(TestCase):
+
+    def setUp(self):
+        self.engine = MagicMock()
+        self.connection = self.engine.begin.return_value.__enter__.return_value
+        self.partitions = EventPartitions(self.engine)
+
+    def _statements(self):
+        return [str(args[0][0]) for args in self.connection.execute.call_args_list]
+
+    def test_get_names(self):
+        self.assertEqual(self.partitions.get_names("rel", "bag_vot_bag_nag_heeft_hoofdadres", "GOB"), (
+            "events.rel",
+            "events.rel_bag_vot_bag_nag_heeft_hoofdadres",
+            "events.rel_bag_vot_bag_nag_heeft_hoofdadres_gob",
+        ))
+
+    def test_sequence(self):
+        mock_connection = self.engine.connect.return_value.__enter__.return_value
+        mock_connection.execute.return_value.scalar.return_value = "public.events_eventid_seq"
+
+        self.assertEqual(self.partitions.sequence, "public.events_eventid_seq")
+        self.assertEqual(self.partitions.sequence, "public.events_eventid_seq")
+        mock_connection.execute.assert_called_once()
+
+    def test_get_creates(self):
+        # the source partition does not exist
+        self.connection.execute.return_value.scalar.return_value = None
+
+        self.assertEqual(self.partitions.get("meetbouten", "metingen", "AMSBI"), "events.meetbouten_metingen_amsbi")
+
+        statements = self._statements()
+        self.assertEqual(statements[1:4], [
+            "CREATE TABLE IF NOT EXISTS events.meetbouten PARTITION OF events "
+            "FOR VALUES IN ('meetbouten') PARTITION BY LIST (entity)",
+            "CREATE TABLE IF NOT EXISTS events.meetbouten_metingen PARTITION OF events.meetbouten "
+            "FOR VALUES IN ('metingen') PARTITION BY LIST (source)",
+            "CREATE TABLE IF NOT EXISTS events.meetbouten_metingen_amsbi PARTITION OF events.meetbouten_metingen "
+            "FOR VALUES IN ('AMSBI')",
+        ])
+        self.assertIn("INSERT INTO event_partitions", statements[4])
+        self.assertEqual(self.connection.execute.call_args[0][1], {
+            "catalogue": "meetbouten", "entity": "metingen", "source": "AMSBI",
+            "tablename": "meetbouten_metingen_amsbi"
+        })
+
+        # the name is cached
+        self.connection.execute.reset_mock()
+        self.assertEqual(self.partitions.get("meetbouten", "metingen", "AMSBI"), "events.meetbouten_metingen_amsbi")
+        self.connection.execute.assert_not_called()
+
+    def test_get_exists(self):
+        self.connection.execute.return_value.scalar.return_value = "events.meetbouten_metingen_amsbi"
+
+        self.partitions.get("meetbouten", "metingen", "AMSBI")
+
+        # only registered
+        statements = self._statements()
+        self.assertEqual(len(statements), 2)
+        self.assertIn("INSERT INTO event_partitions", statements[1])
+
+    def test_get_created_concurrently(self):
+        error = sa_exc.DBAPIError("CREATE TABLE", {}, Exception("duplicate key"))
+        self.connection.execute.side_effect = [
+            MagicMock(**{"scalar.return_value": None}), error, MagicMock(**{"scalar.return_value": None})
+        ]
+
+        with self.assertRaises(sa_exc.DBAPIError):
+            self.partitions.get("meetbouten", "metingen", "AMSBI")
+
+        self.connection.execute.side_effect = [
+            MagicMock(**{"scalar.return_value": None}), error,
+            MagicMock(**{"scalar.return_value": "events.meetbouten_metingen_amsbi"}), None
+        ]
+        self.assertEqual(self.partitions.get("meetbouten", "metingen", "AMSBI"), "events.meetbouten_metingen_amsbi")
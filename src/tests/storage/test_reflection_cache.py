@@ -0,0 +1,63 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy import MetaData, Table, Column, Integer
+
+from gobupload.storage.reflection_cache import ReflectionCache
+
+
+class TestReflectionCache(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name) / "reflection.pickle"
+        self.cache = ReflectionCache(self.path)
+
+        self.metadata = MetaData()
+        Table("table1", self.metadata, Column("_gobid", Integer, primary_key=True))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_disabled(self):
+        cache = ReflectionCache("")
+        self.assertFalse(cache.enabled)
+
+        cache.save(("rev", "1.0", "2.0"), self.metadata)
+        self.assertIsNone(cache.load(("rev", "1.0", "2.0")))
+        cache.invalidate()
+
+    def test_save_load(self):
+        key = ("rev", "1.0", "2.0")
+        self.assertIsNone(self.cache.load(key))
+
+        self.cache.save(key, self.metadata)
+        self.assertEqual(list(self.cache.load(key).tables), ["table1"])
+        self.assertEqual(list(self.path.parent.iterdir()), [self.path])
+
+        # another revision
+        self.assertIsNone(self.cache.load(("rev2", "1.0", "2.0")))
+
+        self.cache.invalidate()
+        self.assertIsNone(self.cache.load(key))
+        self.cache.invalidate()
+
+    def test_load_corrupt(self):
+        self.path.write_bytes(b"not a pickle")
+        self.assertIsNone(self.cache.load(("rev", "1.0", "2.0")))
+
+    @patch("builtins.print", MagicMock())
+    def test_save_error(self):
+        cache = ReflectionCache(Path(self.directory.name) / "missing" / "reflection.pickle")
+        cache.save(("rev", "1.0", "2.0"), self.metadata)
+        self.assertIsNone(cache.load(("rev", "1.0", "2.0")))
+
+    @patch("gobupload.storage.reflection_cache.migration.MigrationContext")
+    @patch("gobupload.storage.reflection_cache._get_model_version", MagicMock(return_value="2.31.0"))
+    def test_get_key(self, mock_context):
+        mock_context.configure.return_value.get_current_revision.return_value = "a9c6d7e8f0b1"
+
+        key = self.cache.get_key(MagicMock())
+        self.assertEqual(key[:2], ("a9c6d7e8f0b1", "2.31.0"))
@@ -43,6 +43,10 @@ class TestAlembicUtils(TestCase):
                 "UPDATE events SET entity = 'new_relation_name' WHERE catalogue='rel' AND entity = 'old_relation_name'"),
         ])
 
+        registration = op.execute.call_args[0][0]
+        assert "DELETE FROM event_partitions WHERE catalogue = 'rel' AND entity = 'old_relation_name'" in registration
+        assert "SELECT 'rel', 'new_relation_name', 'GOB', 'rel_new_relation_name_gob'" in registration
+
     def test_downgrade_relations(self):
         op = MagicMock()
         downgrade_relations(op, self.renamed_relations)
@@ -1,3 +1,4 @@
+import os
 import sys
 from unittest import TestCase, mock
 
@@ -20,7 +21,7 @@ class TestMain(TestCase):
                                             'gob.workflow.apply.queue': {'load_message': False}
                                         })
         mock_service.return_value.start.assert_called_with()
-        mock_storage.return_value.init_storage.assert_called_with()
+        mock_storage.return_value.init_storage.assert_called_with(background_indexes=False)
 
         for key, definition in SERVICEDEFINITION.items():
             self.assertTrue('queue' in definition)
@@ -76,6 +77,103 @@ class TestMain(TestCase):
             recreate_materialized_views=['some_mv_name']
         )
 
+    @mock.patch("gobupload.__main__.standalone.run_as_standalone")
+    @mock.patch('gobupload.__main__.GOBStorageHandler')
+    def test_main_calls_backfill_event_partitions(self, mock_storage, mock_standalone):
+        sys.argv = ['python -m gobupload', 'backfill_event_partitions']
+        with self.assertRaisesRegex(SystemExit, "0"):
+            main()
+
+        mock_storage.return_value.backfill_event_partitions.assert_called_once()
+        mock_standalone.assert_not_called()
+
+    @mock.patch("gobupload.__main__.standalone.run_as_standalone")
+    @mock.patch('gobupload.__main__.EventArchiver')
+    @mock.patch('gobupload.__main__.GOBStorageHandler')
+    def test_main_calls_archive_events(self, mock_storage, mock_archiver, mock_standalone):
+        mock_storage.return_value.get_source_catalogue_entity_combinations.return_value = iter(["collection1"])
+        mock_archiver.return_value.archive.return_value = mock.MagicMock(events=10, reclaimed=2 ** 20)
+
+        sys.argv = [
+            'python -m gobupload', 'archive_events', '--cutoff', '100', '--directory', '/tmp/archive',
+            '--catalogue', 'meetbouten'
+        ]
+        with self.assertRaisesRegex(SystemExit, "0"):
+            main()
+
+        mock_storage.return_value.get_source_catalogue_entity_combinations.assert_called_with("meetbouten", None)
+        mock_archiver.assert_called_with(mock_storage.return_value, "/tmp/archive")
+        mock_archiver.return_value.archive.assert_called_with(100, False)
+        mock_standalone.assert_not_called()
+
+    @mock.patch("gobupload.__main__.standalone.run_as_standalone")
+    @mock.patch('gobupload.__main__.TableRebuilder')
+    @mock.patch('gobupload.__main__.GOBStorageHandler')
+    def test_main_calls_rebuild_table(self, mock_storage, mock_rebuilder, mock_standalone):
+        mock_storage.return_value.get_source_catalogue_entity_combinations.return_value = iter(["collection1"])
+        mock_rebuilder.return_value.rebuild.return_value = mock.MagicMock(
+            events=100, duration=2.0, events_per_second=50.0
+        )
+
+        sys.argv = [
+            'python -m gobupload', 'rebuild_table', '--catalogue', 'meetbouten', '--collection', 'metingen',
+            '--workers', '8'
+        ]
+        with self.assertRaisesRegex(SystemExit, "0"):
+            main()
+
+        mock_storage.assert_any_call("collection1")
+        mock_rebuilder.assert_called_with(mock_storage.return_value, 8, None)
+        mock_standalone.assert_not_called()
+
+        mock_storage.return_value.get_source_catalogue_entity_combinations.return_value = iter([])
+        with self.assertRaisesRegex(SystemExit, str(os.EX_DATAERR)):
+            main()
+
+    @mock.patch("gobupload.__main__.standalone.run_as_standalone")
+    @mock.patch('gobupload.__main__.GOBStorageHandler')
+    def test_main_calls_verify_event_watermarks(self, mock_storage, mock_standalone):
+        mock_storage.return_value.get_event_watermark_collections.return_value = ["collection1", "collection2"]
+        mock_storage.return_value.verify_event_watermarks.side_effect = [True, False, True, False]
+
+        sys.argv = ['python -m gobupload', 'verify_event_watermarks']
+        with self.assertRaisesRegex(SystemExit, str(os.EX_DATAERR)):
+            main()
+
+        mock_storage.assert_any_call("collection2")
+        mock_storage.return_value.verify_event_watermarks.assert_called_with(rebuild=False)
+
+        sys.argv = ['python -m gobupload', 'verify_event_watermarks', '--rebuild']
+        with self.assertRaisesRegex(SystemExit, "0"):
+            main()
+
+        mock_storage.return_value.verify_event_watermarks.assert_called_with(rebuild=True)
+        mock_standalone.assert_not_called()
+
+    @mock.patch("gobupload.__main__.standalone.run_as_standalone")
+    @mock.patch("gobupload.__main__.MaterializedViews")
+    @mock.patch('gobupload.__main__.GOBStorageHandler')
+    def test_main_calls_verify_materialized_views(self, mock_storage, mock_views, mock_standalone):
+        view1, view2 = mock.MagicMock(), mock.MagicMock()
+        view1.name, view2.name = "mv_view1", "mv_view2"
+        view1.verify.return_value = (0, 0)
+        view2.verify.return_value = (2, 1)
+        mock_views.return_value.get_all.return_value = [view1, view2]
+
+        sys.argv = ['python -m gobupload', 'verify_materialized_views']
+        with self.assertRaisesRegex(SystemExit, str(os.EX_DATAERR)):
+            main()
+
+        view2.repair.assert_not_called()
+
+        sys.argv = ['python -m gobupload', 'verify_materialized_views', '--mv-name', 'mv_view2', '--repair']
+        with self.assertRaisesRegex(SystemExit, "0"):
+            main()
+
+        view1.verify.assert_called_once()
+        view2.repair.assert_called_once_with(mock_storage.return_value)
+        mock_standalone.assert_not_called()
+
     @mock.patch('gobupload.__main__.GOBStorageHandler')
     @mock.patch('gobupload.__main__.standalone.run_as_standalone', return_value=0)
     def test_main_calls_run_as_standalone(self, mock_run_as_standalone, mock_storage):
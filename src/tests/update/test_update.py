@@ -26,11 +26,16 @@ class TestUpdate(TestCase):
 
     def test_get_event_ids(self, _):
         mock_storage = MagicMock()
-        mock_storage.get_entity_max_eventid = MagicMock(return_value="max")
-        mock_storage.get_last_eventid = MagicMock(return_value="last")
+        mock_storage.get_event_watermarks = MagicMock(return_value=("max", "last"))
         max_id, last_id = get_event_ids(mock_storage)
         self.assertEqual(max_id, "max")
         self.assertEqual(last_id, "last")
+        mock_storage.rebuild_event_watermarks.assert_not_called()
+
+        # initialize the watermarks the first time
+        mock_storage.get_event_watermarks.return_value = None
+        mock_storage.rebuild_event_watermarks.return_value = ("max", "last")
+        self.assertEqual(get_event_ids(mock_storage), ("max", "last"))
 
     @patch('gobupload.update.main.get_event_ids')
     def test_fullupdate_saves_event(self, mock_ids, mock):
@@ -60,11 +65,9 @@ class TestUpdate(TestCase):
 
         message = fixtures.get_event_message_fixture('ADD')
 
-        self.mock_storage.get_events_starting_after.return_value = []
-
-        result = full_update(message)
+        full_update(message)
 
-        self.mock_storage.get_events_starting_after.assert_not_called()
+        self.mock_storage.add_events.assert_called()
 
     @patch('gobcore.events.GobEvent')
     @patch('gobupload.update.main.get_event_ids')
@@ -78,12 +81,9 @@ class TestUpdate(TestCase):
 
         message = fixtures.get_event_message_fixture()
 
-        self.mock_storage.get_events_starting_after.return_value = []
-
         full_update(message)
 
         self.mock_storage.add_events.assert_not_called()
-        self.mock_storage.get_events_starting_after.assert_not_called()
 
     @patch('gobcore.events.GobEvent')
     @patch('gobupload.update.main.get_event_ids')
@@ -100,12 +100,9 @@ class TestUpdate(TestCase):
             id_to_pop = message['contents'][0]['data']['_tid']
             gob_event.pop_ids.return_value = id_to_pop, id_to_pop
 
-            self.mock_storage.get_events_starting_after.return_value = []
-
             full_update(message)
 
             self.mock_storage.add_events.assert_called()
-            self.mock_storage.get_events_starting_after.assert_not_called()
 
     def test_statistics(self, mock):
         stats = UpdateStatistics()
@@ -172,6 +169,7 @@ class TestUpdate(TestCase):
 
         _store_events(self.mock_storage, last_events, [event], stats)
 
+        self.mock_storage.get_event_partition.assert_called_once()
         assert stats.num_events == 1
         assert stats.num_single_events == 1
         assert len(stats.stored) == 1
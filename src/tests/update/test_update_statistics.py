@@ -37,3 +37,24 @@ class TestUpdateStatistics(TestCase):
         us = UpdateStatistics()
 
         self.assertEqual(expected, us._get_stats(stats))
+
+    def test_merge(self):
+        us = UpdateStatistics()
+        us.store_event({"event": "ADD"})
+        us.add_applied("ADD", 1)
+
+        other = UpdateStatistics()
+        other.store_event({"event": "ADD"})
+        other.store_event({"event": "BULKCONFIRM", "data": {"confirms": [{}, {}]}})
+        other.skip_event({"event": "MODIFY"})
+        other.add_applied("ADD", 1)
+        other.add_applied("CONFIRM", 2)
+
+        us.merge(other)
+
+        self.assertEqual(us.stored, {"ADD": 2, "CONFIRM": 2})
+        self.assertEqual(us.skipped, {"MODIFY": 1})
+        self.assertEqual(us.applied, {"ADD": 2, "CONFIRM": 2})
+        self.assertEqual(us.num_events, 4)
+        self.assertEqual(us.num_single_events, 3)
+        self.assertEqual(us.num_bulk_events, 1)